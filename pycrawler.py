@@ -12,7 +12,10 @@
 # Version: 0.1
 # Release Date: 22/11/2020
 
-from pycrawler_lib.main import main
+import pycrawler_lib.profiling as profiling
+
+with profiling.phase('import pycrawler_lib.main'):
+    from pycrawler_lib.main import main
 
 if __name__ == '__main__':
     main()
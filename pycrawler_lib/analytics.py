@@ -0,0 +1,448 @@
+import json
+import logging
+import os
+import time
+
+from os.path import exists, getsize, isdir, join
+
+from typing import Dict
+from typing import List
+
+import numpy
+
+import pycrawler_lib.counters as counters
+import pycrawler_lib.sharding as sharding
+
+log = logging.getLogger('main_logger')
+
+# daily aggregates of counter series are cached in gathered_commands/.report_cache/<series>.npz and updated
+# incrementally: columns are append-only, hence only rows appended since the previous report are read
+REPORT_CACHE_DIR_NAME = '.report_cache'
+CACHE_VERSION = 2
+
+DAY = 86400
+
+# aggregation key: source (27 bits) | counter (20 bits) | day since epoch (16 bits)
+COUNTER_BITS = 20
+DAY_BITS = 16
+SOURCE_SHIFT = COUNTER_BITS + DAY_BITS
+COUNTER_DAY_MASK = (1 << SOURCE_SHIFT) - 1
+
+# sums kept for each source x counter x day. Rates are taken only over rows with non-zero interval
+# (e.g. the first delta or back-to-back runs have none): rated_value, count, rate and rate_sq skip the rest
+AGGREGATES = ('value', 'rated_value', 'interval', 'count', 'rate', 'rate_sq')
+
+PERCENTILES = (50, 90, 99)
+
+# baseline of a device must have at least this many snapshots to detect anomalies against it
+MIN_BASELINE_SNAPSHOTS = 10
+
+
+def series_sources(gathered_commands_path: str) -> Dict:
+    """
+    :return: {series: [(source, device name)]}, where series is the file name of a delta command
+             (e.g. 'show_asp_drop') and source is the directory with counter columns relative to gathered_commands:
+             <device>/counters/<series> or nodes/<node>/<device>/counters/<series> (sharding mode)
+    """
+    device_paths = []
+    for name in sorted(os.listdir(gathered_commands_path)):
+        if name.startswith('.') or name == sharding.DEVICES_DIR_NAME:
+            continue
+
+        if name == sharding.NODES_DIR_NAME:
+            nodes_path = join(gathered_commands_path, name)
+            for node_name in sorted(os.listdir(nodes_path)):
+                node_path = join(nodes_path, node_name)
+                if isdir(node_path):
+                    device_paths += [(device_name, join(name, node_name, device_name))
+                                     for device_name in sorted(os.listdir(node_path))
+                                     if not device_name.startswith('.')]
+        else:
+            device_paths.append((name, name))
+
+    sources = dict()
+    for device_name, device_path in device_paths:
+        counters_path = join(gathered_commands_path, device_path, counters.COUNTERS_DIR_NAME)
+        if not isdir(counters_path):
+            continue
+
+        for series in sorted(os.listdir(counters_path)):
+            if isdir(join(counters_path, series)):
+                sources.setdefault(series, []).append((join(device_path, counters.COUNTERS_DIR_NAME, series),
+                                                       device_name))
+
+    return sources
+
+
+def column_rows(series_path: str) -> int:
+    """
+    :return: number of rows which have been written to all columns of the series (columns are never truncated here,
+             report doesn't write to gathered commands)
+    """
+    rows = []
+    for column, (typecode, dtype) in counters.COLUMNS.items():
+        filename = counters.column_filename(series_path, column)
+        rows.append(getsize(filename) // numpy.dtype(dtype).itemsize if exists(filename) else 0)
+
+    return min(rows)
+
+
+def read_column(series_path: str, column: str, start: int, stop: int):
+    """
+    :return: rows start:stop of the column. The file is memory-mapped, only the requested rows are read
+    """
+    dtype = numpy.dtype(f'<{counters.COLUMNS[column][1]}')
+    if stop <= start:
+        return numpy.array([], dtype=dtype)
+
+    return numpy.memmap(counters.column_filename(series_path, column), dtype=dtype, mode='r',
+                        offset=start * dtype.itemsize, shape=(stop - start,))
+
+
+def read_names(series_path: str) -> List:
+    filename = join(series_path, counters.COUNTER_NAMES_FILENAME)
+    if not exists(filename):
+        return []
+
+    with open(filename, 'r') as fp:
+        return json.load(fp)
+
+
+class SeriesData:
+    """
+    Counter series of a delta command for the whole fleet: daily sums of each source x counter
+    plus raw rows of the recent window.
+    """
+
+    def __init__(self, series: str):
+        self.series = series
+        # source directories (relative to gathered_commands), device name of each source and rows read from it
+        self.sources = []
+        self.source_devices = []
+        self.rows = numpy.array([], dtype='<u8')
+        # names of counters of the whole fleet (global counter ids are positions in this list)
+        self.names = []
+        # sorted unique aggregation keys and sums for each of them
+        self.keys = numpy.array([], dtype='<i8')
+        self.sums = {aggregate: numpy.array([], dtype='<f8') for aggregate in AGGREGATES}
+        # rows of the recent window: source, counter, timestamp, value, interval
+        self.recent = dict()
+        # timestamp of the latest row
+        self.latest = 0.0
+
+    def load_cache(self, filename: str) -> None:
+        if not exists(filename):
+            return
+
+        try:
+            with numpy.load(filename, allow_pickle=False) as cache:
+                if int(cache['version']) != CACHE_VERSION:
+                    return
+                self.sources = cache['sources'].tolist()
+                self.source_devices = cache['source_devices'].tolist()
+                self.rows = cache['rows']
+                self.names = cache['names'].tolist()
+                self.keys = cache['keys']
+                self.sums = {aggregate: cache[aggregate] for aggregate in AGGREGATES}
+                self.latest = float(cache['latest'])
+        except (OSError, ValueError, KeyError) as e:
+            log.error('Unable to read report cache: %s. It will be rebuilt. Error: %s', filename, e)
+            self.__init__(self.series)
+
+    def save_cache(self, filename: str) -> None:
+        tmp_filename = filename + '.tmp'
+
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(tmp_filename, 'wb') as fp:
+                numpy.savez(fp, version=CACHE_VERSION, sources=numpy.array(self.sources, dtype=str),
+                            source_devices=numpy.array(self.source_devices, dtype=str), rows=self.rows,
+                            names=numpy.array(self.names, dtype=str), keys=self.keys, latest=self.latest,
+                            **self.sums)
+            os.replace(tmp_filename, filename)
+        except OSError as e:
+            log.error('Unable to write report cache: %s. Error: %s', filename, e)
+
+    def update(self, gathered_commands_path: str, sources: List) -> int:
+        """
+        Reads rows appended to columns of the sources since the cache has been written and adds them to daily sums.
+        Sources which have disappeared are dropped, sources which have been truncated are read from the beginning.
+
+        :param sources: [(source, device name)]
+        :return: number of rows read
+        """
+        name_ids = {name: counter_id for counter_id, name in enumerate(self.names)}
+        cached = {source: position for position, source in enumerate(self.sources)}
+        # position of each cached source in the new list of sources (-1 - dropped)
+        new_positions = numpy.full(len(self.sources), -1, dtype='<i8')
+
+        rows = []
+        parts = []
+        for position, (source, device_name) in enumerate(sources):
+            series_path = join(gathered_commands_path, source)
+            rows_now = column_rows(series_path)
+
+            start = 0
+            cached_position = cached.get(source)
+            if cached_position is not None and self.rows[cached_position] <= rows_now:
+                new_positions[cached_position] = position
+                start = int(self.rows[cached_position])
+            rows.append(rows_now)
+
+            if start == rows_now:
+                continue
+
+            # local counter ids of the source -> global ones
+            local_names = read_names(series_path)
+            counter_ids = read_column(series_path, 'counter_id', start, rows_now)
+            local_names += [f'#{counter_id}' for counter_id in range(len(local_names), int(counter_ids.max()) + 1)]
+            for name in local_names:
+                if name not in name_ids:
+                    name_ids[name] = len(self.names)
+                    self.names.append(name)
+            lookup = numpy.array([name_ids[name] for name in local_names], dtype='<i8')
+
+            timestamps = read_column(series_path, 'timestamp', start, rows_now)
+            values = numpy.array(read_column(series_path, 'value', start, rows_now))
+            intervals = numpy.array(read_column(series_path, 'interval', start, rows_now))
+            rated = intervals > 0
+            rates = numpy.where(rated, read_column(series_path, 'rate', start, rows_now), 0.0)
+            keys = (position << SOURCE_SHIFT) | (lookup[counter_ids] << DAY_BITS) \
+                | (timestamps // DAY).astype('<i8')
+            parts.append((keys, {'value': values,
+                                 'rated_value': numpy.where(rated, values, 0.0),
+                                 'interval': numpy.where(rated, intervals, 0.0),
+                                 'count': rated.astype('<f8'),
+                                 'rate': rates,
+                                 'rate_sq': rates * rates}))
+            self.latest = max(self.latest, float(timestamps[-1]))
+
+        new_rows = sum(len(keys) for keys, sums in parts)
+        dropped = bool((new_positions < 0).any())
+
+        if parts or dropped or len(self.sources) != len(sources):
+            # sums of cached sources are moved to their new positions
+            old_positions = new_positions[self.keys >> SOURCE_SHIFT]
+            kept = old_positions >= 0
+            old_keys = (old_positions[kept] << SOURCE_SHIFT) | (self.keys[kept] & COUNTER_DAY_MASK)
+
+            all_keys = numpy.concatenate([old_keys] + [keys for keys, sums in parts])
+            self.keys, inverse = numpy.unique(all_keys, return_inverse=True)
+            self.sums = {aggregate: numpy.bincount(inverse, minlength=len(self.keys),
+                                                   weights=numpy.concatenate([self.sums[aggregate][kept]]
+                                                                             + [sums[aggregate]
+                                                                                for keys, sums in parts]))
+                         for aggregate in AGGREGATES}
+
+        self.sources = [source for source, device_name in sources]
+        self.source_devices = [device_name for source, device_name in sources]
+        self.rows = numpy.array(rows, dtype='<u8')
+
+        return new_rows
+
+    def load_recent(self, gathered_commands_path: str, since: float) -> None:
+        """
+        Reads raw rows taken after since. Rows of each source are in time order, hence the start of the window
+        is found with binary search over the memory-mapped timestamp column.
+        """
+        name_ids = {name: counter_id for counter_id, name in enumerate(self.names)}
+        parts = []
+
+        for position, source in enumerate(self.sources):
+            series_path = join(gathered_commands_path, source)
+            rows = int(self.rows[position])
+            timestamps = read_column(series_path, 'timestamp', 0, rows)
+            start = int(numpy.searchsorted(timestamps, since, side='right'))
+            if start == rows:
+                continue
+
+            local_names = read_names(series_path)
+            counter_ids = read_column(series_path, 'counter_id', start, rows)
+            lookup = numpy.array([name_ids.get(name, -1) for name in local_names]
+                                 + [name_ids.get(f'#{counter_id}', -1)
+                                    for counter_id in range(len(local_names), int(counter_ids.max()) + 1)],
+                                 dtype='<i8')
+            parts.append({'source': numpy.full(rows - start, position, dtype='<i8'),
+                          'counter': lookup[counter_ids],
+                          'value': numpy.array(read_column(series_path, 'value', start, rows)),
+                          'interval': numpy.array(read_column(series_path, 'interval', start, rows))})
+
+        self.recent = {column: numpy.concatenate([part[column] for part in parts]) if parts
+                       else numpy.array([], dtype='<i8' if column in ('source', 'counter') else '<f8')
+                       for column in ('source', 'counter', 'value', 'interval')}
+
+
+def load_series(gathered_commands_path: str, series: str, sources: List, recent_seconds: int, use_cache=True):
+    """
+    :return: SeriesData with daily sums of all rows and raw rows of the last recent_seconds
+    """
+    cache_filename = join(gathered_commands_path, REPORT_CACHE_DIR_NAME, f'{series}.npz')
+    data = SeriesData(series)
+
+    if use_cache:
+        data.load_cache(cache_filename)
+
+    started = time.perf_counter()
+    new_rows = data.update(gathered_commands_path, sources)
+    log.info('%s: %s new rows of %s sources have been loaded in %.3f sec',
+             series, new_rows, len(sources), time.perf_counter() - started)
+
+    if use_cache and new_rows:
+        data.save_cache(cache_filename)
+
+    data.load_recent(gathered_commands_path, data.latest - recent_seconds)
+
+    return data
+
+
+def format_time(timestamp: float) -> str:
+    return time.strftime('%Y-%m-%d %H:%M', time.gmtime(timestamp))
+
+
+def divide(numerator, denominator):
+    """
+    :return: numerator / denominator, 0 where denominator is 0
+    """
+    return numpy.divide(numerator, denominator, out=numpy.zeros(len(numerator)), where=denominator > 0)
+
+
+def summarize_series(data: SeriesData, days: int, recent_seconds: int, top=10, threshold=3.0) -> str:
+    """
+    :param days: how many days (including the day of the latest row) to report on
+    :param recent_seconds: rates of this many last seconds are compared against the rest of the days (baseline)
+    :param threshold: z-score of the recent rate of a counter against its baseline to report it as an anomaly
+    :return: report with top counters of the fleet, fleet percentiles of their rates and anomalies
+    """
+    if not len(data.keys):
+        return f'{data.series}: no counters have been collected yet'
+
+    devices, source_device = numpy.unique(numpy.array(data.source_devices, dtype=str), return_inverse=True)
+    num_names = len(data.names)
+
+    # daily sums of the window -> sums of each device x counter
+    first_day = int(data.latest // DAY) - days + 1
+    in_window = (data.keys & ((1 << DAY_BITS) - 1)) >= first_day
+    window_keys = source_device[data.keys[in_window] >> SOURCE_SHIFT] * num_names \
+        + ((data.keys[in_window] & COUNTER_DAY_MASK) >> DAY_BITS)
+    pairs, inverse = numpy.unique(window_keys, return_inverse=True)
+    window = {aggregate: numpy.bincount(inverse, weights=data.sums[aggregate][in_window], minlength=len(pairs))
+              for aggregate in AGGREGATES}
+    pair_device = pairs // num_names
+    pair_counter = pairs % num_names
+
+    # the same for raw rows of the recent window, rows of counters unknown to the cache are skipped
+    recent = data.recent
+    known = recent['counter'] >= 0
+    recent_keys = source_device[recent['source'][known]] * num_names + recent['counter'][known]
+    positions = numpy.minimum(numpy.searchsorted(pairs, recent_keys), max(len(pairs) - 1, 0))
+    matched = pairs[positions] == recent_keys if len(pairs) else numpy.zeros(len(recent_keys), dtype=bool)
+    recent_positions = positions[matched]
+    recent_values = recent['value'][known][matched]
+    recent_row_intervals = recent['interval'][known][matched]
+    rated = recent_row_intervals > 0
+    recent_rates = divide(recent_values, recent_row_intervals)
+    recent_sums = {'value': numpy.bincount(recent_positions, weights=recent_values, minlength=len(pairs)),
+                   'rated_value': numpy.bincount(recent_positions, weights=numpy.where(rated, recent_values, 0.0),
+                                                 minlength=len(pairs)),
+                   'interval': numpy.bincount(recent_positions, weights=numpy.where(rated, recent_row_intervals, 0.0),
+                                              minlength=len(pairs)),
+                   'count': numpy.bincount(recent_positions, weights=rated.astype('<f8'), minlength=len(pairs)),
+                   'rate': numpy.bincount(recent_positions, weights=recent_rates, minlength=len(pairs)),
+                   'rate_sq': numpy.bincount(recent_positions, weights=recent_rates * recent_rates,
+                                             minlength=len(pairs))}
+    recent_intervals = recent_sums['interval']
+
+    lines = [f'{data.series}: {len(devices)} devices, {num_names} counters, '
+             f'from {format_time(first_day * DAY)} to {format_time(data.latest)} (UTC)']
+
+    # top counters of the fleet and the device with the largest total of each of them
+    totals = numpy.bincount(pair_counter, weights=window['value'], minlength=num_names)
+    affected = numpy.bincount(pair_counter, weights=window['value'] > 0, minlength=num_names)
+    order = numpy.lexsort((window['value'], pair_counter))
+    last_of_counter = numpy.flatnonzero(numpy.r_[pair_counter[order][1:] != pair_counter[order][:-1], True])
+    worst = numpy.full(num_names, -1)
+    worst[pair_counter[order][last_of_counter]] = order[last_of_counter]
+    top_counters = [counter_id for counter_id in numpy.argsort(-totals, kind='stable')[:top] if totals[counter_id] > 0]
+
+    lines += ['', f'Top {top} counters (fleet total over {days} days):',
+              f'{"counter":<60}{"total":>16}{"devices":>9}  {"worst device":<30}{"its total":>16}']
+    for counter_id in top_counters:
+        lines.append(f'{data.names[counter_id]:<60}{totals[counter_id]:>16.0f}{affected[counter_id]:>9.0f}  '
+                     f'{devices[pair_device[worst[counter_id]]]:<30}{window["value"][worst[counter_id]]:>16.0f}')
+
+    # percentiles of mean rate of each top counter over devices which have rows with non-zero interval in the window
+    device_intervals = numpy.zeros(len(devices))
+    numpy.maximum.at(device_intervals, pair_device, window['interval'])
+    active = numpy.flatnonzero(device_intervals > 0)
+    rank = numpy.full(num_names, -1)
+    rank[top_counters] = numpy.arange(len(top_counters))
+    rates = numpy.zeros((len(top_counters), len(devices)))
+    in_top = rank[pair_counter] >= 0
+    rates[rank[pair_counter[in_top]], pair_device[in_top]] = \
+        divide(window['rated_value'][in_top], device_intervals[pair_device[in_top]])
+    rates = rates[:, active]
+
+    lines += ['', f'Fleet percentiles of rate (per second) over {days} days:',
+              f'{"counter":<60}' + ''.join(f' {f"p{p}":>15}' for p in PERCENTILES) + f' {"max":>15}']
+    if len(top_counters) and len(active):
+        fleet_percentiles = numpy.percentile(rates, PERCENTILES, axis=1)
+        for position, counter_id in enumerate(top_counters):
+            lines.append(f'{data.names[counter_id]:<60}'
+                         + ''.join(f' {value:>15.3f}' for value in fleet_percentiles[:, position])
+                         + f' {rates[position].max():>15.3f}')
+
+    # recent rate of each device x counter against its own baseline (the window without the recent rows).
+    # Counters missing in a snapshot are zero (e.g. 'show asp drop' shows only non-zero ones), hence mean and
+    # deviation are taken over all snapshots of the device
+    baseline = {aggregate: window[aggregate] - recent_sums[aggregate] for aggregate in AGGREGATES}
+    device_snapshots = numpy.zeros(len(devices))
+    numpy.maximum.at(device_snapshots, pair_device, baseline['count'])
+    device_baseline_intervals = numpy.zeros(len(devices))
+    numpy.maximum.at(device_baseline_intervals, pair_device, baseline['interval'])
+
+    snapshots = device_snapshots[pair_device]
+    mean = divide(baseline['rated_value'], device_baseline_intervals[pair_device])
+    mean_rate = divide(baseline['rate'], snapshots)
+    deviation = numpy.sqrt(numpy.maximum(divide(baseline['rate_sq'], snapshots) - mean_rate ** 2, 0))
+    recent_rate = divide(recent_sums['rated_value'], recent_intervals)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        z = numpy.where(deviation > 0, (recent_rate - mean) / deviation,
+                        numpy.where(recent_rate > mean, numpy.inf, 0.0))
+    anomalies = numpy.flatnonzero((recent_intervals > 0) & (snapshots >= MIN_BASELINE_SNAPSHOTS)
+                                  & (recent_rate > mean) & (z >= threshold))
+    anomalies = anomalies[numpy.lexsort((-recent_rate[anomalies], -z[anomalies]))][:top]
+
+    lines += ['', f'Anomalies (rate of the last {recent_seconds} sec against baseline of the device, '
+                  f'z-score >= {threshold}):',
+              f'{"device":<30}{"counter":<60}{"rate":>15} {"baseline":>15} {"z-score":>10}']
+    for position in anomalies:
+        lines.append(f'{devices[pair_device[position]]:<30}{data.names[pair_counter[position]]:<60}'
+                     f'{recent_rate[position]:>15.3f} {mean[position]:>15.3f} {z[position]:>10.1f}')
+    if not len(anomalies):
+        lines.append('None')
+
+    return '\n'.join(lines)
+
+
+def report(gathered_commands_path: str, series_filter=None, days=7, recent_seconds=3600, top=10, threshold=3.0,
+           use_cache=True) -> str:
+    """
+    Builds report over counter series of delta commands of the whole fleet (see 'parse_counters' in settings.ini).
+
+    :param series_filter: file name of the delta command to report on (e.g. 'show_asp_drop'), None - all of them
+    :return: report or None if there are no counter series
+    """
+    sources = series_sources(gathered_commands_path)
+    if series_filter is not None:
+        sources = {series: sources[series] for series in sources if series == series_filter}
+
+    if not sources:
+        return None
+
+    reports = []
+    for series, sources_of_series in sources.items():
+        data = load_series(gathered_commands_path, series, sources_of_series, recent_seconds, use_cache)
+        reports.append(summarize_series(data, days, recent_seconds, top, threshold))
+
+    return '\n\n'.join(reports)
@@ -0,0 +1,180 @@
+import bisect
+import json
+import logging
+import os
+import re
+import threading
+
+from os.path import basename, exists, join
+
+from typing import List
+
+log = logging.getLogger('main_logger')
+
+INDEX_FILENAME = '.archive_index.json'
+ARCHIVE_DIR_NAME = 'archive'
+
+# archive file name: <command_filename>_<timestamp>.<gz|zst|lz4>
+ARCHIVE_NAME_RE = re.compile(r'^(?P<filename>.+)_(?P<timestamp>\d{10})\.(gz|zst|lz4)$')
+
+_indexes = dict()
+_indexes_lock = threading.Lock()
+
+
+class ArchiveIndex:
+    """
+    Persistent index of a directory with command files (e.g. gathered_commands/<device_name>/commands).
+
+    Tracks size of each plain text command file and list of its archives (sorted by timestamp),
+    hence neither rotation nor retention have to list and stat the directories on every run.
+    Index is stored in the directory itself as .archive_index.json and rebuilt from directory content if it's missing.
+    """
+
+    def __init__(self, dir_path: str):
+        self.dir_path = dir_path
+        self.archive_path = join(dir_path, ARCHIVE_DIR_NAME)
+        self.index_filename = join(dir_path, INDEX_FILENAME)
+
+        self._lock = threading.RLock()
+        # command filename -> size in bytes
+        self.files = dict()
+        # command filename -> list of [timestamp, archive filename] sorted by timestamp
+        self.archives = dict()
+        # whether index has been changed since it has been saved
+        self.changed = False
+
+        if not self.load():
+            self.rebuild()
+
+    def load(self) -> bool:
+        if not exists(self.index_filename):
+            return False
+
+        try:
+            with open(self.index_filename, 'r') as fp:
+                data = json.load(fp)
+            self.files = data['files']
+            self.archives = data['archives']
+        except (OSError, ValueError, KeyError) as e:
+            log.error('Unable to read archive index: %s. It will be rebuilt. Error: %s', self.index_filename, e)
+            return False
+
+        return True
+
+    def rebuild(self) -> None:
+        """
+        Builds index from content of the directory and its archive directory.
+        """
+        log.info('Building archive index for directory: %s', self.dir_path)
+
+        with self._lock:
+            self.files = dict()
+            self.archives = dict()
+
+            with os.scandir(self.dir_path) as entries:
+                for entry in entries:
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        self.files[entry.name] = entry.stat().st_size
+
+            if exists(self.archive_path):
+                with os.scandir(self.archive_path) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            self.add_archive(entry.name)
+
+            self.save()
+
+    def save(self) -> None:
+        """
+        Writes index to temporary file and renames it, hence index is never half-written.
+        """
+        tmp_filename = self.index_filename + '.tmp'
+
+        with self._lock:
+            data = {'files': self.files, 'archives': self.archives}
+
+            try:
+                with open(tmp_filename, 'w') as fp:
+                    json.dump(data, fp)
+                os.replace(tmp_filename, self.index_filename)
+                self.changed = False
+            except OSError as e:
+                log.error('Unable to write archive index: %s. Error: %s', self.index_filename, e)
+
+    def save_changes(self) -> None:
+        """
+        Saves index if it has been changed (e.g. sizes of files have been updated by writes).
+        """
+        with self._lock:
+            if self.changed:
+                self.save()
+
+    def update_size(self, filename: str, size: int) -> None:
+        with self._lock:
+            self.files[filename] = size
+            self.changed = True
+
+    def remove_file(self, filename: str) -> None:
+        with self._lock:
+            self.files.pop(filename, None)
+            self.changed = True
+
+    def big_files(self, size_limit: int) -> List:
+        """
+        :param size_limit: size in bytes
+        :return: absolute paths of command files which are bigger than size_limit
+        """
+        with self._lock:
+            return [join(self.dir_path, filename) for filename, size in self.files.items() if size > size_limit]
+
+    def add_archive(self, archive_name: str) -> None:
+        """
+        :param archive_name: archive file name (or absolute path) in format <command_filename>_<timestamp>.<ext>
+        """
+        archive_name = basename(archive_name)
+        match = ARCHIVE_NAME_RE.match(archive_name)
+        if not match:
+            return
+
+        with self._lock:
+            archives = self.archives.setdefault(match.group('filename'), [])
+            entry = [int(match.group('timestamp')), archive_name]
+            if entry not in archives:
+                bisect.insort(archives, entry)
+                self.changed = True
+
+    def trim_archives(self, filename: str, num_to_store: int) -> List:
+        """
+        Removes from index all archives of the command file but the newest num_to_store ones.
+
+        :return: absolute paths of archives to remove
+        """
+        with self._lock:
+            archives = self.archives.get(filename, [])
+            num_to_remove = max(len(archives) - num_to_store, 0)
+            to_remove = archives[:num_to_remove]
+            self.archives[filename] = archives[num_to_remove:]
+            self.changed = self.changed or bool(to_remove)
+
+        return [join(self.archive_path, archive_name) for timestamp, archive_name in to_remove]
+
+
+def get_index(dir_path: str) -> ArchiveIndex:
+    """
+    Returns index of the directory. Index is loaded only once per process.
+    """
+    with _indexes_lock:
+        index = _indexes.get(dir_path)
+        if index is None:
+            index = ArchiveIndex(dir_path)
+            _indexes[dir_path] = index
+
+    return index
+
+
+def command_filename(archive_name: str) -> str:
+    """
+    :return: name of the command file the archive has been created from
+    """
+    match = ARCHIVE_NAME_RE.match(basename(archive_name))
+    return match.group('filename') if match else ''
@@ -0,0 +1,331 @@
+import logging
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+
+from collections import deque
+from os.path import join
+
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+
+import pycrawler_lib.metrics as metrics
+
+log = logging.getLogger('main_logger')
+
+# outputs recorded from FTD, replayed by simulated devices
+SHOW_TIME_OUTPUT = 'Localtime - {localtime}\nUTC - {utc}\n'
+
+SHOW_FAILOVER_OUTPUT = '        This host: Primary - Active\n'
+
+SHOW_BLOCKS_OUTPUT = '''  SIZE    MAX    LOW    CNT
+     0   2950   2921   2950
+     4    400    398    399
+    80   2500   2446   2500
+   256   6404   6226   6404
+  1550  32136  31432  31951
+  2048   8100   8058   8100
+  2560   2920   2920   2920
+  4096    100    100    100
+  8192    100    100    100
+  9344  32000  31964  32000
+ 16384    104    104    104
+ 65536     16     16     16
+'''
+
+SHOW_ASP_DROP_OUTPUT = '''
+Frame drop:
+  Invalid TCP Length (invalid-tcp-hdr-length)                             {0}
+  No route to host (no-route)                                             {1}
+  Flow is denied by configured rule (acl-drop)                            {2}
+  First TCP packet not SYN (tcp-not-syn)                                  {3}
+  FP L2 rule drop (l2_acl)                                                {4}
+
+Last clearing: {clear_time} by enable_15
+
+Flow drop:
+  NAT failed (nat-failed)                                                 {5}
+  Inspection failure (inspect-fail)                                       {6}
+
+Last clearing: {clear_time} by enable_15
+'''
+
+SHOW_CRYPTO_ACCELERATOR_OUTPUT = '''
+Crypto Accelerator Status
+-------------------------
+[Capability]
+   Supports hardware native IPsec
+[Global Statistics]
+Number of active accelerators : 1
+Number of non-operational accelerators : 0
+Input packets: {0}
+Input bytes: {1}
+Output packets: {2}
+Output error packets: {3}
+Output bytes: {4}
+
+[Accelerator 0]
+   Status: OK
+   Software crypto engine
+   Input packets: {0}
+   Input bytes: {1}
+   Output packets: {2}
+   Output error packets: {3}
+   Output bytes: {4}
+'''
+
+
+# how much output a simulated terminal returns per read
+READ_SIZE = 64 * 1024
+
+
+class SimulatedMatch:
+    def __init__(self, match_output: str, last_match_index: int):
+        self.match_output = match_output
+        self.last_match_index = last_match_index
+
+
+class SimulatedSpawn:
+    """
+    Terminal of a simulated device: the part of unicon spawn API used for batched and streamed commands.
+    Output of commands is generated in pieces as it's read, hence huge outputs are never kept in memory as a whole.
+    """
+
+    def __init__(self, device: 'SimulatedDevice'):
+        self.device = device
+        self.buffer = ''
+        self._pieces = deque()
+
+    def sendline(self, command='') -> None:
+        time.sleep(self.device.latency)
+        for line in command.split('\n'):
+            self._pieces.append(self._respond(line))
+
+    def _respond(self, command: str) -> Iterator[str]:
+        yield f'{command}\r\n'
+        if command:
+            yield from self.device.output_pieces(command)
+        yield self.device.prompt
+
+    def _read(self) -> bool:
+        while self._pieces:
+            piece = next(self._pieces[0], None)
+            if piece is None:
+                self._pieces.popleft()
+                continue
+            self.buffer += piece
+            return True
+
+        return False
+
+    def expect(self, patterns: List, timeout=None) -> SimulatedMatch:
+        while True:
+            for position, pattern in enumerate(patterns):
+                match = re.search(pattern, self.buffer, re.DOTALL)
+                if match:
+                    match_output = self.buffer[:match.end()]
+                    self.buffer = self.buffer[match.end():]
+                    return SimulatedMatch(match_output, position)
+
+            if not self._read():
+                raise TimeoutError(f'{self.device.name}: no match for patterns: {patterns}')
+
+
+class SimulatedState:
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+
+
+class SimulatedStateMachine:
+    current_state = 'enable'
+
+    def __init__(self, prompt_pattern: str):
+        self._state = SimulatedState(prompt_pattern)
+
+    def get_state(self, state: str) -> SimulatedState:
+        return self._state
+
+
+class SimulatedDevice:
+    """
+    Device which replays recorded outputs with configurable latency, instead of connecting to a real firewall.
+    Implements the part of pyATS device API used by pycrawler.
+    """
+
+    def __init__(self, name: str, latency: float, output_size: int, device_os='fxos'):
+        """
+        :param latency: delay (in seconds) of connect and of each command
+        :param output_size: approximate size (in bytes) of output of 'show blocks' commands
+        """
+        self.name = name
+        self.os = device_os
+        self.type = 'ftd'
+        self.custom = dict()
+        self.latency = latency
+        self.output_size = output_size
+
+        self._connected = False
+        self._counters = [0] * 7
+        self._random = random.Random(name)
+
+        self.prompt = f'{name}> '
+        self.spawn = SimulatedSpawn(self)
+        self.state_machine = SimulatedStateMachine(r'^(.*?)' + re.escape(name) + r'> $')
+
+    def connect(self, **kwargs) -> None:
+        time.sleep(self.latency)
+        self._connected = True
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def disconnect(self) -> None:
+        self._connected = False
+
+    def execute(self, command: str, **kwargs) -> str:
+        time.sleep(self.latency)
+
+        if command.startswith('show blocks'):
+            return ''.join(self.output_pieces(command)) + '>'
+
+        return self.render(command)
+
+    def output_pieces(self, command: str) -> Iterator[str]:
+        """
+        Yields output of the command in pieces of up to READ_SIZE, as it's read from the terminal.
+        """
+        if not command.startswith('show blocks'):
+            yield self.render(command)
+            return
+
+        repeat = max(self.output_size // len(SHOW_BLOCKS_OUTPUT), 1)
+        repeat_per_piece = max(READ_SIZE // len(SHOW_BLOCKS_OUTPUT), 1)
+        for position in range(0, repeat, repeat_per_piece):
+            yield SHOW_BLOCKS_OUTPUT * min(repeat_per_piece, repeat - position)
+
+    def render(self, command: str) -> str:
+        if command == 'show time':
+            now = time.gmtime()
+            return SHOW_TIME_OUTPUT.format(localtime=time.strftime('%a %b %d %H:%M:%S UTC %Y', now),
+                                           utc=time.strftime('%a %b %d %H:%M:%S UTC %Y', now))
+
+        if command.startswith('show failover'):
+            return SHOW_FAILOVER_OUTPUT
+
+        if command.startswith('clear'):
+            self._counters = [0] * len(self._counters)
+            return ''
+
+        if command == 'show asp drop' or command == 'show crypto accelerator statistics':
+            self._counters = [counter + self._random.randint(0, 1000) for counter in self._counters]
+            output = SHOW_ASP_DROP_OUTPUT if command == 'show asp drop' else SHOW_CRYPTO_ACCELERATOR_OUTPUT
+            return output.format(*self._counters, clear_time=time.strftime('%H:%M:%S UTC %b %d %Y'))
+
+        return ''
+
+
+class SimulatedTestbed:
+    def __init__(self, num_devices: int, latency: float, output_size: int):
+        self.devices = {f'sim-ftd-{i}': SimulatedDevice(f'sim-ftd-{i}', latency, output_size)
+                        for i in range(num_devices)}
+
+
+def get_dir_size(dir_path: str) -> int:
+    size = 0
+    for root, dirs, files in os.walk(dir_path):
+        for filename in files:
+            try:
+                size += os.path.getsize(join(root, filename))
+            except OSError:
+                pass
+
+    return size
+
+
+def sample_values(metric: str, samples: List) -> List:
+    return [sample['value'] for sample in samples if sample['metric'] == metric]
+
+
+def run_fleet(num_devices: int, collect_commands: Callable, collect_deltas: Callable, wait_for_archives: Callable,
+              runs: int, latency: float, output_size: int, dir_path: str) -> Dict:
+    """
+    Collects commands and delta commands from a simulated fleet runs times.
+
+    :param collect_commands: function collect_commands(testbed, dir_name) to collect regular commands
+    :param collect_deltas: function collect_deltas(testbed, dir_name) to collect delta commands
+    :param wait_for_archives: function to wait for background writes and compression to finish
+    :return: results of the benchmark for the fleet
+    """
+    testbed = SimulatedTestbed(num_devices, latency, output_size)
+    fleet_path = join(dir_path, f'fleet_{num_devices}')
+
+    metrics.take_samples()
+    started = time.perf_counter()
+
+    for run in range(runs):
+        log.info('Benchmark: %s devices, run %s of %s', num_devices, run + 1, runs)
+        collect_commands(testbed, fleet_path)
+        collect_deltas(testbed, fleet_path)
+
+    wait_for_archives()
+    duration = time.perf_counter() - started
+    samples = metrics.take_samples()
+    bytes_written = sum(sample_values('output_bytes', samples))
+
+    return {'devices': num_devices,
+            'runs': runs,
+            'duration': duration,
+            'devices_per_minute': num_devices * runs / duration * 60,
+            'bytes_written': bytes_written,
+            'bytes_per_second': bytes_written / duration,
+            'bytes_stored': get_dir_size(fleet_path),
+            'rotation': sum(sample_values('rotation', samples)),
+            'compress': sum(sample_values('compress', samples)),
+            'execute_p95': metrics.percentile(sample_values('execute', samples), 95)}
+
+
+def format_results(results: List) -> str:
+    lines = [f'{"devices":>8}{"runs":>6}{"seconds":>10}{"devices/min":>13}{"MB written":>12}{"MB/s":>9}'
+             f'{"MB on disk":>12}{"rotation s":>12}{"compress s":>12}{"execute p95":>13}']
+
+    for result in results:
+        lines.append(f'{result["devices"]:>8}{result["runs"]:>6}{result["duration"]:>10.2f}'
+                     f'{result["devices_per_minute"]:>13.1f}{result["bytes_written"] / 10 ** 6:>12.2f}'
+                     f'{result["bytes_per_second"] / 10 ** 6:>9.2f}{result["bytes_stored"] / 10 ** 6:>12.2f}'
+                     f'{result["rotation"]:>12.3f}'
+                     f'{result["compress"]:>12.3f}{result["execute_p95"]:>13.3f}')
+
+    return '\n'.join(lines)
+
+
+def run_benchmark(collect_commands: Callable, collect_deltas: Callable, wait_for_archives: Callable,
+                  fleet_sizes: List, runs=2, latency=0.05, output_size=4096, dir_path=None) -> List:
+    """
+    Measures throughput of collection against simulated fleets of different size.
+    Output is written to a temporary directory which is removed afterwards (unless dir_path is specified).
+
+    :param fleet_sizes: numbers of devices to simulate, e.g. [10, 100, 1000, 5000]
+    :param runs: how many times to collect commands from each fleet (deltas are written starting from the 2nd run)
+    :return: list of results, one per fleet size
+    """
+    remove_dir = dir_path is None
+    if dir_path is None:
+        dir_path = tempfile.mkdtemp(prefix='pycrawler_benchmark_')
+    else:
+        os.makedirs(dir_path, exist_ok=True)
+
+    results = []
+    try:
+        for num_devices in fleet_sizes:
+            results.append(run_fleet(num_devices, collect_commands, collect_deltas, wait_for_archives,
+                                     runs, latency, output_size, dir_path))
+    finally:
+        if remove_dir:
+            shutil.rmtree(dir_path, ignore_errors=True)
+
+    return results
@@ -0,0 +1,361 @@
+import gzip
+import logging
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+
+from os import listdir
+from os.path import basename, dirname, exists, join
+
+from typing import Callable
+
+import pycrawler_lib.metrics as metrics
+
+log = logging.getLogger('main_logger')
+
+# extension of archive files for each supported codec
+CODEC_EXTENSIONS = {'gzip': 'gz', 'zstd': 'zst', 'lz4': 'lz4'}
+
+# compression levels which are accepted by each codec
+CODEC_LEVELS = {'gzip': (0, 9), 'zstd': (0, 22), 'lz4': (0, 16)}
+DEFAULT_LEVEL = 6
+
+PENDING_SUFFIX = '.pending'
+TMP_SUFFIX = '.tmp'
+
+# sidecar files of an archive (hidden files next to it): offset index of the original file (moved with it)
+# and map of compressed blocks
+INDEX_SUFFIX = '.idx'
+BLOCKS_SUFFIX = '.blocks'
+
+# archives are written as a sequence of independent gzip members (zstd/lz4 frames) of BLOCK_SIZE uncompressed bytes,
+# hence a part of the archive could be read by decompressing only the blocks it's in.
+# Such archive is still a regular one for zcat, zstd -d and lz4 -d
+BLOCK_SIZE = 1024 * 1024
+
+# Each entry in the map of blocks: uncompressed offset (uint64) | compressed offset (uint64)
+BLOCK_ENTRY = struct.Struct('<QQ')
+
+
+def check_codec(codec: str) -> str:
+    """
+    Checks that library for the codec is installed. Falls back to gzip otherwise.
+
+    :param codec: one of 'gzip', 'zstd', 'lz4'
+    :return: codec which is available
+    """
+    try:
+        if codec == 'zstd':
+            import zstandard  # noqa: F401
+        elif codec == 'lz4':
+            import lz4.frame  # noqa: F401
+    except ImportError:
+        log.error('Library for "%s" compression is not installed. Falling back to "gzip". '
+                  'Install it with: pip install %s', codec, 'zstandard' if codec == 'zstd' else 'lz4')
+        return 'gzip'
+
+    return codec
+
+
+def check_level(codec: str, level: int) -> int:
+    """
+    Checks that the level is accepted by the codec (e.g. zstd level 19 is not valid for gzip it has fallen back to).
+
+    :param codec: one of 'gzip', 'zstd', 'lz4'
+    :return: level or DEFAULT_LEVEL if the codec doesn't accept it
+    """
+    min_level, max_level = CODEC_LEVELS[codec]
+    if min_level <= level <= max_level:
+        return level
+
+    log.error('Compression level %s is not valid for "%s" codec: it must be between %s and %s. '
+              'Using default level: %s', level, codec, min_level, max_level, DEFAULT_LEVEL)
+    return DEFAULT_LEVEL
+
+
+def compress_bytes(data: bytes, codec: str, level: int) -> bytes:
+    """
+    Compresses data in memory. 'gzip' codec uses zlib format (without gzip header) for a smaller overhead.
+    """
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress(data, compression_level=level)
+
+    return zlib.compress(data, level)
+
+
+def decompress_bytes(data: bytes, codec: str) -> bytes:
+    if codec == 'zstd':
+        import zstandard
+        # frames written by make_compressor() have no content size in their header
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress(data)
+
+    return zlib.decompress(data)
+
+
+class LZ4Compressor:
+    """
+    lz4 frame compressor with the same interface as zlib's compressobj: compress(data) and flush().
+    """
+
+    def __init__(self, level: int):
+        import lz4.frame
+        self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self._started = False
+
+    def _begin(self) -> bytes:
+        if self._started:
+            return b''
+        self._started = True
+        return self._compressor.begin()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._begin() + self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._begin() + self._compressor.flush()
+
+
+def make_compressor(codec: str, level: int):
+    """
+    :return: incremental compressor with compress(data) and flush(). Its output is the same format
+             as the one of compress_bytes(), hence it's decompressed with decompress_bytes()
+    """
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compressobj()
+
+    if codec == 'lz4':
+        return LZ4Compressor(level)
+
+    return zlib.compressobj(level)
+
+
+def compress_block(data: bytes, codec: str, level: int) -> bytes:
+    """
+    Compresses data as a standalone gzip member (zstd/lz4 frame).
+    """
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress(data, compression_level=level)
+
+    return gzip.compress(data, compresslevel=level)
+
+
+def decompress_block(data: bytes, codec: str) -> bytes:
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress(data)
+
+    return gzip.decompress(data)
+
+
+def decompress_file(filename: str, codec: str) -> bytes:
+    """
+    Decompresses the whole archive (e.g. archive which has been written before archives were split into blocks).
+    """
+    if codec == 'zstd':
+        import zstandard
+        with open(filename, 'rb') as fp:
+            return zstandard.ZstdDecompressor().stream_reader(fp, read_across_frames=True).readall()
+
+    if codec == 'lz4':
+        import lz4.frame
+        with lz4.frame.open(filename, 'rb') as fp:
+            return fp.read()
+
+    with gzip.open(filename, 'rb') as fp:
+        return fp.read()
+
+
+def sidecar_filename(archive_name: str, suffix: str) -> str:
+    """
+    :param archive_name: archive (or pending file): archive/<command_filename>_<timestamp>.<gz|zst|lz4|pending>
+    :return: archive/.<command_filename>_<timestamp><suffix>
+    """
+    return join(dirname(archive_name), f'.{basename(archive_name).rsplit(".", 1)[0]}{suffix}')
+
+
+def remove_sidecars(archive_name: str) -> None:
+    for suffix in (INDEX_SUFFIX, BLOCKS_SUFFIX):
+        try:
+            os.remove(sidecar_filename(archive_name, suffix))
+        except FileNotFoundError:
+            pass
+
+
+def compress_file(f_in_name: str, f_out_name: str, codec: str, level: int) -> str:
+    """
+    Compresses file block by block and removes the original one. Runs in a worker process.
+
+    Archive is written to a temporary file first and renamed when it's complete,
+    hence crash during compression never leaves half-written archive.
+
+    :return: name of the archive file
+    """
+    f_tmp_name = f_out_name + TMP_SUFFIX
+    blocks = []
+
+    with open(f_in_name, 'rb') as f_in:
+        with open(f_tmp_name, 'wb') as f_out:
+            uncompressed_offset = 0
+            while True:
+                data = f_in.read(BLOCK_SIZE)
+                if not data:
+                    break
+                blocks.append(BLOCK_ENTRY.pack(uncompressed_offset, f_out.tell()))
+                f_out.write(compress_block(data, codec, level))
+                uncompressed_offset += len(data)
+
+            f_out.flush()
+            os.fsync(f_out.fileno())
+
+    blocks_name = sidecar_filename(f_out_name, BLOCKS_SUFFIX)
+    with open(blocks_name + TMP_SUFFIX, 'wb') as f_blocks:
+        f_blocks.write(b''.join(blocks))
+    os.replace(blocks_name + TMP_SUFFIX, blocks_name)
+
+    os.replace(f_tmp_name, f_out_name)
+    os.remove(f_in_name)
+
+    return f_out_name
+
+
+def compress_file_timed(f_in_name: str, f_out_name: str, codec: str, level: int):
+    """
+    :return: name of the archive file and time of compression in seconds
+    """
+    started = time.perf_counter()
+    f_out_name = compress_file(f_in_name, f_out_name, codec, level)
+    return f_out_name, time.perf_counter() - started
+
+
+class Archiver:
+    """
+    Background compression stage for archive rotation.
+
+    Collectors hand over big plain text files with archive(): the file is moved to the archive directory
+    right away (so collectors could start writing a new file) and compressed in a pool of worker processes.
+    """
+
+    def __init__(self, codec='gzip', level=DEFAULT_LEVEL, max_workers=2):
+        self.codec = check_codec(codec)
+        self.extension = CODEC_EXTENSIONS[self.codec]
+        self.level = check_level(self.codec, level)
+        self.max_workers = max_workers
+
+        self._executor = None
+        self._lock = threading.Lock()
+        # pending files which are queued to compression already
+        self._queued = set()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # worker processes are started only when there is something to compress.
+        # 'spawn' is used since forking a process with running collector threads is not safe
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def archive(self, big_file: str, abs_archive_path: str, on_done: Callable = None, index_file: str = None) -> None:
+        """
+        Moves big_file to archive directory and queues it for compression.
+
+        :param big_file: plain text file to archive
+        :param abs_archive_path: archive directory
+        :param on_done: function on_done(archive_name) to call when archive has been written (e.g. to apply retention)
+        :param index_file: offset index of big_file to move together with it (offsets stay valid for the archive)
+        """
+        timestamp = int(time.time())
+        pending_name = join(abs_archive_path, f'{basename(big_file)}_{timestamp}{PENDING_SUFFIX}')
+
+        try:
+            os.replace(big_file, pending_name)
+        except OSError as e:
+            log.error('Unable to move file: %s to archive directory: %s. Error: %s', big_file, abs_archive_path, e)
+            return
+
+        if index_file is not None and exists(index_file):
+            try:
+                os.replace(index_file, sidecar_filename(pending_name, INDEX_SUFFIX))
+            except OSError as e:
+                log.error('Unable to move offset index: %s to archive directory: %s. Error: %s',
+                          index_file, abs_archive_path, e)
+
+        self._submit(pending_name, on_done)
+        self.recover_pending(abs_archive_path, on_done)
+
+    def recover_pending(self, abs_archive_path: str, on_done: Callable = None) -> None:
+        """
+        Queues files which have been moved to archive directory but not compressed (e.g. process has been killed).
+        """
+        for filename in listdir(abs_archive_path):
+            pending_name = join(abs_archive_path, filename)
+
+            with self._lock:
+                queued = pending_name in self._queued
+
+            if filename.endswith(PENDING_SUFFIX) and not queued:
+                log.info('Found file which has not been compressed during previous run: %s', pending_name)
+                self._submit(pending_name, on_done)
+
+    def _submit(self, pending_name: str, on_done: Callable = None) -> None:
+        archive_name = pending_name[:-len(PENDING_SUFFIX)] + f'.{self.extension}'
+        log.debug('file to compress: %s, archive: %s', pending_name, archive_name)
+
+        with self._lock:
+            self._queued.add(pending_name)
+
+        future = self._get_executor().submit(compress_file_timed, pending_name, archive_name, self.codec,
+                                             self.level)
+
+        def done(f):
+            with self._lock:
+                self._queued.discard(pending_name)
+
+            try:
+                archive_name, seconds = f.result()
+                log.info('File has been archived successfully: %s', archive_name)
+                metrics.observe('compress', seconds, command=basename(pending_name).rsplit('_', 1)[0])
+            except Exception as e:
+                log.error('Unable to archive file: %s. Error: %s', pending_name, e)
+                return
+
+            if on_done is not None:
+                on_done(archive_name)
+
+        future.add_done_callback(done)
+
+    def shutdown(self) -> None:
+        """
+        Waits for all queued files to be compressed.
+        """
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+
+        if executor is not None:
+            log.debug('Waiting for compression of archive files to finish')
+            executor.shutdown(wait=True)
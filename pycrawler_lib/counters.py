@@ -0,0 +1,335 @@
+import json
+import logging
+import os
+import re
+import sys
+
+from array import array
+from os.path import exists, getsize, join
+
+from typing import Dict
+
+log = logging.getLogger('main_logger')
+
+COUNTERS_DIR_NAME = 'counters'
+COUNTER_NAMES_FILENAME = 'counters.json'
+
+# Columns of counter series (one row per counter per snapshot). Each column is a flat binary file
+# with little-endian values, which could be loaded with e.g. numpy.fromfile(path, dtype='<f8')
+COLUMNS = {'timestamp': ('d', 'f8'),
+           'interval': ('d', 'f8'),
+           'counter_id': ('I', 'u4'),
+           'value': ('d', 'f8'),
+           'rate': ('d', 'f8')}
+
+# Table of regular expressions to get counters from outputs of the commands without Genie parser.
+# 'section' matches line with name of the section (used as a prefix of counter name),
+# 'counter' matches line with a counter: its name ('key') and value
+COUNTER_PATTERNS = {
+    'show asp drop': {
+        # Frame drop:
+        #   Invalid TCP Length (invalid-tcp-hdr-length)                    12
+        'section': re.compile(r'^(?P<section>\w[\w ]*):\s*$'),
+        'counter': re.compile(r'^\s+.+?\s+\((?P<key>[\w-]+)\)\s+(?P<value>\d+)\s*$'),
+    },
+    'show crypto accelerator statistics': {
+        # [Accelerator 0]
+        #    Input bytes processed: 23415
+        'section': re.compile(r'^\s*\[(?P<section>[^\]]+)\]\s*$'),
+        'counter': re.compile(r'^\s+(?P<key>[A-Za-z][\w ()/.-]*?):\s+(?P<value>\d+)\s*$'),
+    },
+}
+
+DEFAULT_COUNTER_PATTERN = {
+    'section': None,
+    'counter': re.compile(r'^\s*(?P<key>[A-Za-z][^:]*?)\s*:\s+(?P<value>\d+)\s*$'),
+}
+
+# (os, command) for which there is no Genie parser, not to try it again
+_no_genie_parser = set()
+
+
+def flatten_counters(parsed: Dict, prefix='') -> Dict:
+    """
+    Converts nested dictionary (e.g. output of Genie parser) to {'key1/key2/...': numeric value}.
+    """
+    counters = dict()
+
+    for key, value in parsed.items():
+        name = f'{prefix}/{key}' if prefix else str(key)
+
+        if isinstance(value, dict):
+            counters.update(flatten_counters(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            counters[name] = value
+
+    return counters
+
+
+def parse_with_genie(device, command: str, command_output: str) -> Dict:
+    """
+    :return: counters parsed by Genie parser or empty dict if there is no Genie parser for the command
+    """
+    if (device.os, command) in _no_genie_parser:
+        return dict()
+
+    try:
+        # output is passed to the parser, hence the command is not executed on the device once again
+        parsed = device.parse(command, output=command_output)
+    except Exception as e:
+        log.debug('%s: unable to parse "%s" with Genie parser. Using regular expressions instead. Error: %s',
+                  device.name, command, e)
+        _no_genie_parser.add((device.os, command))
+        return dict()
+
+    return flatten_counters(parsed)
+
+
+def parse_with_patterns(command: str, command_output: str) -> Dict:
+    patterns = COUNTER_PATTERNS.get(command, DEFAULT_COUNTER_PATTERN)
+    counters = dict()
+    section = ''
+
+    for line in command_output.splitlines():
+        match = patterns['counter'].match(line)
+        if match:
+            name = f'{section}/{match.group("key")}' if section else match.group('key')
+            counters[name] = counters.get(name, 0) + int(match.group('value'))
+            continue
+
+        if patterns['section']:
+            match = patterns['section'].match(line)
+            if match:
+                section = match.group('section').strip()
+
+    return counters
+
+
+def parse_counters(device, command: str, command_output: str, use_genie=False) -> Dict:
+    """
+    :return: {counter name: value} from the output of the command
+    """
+    counters = dict()
+
+    if use_genie:
+        counters = parse_with_genie(device, command, command_output)
+
+    if not counters:
+        counters = parse_with_patterns(command, command_output)
+
+    return counters
+
+
+def get_counter_ids(series_path: str, names) -> Dict:
+    """
+    Returns ids of counters from counters.json of the series. Ids for new counters are added to counters.json.
+    """
+    names_filename = join(series_path, COUNTER_NAMES_FILENAME)
+    counter_names = []
+
+    if exists(names_filename):
+        with open(names_filename, 'r') as fp:
+            counter_names = json.load(fp)
+
+    counter_ids = {name: counter_id for counter_id, name in enumerate(counter_names)}
+    new_names = [name for name in names if name not in counter_ids]
+
+    if new_names:
+        for name in new_names:
+            counter_ids[name] = len(counter_names)
+            counter_names.append(name)
+
+        tmp_filename = names_filename + '.tmp'
+        with open(tmp_filename, 'w') as fp:
+            json.dump(counter_names, fp)
+        os.replace(tmp_filename, names_filename)
+
+    return counter_ids
+
+
+def column_filename(series_path: str, column: str) -> str:
+    return join(series_path, f'{column}.{COLUMNS[column][1]}')
+
+
+def align_columns(series_path: str) -> None:
+    """
+    Cuts off rows which have not been written to all columns (e.g. process has been killed during write).
+    """
+    rows = []
+    for column, (typecode, dtype) in COLUMNS.items():
+        filename = column_filename(series_path, column)
+        size = getsize(filename) if exists(filename) else 0
+        rows.append(size // array(typecode).itemsize)
+
+    num_rows = min(rows)
+    if num_rows == max(rows):
+        return
+
+    log.warning('Columns of counter series: %s have different length. Cutting them to %s rows', series_path, num_rows)
+    for column, (typecode, dtype) in COLUMNS.items():
+        filename = column_filename(series_path, column)
+        if exists(filename):
+            os.truncate(filename, num_rows * array(typecode).itemsize)
+
+
+def append_counters(series_path: str, counters: Dict, timestamp: float, seconds_interval: float) -> None:
+    """
+    Appends counters of a snapshot (one row per counter) to columns of the series.
+
+    :param series_path: directory of the series (gathered_commands/<device_name>/counters/<command>)
+    :param counters: {counter name: value}
+    :param timestamp: time of the snapshot (seconds since epoch)
+    :param seconds_interval: interval the counters have been accumulated for. Used to calculate rate per second
+    """
+    if not counters:
+        return
+
+    os.makedirs(series_path, exist_ok=True)
+
+    counter_ids = get_counter_ids(series_path, counters)
+    align_columns(series_path)
+
+    names = sorted(counters)
+    values = {
+        'timestamp': [timestamp] * len(names),
+        'interval': [seconds_interval] * len(names),
+        'counter_id': [counter_ids[name] for name in names],
+        'value': [counters[name] for name in names],
+        'rate': [counters[name] / seconds_interval if seconds_interval > 0 else 0.0 for name in names],
+    }
+
+    for column, (typecode, dtype) in COLUMNS.items():
+        column_values = array(typecode, values[column])
+        if sys.byteorder == 'big':
+            column_values.byteswap()
+
+        with open(column_filename(series_path, column), 'ab') as fp:
+            column_values.tofile(fp)
+
+
+def store_counters(device, device_path: str, command: str, filename_command: str, command_output: str,
+                   timestamp: float, seconds_interval: float, use_genie=False) -> None:
+    """
+    Parses counters from the output of delta command and stores them with their rates per second
+    to gathered_commands/<device_name>/counters/<command>.
+    """
+    counters = parse_counters(device, command, command_output, use_genie)
+    log.debug('%s: got %d counters from "%s"', device.name, len(counters), command)
+
+    series_path = join(device_path, COUNTERS_DIR_NAME, filename_command)
+
+    try:
+        append_counters(series_path, counters, timestamp, seconds_interval)
+    except (OSError, ValueError) as e:
+        log.error('%s: unable to store counters of "%s" to: %s. Error: %s', device.name, command, series_path, e)
+
+
+def load_counters(series_path: str) -> Dict:
+    """
+    Loads counter series: {column: array of values} and list of counter names in 'names' key.
+    numpy arrays are returned if numpy is installed.
+    """
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    align_columns(series_path)
+    series = dict()
+
+    for column, (typecode, dtype) in COLUMNS.items():
+        filename = column_filename(series_path, column)
+
+        if numpy is not None:
+            series[column] = numpy.fromfile(filename, dtype=f'<{dtype}') if exists(filename) \
+                else numpy.array([], dtype=f'<{dtype}')
+        else:
+            series[column] = array(typecode)
+            if exists(filename):
+                with open(filename, 'rb') as fp:
+                    series[column].frombytes(fp.read())
+                if sys.byteorder == 'big':
+                    series[column].byteswap()
+
+    names_filename = join(series_path, COUNTER_NAMES_FILENAME)
+    series['names'] = []
+    if exists(names_filename):
+        with open(names_filename, 'r') as fp:
+            series['names'] = json.load(fp)
+
+    return series
+
+
+SNAPSHOTS_DIR_NAME = '.snapshots'
+
+# counters are considered wrapped if previous value has been close to the maximum value of the counter
+COUNTER_WIDTHS = (2 ** 32, 2 ** 64)
+WRAP_THRESHOLD = 0.9
+
+
+def snapshot_filename(device_path_delta: str, filename_command: str) -> str:
+    return join(device_path_delta, SNAPSHOTS_DIR_NAME, f'{filename_command}.json')
+
+
+def load_snapshot(filename: str) -> Dict:
+    """
+    :return: previous snapshot of counters: {'timestamp': ..., 'time': ..., 'counters': {...}}
+             or empty dict if there is no previous snapshot
+    """
+    if not exists(filename):
+        return dict()
+
+    try:
+        with open(filename, 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError) as e:
+        log.error('Unable to read snapshot of counters: %s. Error: %s', filename, e)
+        return dict()
+
+
+def save_snapshot(filename: str, counters: Dict, timestamp: float, time_readable: str) -> None:
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as fp:
+        json.dump({'timestamp': timestamp, 'time': time_readable, 'counters': counters}, fp)
+    os.replace(tmp_filename, filename)
+
+
+def counter_delta(previous_value, value):
+    """
+    :return: delta of the counter and whether the counter has been reset (e.g. device has been rebooted)
+    """
+    if value >= previous_value:
+        return value - previous_value, False
+
+    for width in COUNTER_WIDTHS:
+        if WRAP_THRESHOLD * width <= previous_value < width:
+            # counter has wrapped around its maximum value
+            return value + width - previous_value, False
+
+    # counter has been reset, hence it has been counting from zero since then
+    return value, True
+
+
+def compute_deltas(previous_counters: Dict, counters: Dict):
+    """
+    Computes deltas of counters between two snapshots.
+    Counters which have not existed in the previous snapshot are counted from zero.
+    Counters which have disappeared since the previous snapshot have been reset: output of some commands
+    (e.g. 'show asp drop') leaves out counters which are zero, e.g. after counters have been cleared.
+
+    :return: {counter name: delta} and whether counters have been reset since the previous snapshot
+    """
+    deltas = dict()
+    reset = any(previous_value and name not in counters for name, previous_value in previous_counters.items())
+
+    for name, value in counters.items():
+        deltas[name], counter_reset = counter_delta(previous_counters.get(name, 0), value)
+        reset = reset or counter_reset
+
+    return deltas, reset
+
+
+def format_counters(counters: Dict) -> str:
+    return ''.join(f'  {name:<70} {value}\n' for name, value in counters.items())
@@ -0,0 +1,228 @@
+import heapq
+import logging
+import signal
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from typing import Callable
+from typing import Dict
+from typing import List
+
+import pycrawler_lib.supplementary as sup
+
+log = logging.getLogger('main_logger')
+
+
+class SessionPool:
+    """
+    Keeps connected sessions to devices of the testbed between daemon iterations.
+
+    Only one job at a time is allowed to use a session of a device (unicon sessions are not thread safe).
+    If a session has dropped, it's re-established before the next job on this device.
+    """
+
+    def __init__(self, testbed, connect: Callable):
+        """
+        :param testbed: pyATS testbed object
+        :param connect: function connect(device_name, device) -> bool to establish connection to a device
+        """
+        self.testbed = testbed
+        self._connect = connect
+        self._locks = {device_name: threading.Lock() for device_name in testbed.devices}
+
+    def lock(self, device_name: str) -> threading.Lock:
+        return self._locks[device_name]
+
+    def session(self, device_name: str):
+        """
+        Returns connected device or None if it's not possible to connect to the device.
+        Must be called with the device's lock held.
+        """
+        device = self.testbed.devices[device_name]
+
+        if is_connected(device):
+            return device
+
+        log.info('%s: no active session to the device. Connecting', device_name)
+        if self._connect(device_name, device):
+            return device
+
+        return None
+
+    def invalidate(self, device_name: str) -> None:
+        """
+        Drops the session to the device, so it would be re-established before the next job.
+        Must be called with the device's lock held.
+        """
+        device = self.testbed.devices[device_name]
+        try:
+            device.disconnect()
+        except Exception as e:
+            log.debug('%s: error during disconnect: %s', device_name, e)
+
+    def close(self) -> None:
+        for device_name in self.testbed.devices:
+            with self.lock(device_name):
+                self.invalidate(device_name)
+
+
+def is_connected(device) -> bool:
+    try:
+        return bool(device.is_connected())
+    except Exception:
+        return False
+
+
+class Job:
+    def __init__(self, device_name: str, name: str, interval: int, func: Callable):
+        """
+        :param device_name: name of the device as specified in testbed.yaml
+        :param name: name of the job (e.g. 'commands' or 'deltas')
+        :param interval: how often to run the job (in seconds)
+        :param func: function func(device_name, device) to run against connected device
+        """
+        self.device_name = device_name
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.running = False
+
+    def __repr__(self):
+        return f'Job({self.device_name}, {self.name}, every {self.interval} sec)'
+
+
+def run_job(pool: SessionPool, job: Job) -> None:
+    with pool.lock(job.device_name), sup.log_context(device=job.device_name, phase=job.name):
+        try:
+            device = pool.session(job.device_name)
+            if device is None:
+                return
+
+            log.debug('%s: running job "%s"', job.device_name, job.name)
+            job.func(job.device_name, device)
+
+        except Exception as e:
+            log.exception('%s: job "%s" failed. Session will be re-established. Error: %s',
+                          job.device_name, job.name, e)
+            pool.invalidate(job.device_name)
+
+        finally:
+            job.running = False
+
+
+def run_daemon(pool: SessionPool, jobs: List[Job], max_workers: int, stop_event=None) -> None:
+    """
+    Runs jobs against devices of the pool according to their schedule until stopped by SIGINT/SIGTERM.
+
+    :param pool: pool of sessions to the devices
+    :param jobs: list of jobs, each one is scheduled independently with its own interval
+    :param max_workers: how many jobs to run at the same time
+    :param stop_event: threading.Event to stop the daemon (SIGINT/SIGTERM set it as well)
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+
+    def stop(signum, frame):
+        log.info('Got signal %s. Stopping pycrawler daemon', signum)
+        stop_event.set()
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+    # queue of jobs ordered by the time they are due
+    schedule = []
+    now = time.monotonic()
+    for seq, job in enumerate(jobs):
+        heapq.heappush(schedule, (now, seq, job))
+
+    log.info('pycrawler daemon started with %s jobs', len(jobs))
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='daemon') as executor:
+        while schedule and not stop_event.is_set():
+            due, seq, job = schedule[0]
+            now = time.monotonic()
+
+            if due > now:
+                stop_event.wait(due - now)
+                continue
+
+            heapq.heappop(schedule)
+
+            if job.running:
+                log.warning('%s: previous run of job "%s" is still in progress. Skipping this run',
+                            job.device_name, job.name)
+            else:
+                job.running = True
+                executor.submit(run_job, pool, job)
+
+            # don't try to catch up with runs missed while the device was busy
+            next_due = due + job.interval
+            if next_due <= now:
+                next_due = now + job.interval
+            heapq.heappush(schedule, (next_due, seq, job))
+
+    pool.close()
+    log.info('pycrawler daemon stopped')
+
+
+def get_device_interval(device, option: str, default: int) -> int:
+    """
+    Returns interval for the device: either from 'custom' section of the device in testbed.yaml or default one.
+
+    Example of testbed.yaml:
+        ftd-1:
+          os: fxos
+          custom:
+            commands_interval: 60
+            deltas_interval: 300
+    """
+    custom = getattr(device, 'custom', None) or {}
+
+    try:
+        interval = int(custom.get(option, default))
+    except (TypeError, ValueError):
+        log.error('%s: option "%s" in testbed.yaml must be a number. '
+                  'Using default value: %s', device.name, option, default)
+        return default
+
+    if interval <= 0:
+        log.error('%s: option "%s" in testbed.yaml must be greater than 0. '
+                  'Using default value: %s', device.name, option, default)
+        return default
+
+    return interval
+
+
+def build_jobs(testbed, get_plan: Callable, job_specs: Dict) -> List[Job]:
+    """
+    Creates jobs for all devices of the testbed which have commands defined for their operating system.
+    Plans of devices are built once here and reused by every iteration of their jobs.
+
+    :param testbed: pyATS testbed object
+    :param get_plan: function get_plan(device_name, device) to get plan of the device (None if it has no commands)
+    :param job_specs: name of the job -> (function has_commands(plan) to check the job has commands to run,
+                                          function func(device_name, device, plan) to run,
+                                          default interval in seconds)
+    :return: list of jobs
+    """
+    jobs = []
+
+    for device_name, device in testbed.devices.items():
+        plan = get_plan(device_name, device)
+        if plan is None:
+            continue
+
+        for job_name, (has_commands, func, default_interval) in job_specs.items():
+            if not has_commands(plan):
+                continue
+
+            interval = get_device_interval(device, f'{job_name}_interval', default_interval)
+            jobs.append(Job(device_name, job_name, interval, partial(func, device_plan=plan)))
+
+    log.debug('jobs: %s', jobs)
+
+    return jobs
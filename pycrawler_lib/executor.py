@@ -0,0 +1,229 @@
+import logging
+
+from typing import Callable
+from typing import Dict
+from typing import List
+
+import pycrawler_lib.metrics as metrics
+import pycrawler_lib.resilience as resilience
+import pycrawler_lib.supplementary as sup
+
+log = logging.getLogger('main_logger')
+
+# default timeout (in seconds) to wait for output of each command in a batch
+BATCH_COMMAND_TIMEOUT = 300
+
+# how long (in seconds) the device must stay silent after resync() before the next command is sent
+RESYNC_QUIET_TIMEOUT = 2
+
+# streamed output is read in chunks of all complete lines received so far (the prompt is matched first)
+STREAM_CHUNK_PATTERN = r'[\s\S]*\n'
+
+# devices for which batched execution has failed, commands are executed one by one for them
+_batch_unsupported = set()
+
+
+def get_timeout(timeout: float, deadline=None) -> float:
+    return deadline.timeout(timeout) if deadline is not None else timeout
+
+
+def execute_command(device, command: str, log_stdout=False, timeout=0, retries=0, backoff=0, deadline=None) -> str:
+    """
+    Executes a single command on the device and retries it if it fails (e.g. times out).
+
+    :param timeout: how long (in seconds) to wait for output of the command (0 - default timeout of unicon)
+    :param retries: how many times to retry the command
+    :param backoff: delay (in seconds) before the first retry, doubled for each next one
+    :param deadline: Deadline of the run. Timeout is cut down to it
+    """
+    def execute():
+        command_timeout = get_timeout(timeout, deadline)
+        if command_timeout:
+            return device.execute(command, log_stdout=log_stdout, timeout=command_timeout)
+        return device.execute(command, log_stdout=log_stdout)
+
+    # late output of the failed attempt would be read as output of the retry (or of the next command)
+    return resilience.retry(execute, retries, backoff, deadline, f'{device.name}: command "{command}"',
+                            before_retry=lambda: resync(device))
+
+
+def execute_commands(device, commands: List, log_stdout=False, batch=False, timeout=0, retries=0, backoff=0,
+                     deadline=None) -> Dict:
+    """
+    Executes commands on the device.
+
+    :param batch: send all commands to the device at once and split combined output by prompt
+                  instead of waiting for the prompt after each command
+    :param timeout: how long (in seconds) to wait for output of each command
+    :param retries: how many times to retry a command which has failed
+    :param backoff: delay (in seconds) before the first retry
+    :param deadline: Deadline of the run
+    :return: {command: output}
+    """
+    if batch and len(commands) > 1 and device.name not in _batch_unsupported:
+        try:
+            return execute_batch(device, commands, get_timeout(timeout or BATCH_COMMAND_TIMEOUT, deadline))
+        except resilience.DeadlineExceeded:
+            raise
+        except Exception as e:
+            log.warning('%s: batched execution of commands has failed. '
+                        'Commands will be executed one by one. Error: %s', device.name, e)
+            _batch_unsupported.add(device.name)
+            resync(device)
+
+    outputs = dict()
+    for command in commands:
+        with sup.log_context(command=command), metrics.timer('execute', device.name, command):
+            log.info('%s: run command: "%s"', device.name, command)
+            outputs[command] = execute_command(device, command, log_stdout, timeout, retries, backoff, deadline)
+
+    return outputs
+
+
+def get_prompt_pattern(device) -> str:
+    state_machine = device.state_machine
+    return state_machine.get_state(state_machine.current_state).pattern
+
+
+def execute_batch(device, commands: List, timeout=BATCH_COMMAND_TIMEOUT) -> Dict:
+    """
+    Sends all commands in a single write (device reads them as type-ahead) and reads outputs back
+    one prompt at a time. Hence there is only one round trip to the device for the whole list.
+
+    :return: {command: output}
+    """
+    prompt_pattern = get_prompt_pattern(device)
+    spawn = device.spawn
+
+    log.info('%s: run commands in batch: %s', device.name, commands)
+    spawn.sendline('\n'.join(commands))
+
+    outputs = dict()
+    for command in commands:
+        # time between outputs of consecutive commands
+        with metrics.timer('execute', device.name, command):
+            match = spawn.expect([prompt_pattern], timeout=timeout)
+        # echo of type-ahead might be interleaved with output of the previous command,
+        # then outputs can't be split by prompt reliably
+        first_line = match.match_output.lstrip('\r\n').split('\n', 1)[0]
+        if not is_echo(first_line, command):
+            raise ValueError(f'output of command "{command}" does not start with its echo: {first_line.strip()!r}')
+        outputs[command] = split_output(match.match_output, command)
+
+    return outputs
+
+
+def is_echo(line: str, command: str) -> bool:
+    """
+    :return: whether the line is echo of the command (prompt followed by the command)
+    """
+    return line.strip().endswith(command.strip())
+
+
+def split_output(raw_output: str, command: str) -> str:
+    """
+    Strips echo of the command and trailing prompt (the last line) from the raw output of the command.
+    """
+    lines = raw_output.replace('\r\n', '\n').replace('\r', '').split('\n')[:-1]
+
+    if lines and is_echo(lines[0], command):
+        lines = lines[1:]
+
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+class OutputSplitter:
+    """
+    Strips echo of the command and trailing prompt from raw output which arrives in chunks,
+    the same way split_output() does it for the whole output. Only the incomplete line is held back.
+    """
+
+    def __init__(self, command: str, write: Callable):
+        """
+        :param write: function write(data) to pass output without echo and prompt to
+        """
+        self.command = command
+        self._write = write
+        self._pending = ''
+        self._echo_checked = False
+
+    def feed(self, raw_output: str) -> None:
+        self._pending += raw_output.replace('\r\n', '\n').replace('\r', '')
+
+        position = self._pending.rfind('\n') + 1
+        if not position:
+            return
+
+        data = self._pending[:position]
+        self._pending = self._pending[position:]
+
+        if not self._echo_checked:
+            self._echo_checked = True
+            first_line_end = data.find('\n')
+            if is_echo(data[:first_line_end], self.command):
+                data = data[first_line_end + 1:]
+
+        if data:
+            self._write(data)
+
+    def close(self) -> None:
+        # the last line is the prompt
+        self._pending = ''
+
+
+def stream_command(device, command: str, write: Callable, timeout=BATCH_COMMAND_TIMEOUT, deadline=None) -> None:
+    """
+    Executes the command and passes its output to write() in chunks as they arrive from the device,
+    hence output of any size is never kept in memory as a whole. Echo of the command and the prompt are stripped.
+    Commands are not retried: a part of the output might have been written already.
+
+    :param timeout: how long (in seconds) to wait for each next chunk of output
+    :param deadline: Deadline of the run. Timeout is cut down to it
+    """
+    prompt_pattern = get_prompt_pattern(device)
+    spawn = device.spawn
+    splitter = OutputSplitter(command, write)
+
+    log.info('%s: run command with streamed output: "%s"', device.name, command)
+    spawn.sendline(command)
+
+    while True:
+        if deadline is not None:
+            deadline.check(f' during command "{command}"')
+
+        match = spawn.expect([prompt_pattern, STREAM_CHUNK_PATTERN], timeout=get_timeout(timeout, deadline))
+        splitter.feed(match.match_output)
+
+        if match.last_match_index == 0:
+            break
+
+    splitter.close()
+
+
+def resync(device) -> None:
+    """
+    Reads whatever is left from the failed batch or command, so the next command gets its own output.
+    Each command which is still running (e.g. the rest of the batch) ends with a prompt of its own,
+    hence prompts are read until the device stays silent for RESYNC_QUIET_TIMEOUT seconds.
+    If there is no prompt at all, the device is reconnected.
+    """
+    try:
+        prompt_pattern = get_prompt_pattern(device)
+        device.spawn.sendline()
+        device.spawn.expect([prompt_pattern], timeout=BATCH_COMMAND_TIMEOUT)
+    except Exception as e:
+        log.error('%s: unable to get prompt from the device after failed execution. '
+                  'Reconnecting. Error: %s', device.name, e)
+        try:
+            device.disconnect()
+            device.connect()
+        except Exception as e:
+            log.error('%s: unable to reconnect. Error: %s', device.name, e)
+        return
+
+    while True:
+        try:
+            device.spawn.expect([prompt_pattern], timeout=RESYNC_QUIET_TIMEOUT)
+        except Exception:
+            # no more prompts: nothing is left to read
+            break
@@ -0,0 +1,338 @@
+import bisect
+import datetime
+import logging
+import os
+import re
+import zlib
+
+from os.path import exists, getmtime, getsize, isdir, join
+
+from typing import Dict
+from typing import Iterator
+from typing import List
+
+import pycrawler_lib.archive_index as archive_index
+import pycrawler_lib.compression as compression
+import pycrawler_lib.records as records
+import pycrawler_lib.timestamps as timestamps
+
+log = logging.getLogger('main_logger')
+
+# banner before each snapshot in plain text files: '\n*****DT: 30.11 18:44:43. Unit failover status: ...*****\n'
+BANNER_RE = re.compile(rb'\n\*{5}(?P<banner>[^\n]*?)\*{5}\n')
+BANNER_TIME_RE = re.compile(r'[SD]T: (?P<day>\d{2})\.(?P<month>\d{2}) '
+                            r'(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})')
+
+# archive timestamp is time of rotation by the server while snapshots have time of the device,
+# hence archives are selected with this margin (in seconds) to tolerate clock skew
+ARCHIVE_TIME_MARGIN = 3600
+
+# decompressed blocks of an archive to keep in memory
+MAX_CACHED_BLOCKS = 4
+
+EXTENSION_CODECS = {extension: codec for codec, extension in compression.CODEC_EXTENSIONS.items()}
+
+
+class BlockReader:
+    """
+    Random access to uncompressed content of an archive: seek() and read() decompress only the blocks
+    which contain requested bytes (see compression.BLOCK_SIZE). Archives without map of blocks
+    (written before archives were split into blocks) are decompressed as a whole.
+    """
+
+    def __init__(self, archive_name: str, codec: str):
+        self.archive_name = archive_name
+        self.codec = codec
+        self.position = 0
+
+        self._fp = open(archive_name, 'rb')
+        self._compressed_size = getsize(archive_name)
+        self._cache = dict()
+
+        blocks_name = compression.sidecar_filename(archive_name, compression.BLOCKS_SUFFIX)
+        blocks = []
+        if exists(blocks_name):
+            with open(blocks_name, 'rb') as fp:
+                blocks = list(compression.BLOCK_ENTRY.iter_unpack(fp.read()))
+
+        if blocks:
+            self._offsets = [uncompressed_offset for uncompressed_offset, compressed_offset in blocks]
+            self._compressed_offsets = [compressed_offset for uncompressed_offset, compressed_offset in blocks]
+            self.size = self._offsets[-1] + len(self._block(len(blocks) - 1))
+        else:
+            log.debug('There is no map of blocks for archive: %s. Decompressing it as a whole', archive_name)
+            self._offsets = [0]
+            self._compressed_offsets = [0]
+            self._cache[0] = compression.decompress_file(archive_name, codec)
+            self.size = len(self._cache[0])
+
+    def _block(self, position: int) -> bytes:
+        data = self._cache.get(position)
+        if data is not None:
+            return data
+
+        start = self._compressed_offsets[position]
+        end = self._compressed_offsets[position + 1] if position + 1 < len(self._compressed_offsets) \
+            else self._compressed_size
+        self._fp.seek(start)
+        data = compression.decompress_block(self._fp.read(end - start), self.codec)
+
+        if len(self._cache) >= MAX_CACHED_BLOCKS:
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[position] = data
+
+        return data
+
+    def seek(self, offset: int, whence=os.SEEK_SET) -> int:
+        self.position = offset if whence == os.SEEK_SET else self.position + offset
+        return self.position
+
+    def read(self, length: int) -> bytes:
+        chunks = []
+        end = min(self.position + length, self.size)
+        position = bisect.bisect_right(self._offsets, self.position) - 1
+
+        while self.position < end and 0 <= position < len(self._offsets):
+            data = self._block(position)
+            start = self.position - self._offsets[position]
+            chunk = data[start:start + end - self.position]
+            if not chunk:
+                break
+            chunks.append(chunk)
+            self.position += len(chunk)
+            position += 1
+
+        return b''.join(chunks)
+
+    def close(self) -> None:
+        self._fp.close()
+
+
+class Source:
+    """
+    Plain file or archive with snapshots of a command.
+    """
+
+    def __init__(self, filename: str, index_name: str, is_records: bool, codec=None, reference_time=None):
+        """
+        :param index_name: offset index of the file
+        :param codec: codec of the archive (None for plain files)
+        :param reference_time: time when the last snapshot of the file has been taken at the latest.
+                               Used to get year of snapshots from banners which have no index entries
+        """
+        self.filename = filename
+        self.index_name = index_name
+        self.is_records = is_records
+        self.codec = codec
+        self.reference_time = reference_time
+
+    def open(self):
+        """
+        :return: file object and size of uncompressed content
+        """
+        if self.codec is None:
+            fp = open(self.filename, 'rb')
+            return fp, os.fstat(fp.fileno()).st_size
+
+        fp = BlockReader(self.filename, self.codec)
+        return fp, fp.size
+
+
+def banner_timestamp(banner: str, reference_time: float) -> float:
+    """
+    :param banner: banner of a snapshot (time in it has no year, e.g. 'DT: 30.11 18:44:43')
+    :param reference_time: time (seconds since epoch) when the snapshot has been taken at the latest
+    :return: time of the snapshot (seconds since epoch) or None if there is no time in the banner
+    """
+    matches = BANNER_TIME_RE.findall(banner)
+    if not matches:
+        return None
+
+    # delta banners have the start and the end of the interval, time of the snapshot is the end
+    day, month, hour, minute, second = (int(value) for value in matches[-1])
+    year = datetime.datetime.fromtimestamp(reference_time, datetime.timezone.utc).year
+
+    for year in (year, year - 1):
+        try:
+            timestamp = datetime.datetime(year, month, day, hour, minute, second,
+                                          tzinfo=datetime.timezone.utc).timestamp()
+        except ValueError:
+            continue
+        if timestamp <= reference_time + 86400:
+            return timestamp
+
+    return None
+
+
+def scan_text(fp, start: int, end: int, reference_time: float) -> List:
+    """
+    Finds snapshots in the part of a plain text file by their banners.
+
+    :return: index entries (timestamp, offset, length)
+    """
+    fp.seek(start)
+    data = fp.read(end - start)
+    entries = []
+
+    matches = list(BANNER_RE.finditer(data))
+    for position, match in enumerate(matches):
+        offset = match.start()
+        length = (matches[position + 1].start() if position + 1 < len(matches) else len(data)) - offset
+        timestamp = banner_timestamp(match.group('banner').decode('utf-8', 'replace'), reference_time)
+        if timestamp is not None:
+            entries.append((timestamp, start + offset, length))
+
+    return entries
+
+
+def load_entries(source: Source, fp, size: int) -> List:
+    """
+    :return: index entries of the source. Parts of the file which are not covered by the offset index
+             (e.g. written before the index has been introduced) are scanned
+    """
+    entries = records.load_index(source.index_name) if exists(source.index_name) else []
+    entries = [entry for entry in entries if entry[1] + entry[2] <= size]
+
+    def scan(start, end):
+        if start >= end:
+            return []
+        log.debug('Scanning %s from %s to %s: not covered by offset index', source.filename, start, end)
+        if source.is_records:
+            return records.scan_entries(fp, end, start)
+        return scan_text(fp, start, end, source.reference_time)
+
+    if not entries:
+        return scan(0, size)
+
+    return scan(0, entries[0][1]) + entries + scan(entries[-1][1] + entries[-1][2], size)
+
+
+def format_record(record: Dict) -> str:
+    banner = timestamps.time_trunc(record['time'])
+    if record.get('interval') is not None:
+        banner += f'. Interval: {record["interval"]} sec'
+    if record.get('failover'):
+        banner += f'. Unit failover status: {record["failover"]}'
+
+    return f'\n*****{banner}*****\n{record["output"]}'
+
+
+def read_source(source: Source, time_from=None, time_to=None) -> Iterator:
+    """
+    Yields (timestamp, text of the snapshot) for snapshots of the source taken between time_from and time_to.
+    """
+    fp, size = source.open()
+    try:
+        entries = load_entries(source, fp, size)
+
+        if source.is_records:
+            for record in records.iter_entries(fp, entries, time_from, time_to):
+                yield record['timestamp'], format_record(record)
+            return
+
+        for timestamp, offset, length in entries:
+            if (time_from is None or timestamp >= time_from) and (time_to is None or timestamp <= time_to):
+                fp.seek(offset)
+                yield timestamp, fp.read(length).decode('utf-8', 'replace')
+    finally:
+        fp.close()
+
+
+def command_sources(dir_path: str, filename: str, time_from=None, time_to=None) -> List:
+    """
+    :param dir_path: gathered_commands/<device>/<commands|deltas>
+    :param filename: file name of the command, e.g. ftd-1_show_blocks
+    :return: sources which might have snapshots between time_from and time_to, oldest first.
+             Archives are selected by their timestamps without opening them
+    """
+    sources = []
+    archive_path = join(dir_path, archive_index.ARCHIVE_DIR_NAME)
+
+    for name in (filename, records.records_filename(filename)):
+        is_records = name.endswith(records.RECORDS_SUFFIX)
+        archives = []
+        for archive_name in os.listdir(archive_path) if isdir(archive_path) else []:
+            match = archive_index.ARCHIVE_NAME_RE.match(archive_name)
+            if match and match.group('filename') == name:
+                archives.append((int(match.group('timestamp')), archive_name))
+        archives.sort()
+
+        # archive covers snapshots taken after the previous archive and before its own timestamp
+        previous_timestamp = None
+        for timestamp, archive_name in archives:
+            if (time_from is None or timestamp + ARCHIVE_TIME_MARGIN >= time_from) and \
+                    (time_to is None or previous_timestamp is None
+                     or previous_timestamp - ARCHIVE_TIME_MARGIN <= time_to):
+                archive_name = join(archive_path, archive_name)
+                sources.append(Source(archive_name,
+                                      compression.sidecar_filename(archive_name, compression.INDEX_SUFFIX),
+                                      is_records, EXTENSION_CODECS[archive_name.rsplit('.', 1)[1]], timestamp))
+            previous_timestamp = timestamp
+
+        plain_name = join(dir_path, name)
+        if exists(plain_name) and (time_to is None or previous_timestamp is None
+                                   or previous_timestamp - ARCHIVE_TIME_MARGIN <= time_to):
+            sources.append(Source(plain_name, records.index_filename(plain_name), is_records,
+                                  reference_time=getmtime(plain_name)))
+
+    return sources
+
+
+def device_paths(gathered_commands_path: str, device_name: str) -> List:
+    """
+    :return: directories with output of the device: gathered_commands/<device>
+             and gathered_commands/nodes/<node>/<device> (sharding mode)
+    """
+    paths = [join(gathered_commands_path, device_name)]
+
+    nodes_path = join(gathered_commands_path, 'nodes')
+    if isdir(nodes_path):
+        paths += [join(nodes_path, node_name, device_name) for node_name in sorted(os.listdir(nodes_path))]
+
+    return [path for path in paths if isdir(path)]
+
+
+def query(gathered_commands_path: str, device_name: str, command_filename: str, time_from=None, time_to=None,
+          last=0) -> List:
+    """
+    Finds snapshots of the command (both regular and delta) taken between time_from and time_to.
+
+    :param command_filename: part of the file name for output of the command, e.g. 'show_blocks'
+    :param last: return only the last snapshots (0 - all snapshots in the range)
+    :return: list of (timestamp, text of the snapshot) sorted by time
+    """
+    snapshots = []
+    for device_path in device_paths(gathered_commands_path, device_name):
+        for dir_name in ('commands', 'deltas'):
+            for source in command_sources(join(device_path, dir_name), f'{device_name}_{command_filename}',
+                                          time_from, time_to):
+                try:
+                    snapshots.extend(read_source(source, time_from, time_to))
+                except (OSError, ValueError, EOFError, zlib.error) as e:
+                    log.error('Unable to read file: %s. Error: %s', source.filename, e)
+
+    snapshots.sort(key=lambda snapshot: snapshot[0])
+
+    return snapshots[-last:] if last else snapshots
+
+
+def parse_time(value: str) -> float:
+    """
+    :param value: seconds since epoch or UTC time: '2020-11-30', '2020-11-30 18:44' or '2020-11-30 18:44:43'
+    :return: seconds since epoch
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    if re.match(r'^\d{4}-\d{2}-\d{2}$', value.strip()):
+        value = value.strip() + ' 00:00:00'
+    elif re.match(r'^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}$', value.strip()):
+        value = value.strip() + ':00'
+
+    timestamp = timestamps.to_timestamp(value)
+    if timestamp is None:
+        raise ValueError(f"Unable to parse time: '{value}'. Use format 'YYYY-MM-DD HH:MM:SS' (UTC)")
+
+    return timestamp
@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+
+from os.path import basename, dirname, exists, join
+
+from typing import Dict
+from typing import List
+
+log = logging.getLogger('main_logger')
+
+# fields of a device which are kept in the inventory. Credentials and connection details are never cached
+DEVICE_FIELDS = ('os', 'type', 'platform')
+
+
+def inventory_filename(testbed_filename: str) -> str:
+    return join(dirname(testbed_filename), f'.{basename(testbed_filename)}.inventory.json')
+
+
+def testbed_key(testbed_filename: str) -> Dict:
+    stat = os.stat(testbed_filename)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def parse_inventory(testbed_filename: str) -> Dict:
+    """
+    Reads names and operating systems of devices from testbed.yaml with plain YAML parser (without loading pyATS).
+
+    :return: {device name: {'os': ..., 'type': ..., 'platform': ...}} or None if testbed couldn't be read this way
+             (e.g. it extends another testbed file)
+    """
+    import yaml
+
+    with open(testbed_filename, 'r') as fp:
+        data = yaml.safe_load(fp)
+
+    if not isinstance(data, dict) or 'extends' in data or not isinstance(data.get('devices'), dict):
+        return None
+
+    devices = dict()
+    for device_name, device in data['devices'].items():
+        device = device if isinstance(device, dict) else dict()
+        devices[str(device_name)] = {field: device.get(field) for field in DEVICE_FIELDS}
+
+    return devices
+
+
+def load_inventory(testbed_filename: str) -> Dict:
+    """
+    Returns inventory of the testbed: device names and their operating systems.
+
+    Inventory is cached next to testbed.yaml and re-read only when testbed.yaml has been changed,
+    hence short runs don't have to parse testbed.yaml (or load pyATS) just to find out there is nothing to do.
+
+    :return: {device name: {'os': ..., 'type': ..., 'platform': ...}} or None if inventory couldn't be built
+    """
+    cache_filename = inventory_filename(testbed_filename)
+    key = testbed_key(testbed_filename)
+
+    if exists(cache_filename):
+        try:
+            with open(cache_filename, 'r') as fp:
+                cache = json.load(fp)
+            if cache.get('key') == key:
+                return cache['devices']
+        except (OSError, ValueError, KeyError) as e:
+            log.debug('Unable to read inventory cache: %s. It will be rebuilt. Error: %s', cache_filename, e)
+
+    try:
+        devices = parse_inventory(testbed_filename)
+    except Exception as e:
+        log.debug('Unable to build inventory from testbed file: %s. Error: %s', testbed_filename, e)
+        return None
+
+    if devices is None:
+        return None
+
+    tmp_filename = cache_filename + '.tmp'
+    try:
+        with open(tmp_filename, 'w') as fp:
+            json.dump({'key': key, 'devices': devices}, fp)
+        os.replace(tmp_filename, cache_filename)
+    except OSError as e:
+        log.debug('Unable to write inventory cache: %s. Error: %s', cache_filename, e)
+
+    return devices
+
+
+def devices_with_commands(devices: Dict, operating_systems: set) -> List:
+    """
+    :param operating_systems: operating systems which have commands defined
+    :return: names of devices which have commands defined for their operating system
+    """
+    return [device_name for device_name, device in devices.items() if device['os'] in operating_systems]
@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from os.path import exists, join
+
+from typing import Dict
+
+import pycrawler_lib.timestamps as timestamps
+
+log = logging.getLogger('main_logger')
+
+# journal of the current run, kept in gathered_commands/ (gathered_commands/nodes/<node name>/ in sharding mode)
+RUN_JOURNAL_FILENAME = '.run_journal.json'
+
+# journal of each device, kept in gathered_commands/<device_name>/
+DEVICE_JOURNAL_FILENAME = '.journal.json'
+
+# phases of collection from a device, in the order they are finished. Phases which produce output (commands,
+# delta shows, archive) are committed once it has been written, hence they might be committed after the next phase
+CONNECT = 'connect'
+COMMANDS = 'commands'
+DELTA_SHOWS = 'delta_shows'
+# clear commands are about to be sent: time of the clear is recorded before counters are touched on the device
+DELTA_CLEARS_STARTED = 'delta_clears_started'
+DELTA_CLEARS = 'delta_clears'
+CLEAR_FLAG = 'clear_flag'
+# the last phase: device is finished
+ARCHIVE = 'archive'
+
+
+def write_json(filename: str, data: Dict, fsync=True) -> None:
+    """
+    Writes data atomically: readers (and the next run after a crash) see either the old or the new content.
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as fp:
+        json.dump(data, fp)
+        if fsync:
+            fp.flush()
+            os.fsync(fp.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def read_json(filename: str) -> Dict:
+    if not exists(filename):
+        return dict()
+
+    try:
+        with open(filename, 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError) as e:
+        log.error('Unable to read journal: %s. It will be reset. Error: %s', filename, e)
+        return dict()
+
+
+class DeviceJournal:
+    """
+    Phases of collection from a single device committed during the run.
+
+    Each commit rewrites the journal atomically, hence after a crash the journal has exactly the phases which
+    have been finished. Phases of a previous run are overwritten by the first commit of the current one,
+    hence half-done delta show/clear pair of the previous run has to be repaired before it
+    (see repair_clear_flag()).
+    """
+
+    def __init__(self, device_path: str, run_id: str, fsync=True):
+        self.filename = join(device_path, DEVICE_JOURNAL_FILENAME)
+        self.run_id = run_id
+        self.fsync = fsync
+
+        self.previous = read_json(self.filename)
+        # run is resumed: phases committed before the crash are kept
+        self.state = self.previous if self.previous.get('run_id') == run_id else {'run_id': run_id, 'phases': []}
+        # phases are committed both by the collector and by the writer thread (once their output is written)
+        self._lock = threading.Lock()
+
+    def done(self, phase: str) -> bool:
+        return phase in self.state['phases']
+
+    def finished(self) -> bool:
+        return self.done(ARCHIVE)
+
+    def commit(self, phase: str, **fields) -> None:
+        """
+        Records that the phase has been finished.
+
+        :param fields: state to keep with the phase (e.g. time of the clear for DELTA_CLEARS_STARTED)
+        """
+        with self._lock:
+            if not self.done(phase):
+                self.state['phases'].append(phase)
+            self.state.update(fields)
+            self.state['updated'] = time.time()
+            self._save()
+
+    def _save(self) -> None:
+        try:
+            write_json(self.filename, self.state, self.fsync)
+        except OSError as e:
+            log.error('Unable to write journal: %s. Error: %s', self.filename, e)
+
+    def repair_clear_flag(self, flag_filename: str) -> None:
+        """
+        Repairs delta show/clear pair which has been interrupted between clear commands and write of .clear_flag:
+
+        - clear commands have been finished: .clear_flag is written with the time of the clear from the journal;
+        - clear commands might have been sent partially: state of counters is unknown, hence .clear_flag is removed.
+          The next run clears counters and starts a new pair instead of writing a delta for a wrong interval.
+        """
+        phases = self.previous.get('phases', [])
+        if DELTA_CLEARS_STARTED not in phases or CLEAR_FLAG in phases:
+            return
+
+        clear = self.previous['clear']
+        if DELTA_CLEARS in phases:
+            log.warning('Run has been interrupted after counters have been cleared. '
+                        'Repairing %s with time of the clear: %s', flag_filename, clear['time'])
+            timestamps.write_clear_flag(flag_filename, clear['timestamp'], clear['time'])
+            if self.previous is self.state:
+                self.commit(CLEAR_FLAG)
+        else:
+            log.warning('Run has been interrupted while counters have been cleared. Counters of delta commands '
+                        'will be cleared again before the next delta. Removing %s', flag_filename)
+            if exists(flag_filename):
+                os.remove(flag_filename)
+            if self.previous is self.state:
+                # the resumed run clears counters again
+                self.state['phases'].remove(DELTA_CLEARS_STARTED)
+                self._save()
+
+        self.previous = self.state
+
+
+class RunJournal:
+    """
+    Journal of a run of collectors (cron mode).
+
+    A run which has been interrupted (process has been killed, host has been rebooted) is resumed by the next run
+    if it has started within resume_window seconds: devices which have been finished are skipped and the rest
+    continue from their last committed phase (see DeviceJournal).
+    """
+
+    def __init__(self, dir_path: str, mode: str, resume_window: int, fsync=True):
+        """
+        :param mode: which commands are collected by the run ('all', 'commands' or 'deltas').
+                     Only a run of the same mode is resumed
+        :param resume_window: how old (in seconds) an interrupted run may be to resume it (0 - never resume)
+        """
+        self.filename = join(dir_path, RUN_JOURNAL_FILENAME)
+        self.mode = mode
+        self.resume_window = resume_window
+        self.fsync = fsync
+        self.run_id = None
+        self.resumed = False
+
+    def start(self) -> None:
+        now = time.time()
+        previous = read_json(self.filename)
+
+        if previous and not previous.get('finished') and previous.get('mode') == self.mode \
+                and now - previous.get('started', 0) <= self.resume_window:
+            self.run_id = previous['run_id']
+            self.resumed = True
+            log.warning('Previous run %s has been interrupted. Resuming it: '
+                        'devices which have been finished are skipped', self.run_id)
+            return
+
+        if previous and not previous.get('finished'):
+            log.warning('Previous run %s has been interrupted. Starting a new run', previous.get('run_id'))
+
+        self.run_id = f'{now:.6f}'
+        self._write({'run_id': self.run_id, 'mode': self.mode, 'started': now, 'finished': None})
+
+    def finish(self) -> None:
+        """
+        Marks the run as finished (even if some devices have failed), hence it's never resumed.
+        """
+        self._write({'run_id': self.run_id, 'mode': self.mode, 'started': float(self.run_id),
+                     'finished': time.time()})
+
+    def device(self, device_path: str) -> DeviceJournal:
+        return DeviceJournal(device_path, self.run_id, self.fsync)
+
+    def _write(self, data: Dict) -> None:
+        try:
+            write_json(self.filename, data, self.fsync)
+        except OSError as e:
+            log.error('Unable to write journal of the run: %s. Error: %s', self.filename, e)
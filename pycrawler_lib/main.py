@@ -1,395 +1,1046 @@
 #!/usr/bin/env python3
-import dateparser
-import datetime
-import gzip
+import argparse
+import hashlib
 import logging
 import logging.handlers
-import pathlib
-import pytz
 import re
-import shutil
+import socket
+import sys
 import time
 
-from genie.conf import Genie
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from contextlib import contextmanager
+from functools import partial
+
 
 from pathlib import Path
 
-from os import listdir
 from os import remove
-from os.path import basename, dirname, exists, getsize, isfile, join
+from os.path import basename, dirname, exists, join
 
 from typing import List
 from typing import Dict
 
 # To handle errors with connections to devices
-from unicon.core import errors
 
+import pycrawler_lib.archive_index as archive_index
+import pycrawler_lib.benchmark as benchmark
+import pycrawler_lib.compression as compression
+import pycrawler_lib.counters as counters
+import pycrawler_lib.daemon as daemon
+import pycrawler_lib.executor as executor
+import pycrawler_lib.history as history
+import pycrawler_lib.inventory as inventory
+import pycrawler_lib.journal as journal
+import pycrawler_lib.metrics as metrics
+import pycrawler_lib.plans as plans
+import pycrawler_lib.profiling as profiling
+import pycrawler_lib.records as records
+import pycrawler_lib.resilience as resilience
+import pycrawler_lib.scheduler as scheduler
 import pycrawler_lib.settings as settings
+import pycrawler_lib.sharding as sharding
 import pycrawler_lib.supplementary as sup
+import pycrawler_lib.timestamps as timestamps
+import pycrawler_lib.writer as writer
 
 
-def get_gzip_files(current_filename: str, filename_to_compare: str) -> str:
-    filename = basename(current_filename)
-    log.debug(f'filename: {filename}')
+# state of the circuit breaker (failures of devices in the previous runs)
+BREAKER_FILENAME = '.circuit_breaker.json'
 
-    str_to_match = rf'.*({filename}_\d{{10}}.gz)$'
-    log.debug(f'str_to_match: {str_to_match}')
+# time of the last clear of counters of delta commands, kept in gathered_commands/<device_name>/deltas/
+CLEAR_FLAG_FILENAME = '.clear_flag'
+
+# how long (in seconds) to wait for devices which are still in progress when the run deadline has been exceeded.
+# Their timeouts are cut to the deadline, hence they stop before their next command
+DEADLINE_GRACE_PERIOD = 30
 
-    r = re.compile(str_to_match)
-    filepath = rf'{filename_to_compare}'
-    if r.search(filepath):
-        return (filepath)
-    else:
-        return ''
+
+class ConnectionErrorStub(Exception):
+    """
+    Stands in for unicon's ConnectionError if unicon isn't installed (e.g. benchmark against simulated devices).
+    """
 
 
 def remove_file(filename) -> None:
     try:
         remove(filename)
-        log.info(f'File has been removed successfully: {filename}')
+        log.info('File has been removed successfully: %s', filename)
     except PermissionError as e:
-        log.error(f'Unable to delete file: {filename}.'
-                  f'Insufficient privileges. Error: {e}')
+        log.error('Unable to delete file: %s.'
+                  'Insufficient privileges. Error: %s', filename, e)
+    except FileNotFoundError:
+        log.warning('Unable to delete file: %s. File does not exist', filename)
 
 
 def get_files_to_gz(dir_path: str, file_size_to_gzip: int) -> List:
-    onlyfiles = [join(dir_path, f) for f in listdir(dir_path) if isfile(join(dir_path, f))]
-    log.debug(f'onlyfiles: {onlyfiles}')
+    file_size_to_gzip = file_size_to_gzip * 10 ** 6  # converting to Mbytes
 
-    only_non_gzip_files = [filepath for filepath in onlyfiles if '.gz' not in pathlib.Path(filepath).suffixes]
+    # sizes of command files are tracked by the archive index, no need to list and stat the directory
+    only_big_files = archive_index.get_index(dir_path).big_files(file_size_to_gzip)
 
-    log.debug(f'only_non_gzip_files: {only_non_gzip_files}')
+    log.debug('big_files: %s', only_big_files)
 
-    file_size_to_gzip = file_size_to_gzip * 10 ** 6  # converting to Mbytes
+    return only_big_files
 
-    only_big_files = [filepath for filepath in only_non_gzip_files if getsize(filepath) > file_size_to_gzip]
 
-    log.debug(f'big_files: {only_big_files}')
+def gz_files(only_big_files: List, abs_archive_path: str, num_to_store: int) -> None:
+    index = archive_index.get_index(dirname(abs_archive_path))
 
-    return only_big_files
+    # hand over all big plain text files to the background compression stage.
+    # Plain text files are moved to the archive directory right away and removed when they are compressed
+    for big_file in only_big_files:
+        log.debug('big_file to archive: %s', big_file)
 
+        # everything queued for the file has to be written before it's moved. Writes update size of the file
+        # in the index, hence the file is removed from the index only after them
+        output_writer.close_file(big_file)
+        index.remove_file(basename(big_file))
+        # remove the oldest archive files for this command when the new archive is written.
+        # Offset index of the file is moved with it, hence query could find snapshots in the archive by time
+        archiver.archive(big_file, abs_archive_path, partial(remove_old_gz_files, index, num_to_store),
+                         records.index_filename(big_file))
 
-def gzip_file(f_in_name: str, f_out_name: str) -> None:
-    with open(f_in_name, 'rb') as f_in:
-        with gzip.open(f_out_name, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
+    index.save()
 
 
-def gz_files(only_big_files: List, abs_archive_path: str) -> None:
-    timestamp = int(time.time())
+def remove_old_gz_files(index, num_to_store: int, archive_name: str) -> None:
+    # register new archive in the index and remove all archives of this command beyond num_to_store
+    index.add_archive(archive_name)
 
-    # gz all plain text files and remove plain these plain text afterwards
-    for big_file in only_big_files:
-        log.debug(f'big_file to gz: {big_file}')
+    for oldest_file in index.trim_archives(archive_index.command_filename(archive_name), num_to_store):
+        remove_file(oldest_file)
+        compression.remove_sidecars(oldest_file)
 
-        big_filename = basename(big_file)
-        gz_filename = f'{big_filename}_{timestamp}.gz'
-        big_file_archived = join(abs_archive_path, gz_filename)
+    index.save()
 
-        gzip_file(big_file, big_file_archived)
-        remove_file(big_file)
 
+def archive_big_files(dir_path: str, file_size_to_gzip: int, num_to_store: int) -> None:
+    # sizes of files in the index are updated by writes, hence big files are looked for by the writer thread
+    # once output queued so far has been written. The collector doesn't wait for it
+    output_writer.call_when_written(partial(timed_rotate_big_files, dir_path, file_size_to_gzip, num_to_store))
 
-def remove_old_gz_files(only_big_files: List, dir_path: str, num_to_store) -> None:
-    onlyfiles = [join(dir_path, f) for f in listdir(dir_path) if isfile(join(dir_path, f))]
-    only_gzip_files = [filepath for filepath in onlyfiles if '.gz' in pathlib.Path(filepath).suffixes]
 
-    for big_file in only_big_files:
-        # get list of all .gz files for this big file with commands:
-        gz_files_for_big_file = list(filter(lambda filepath: get_gzip_files(big_file, filepath), only_gzip_files))
+def timed_rotate_big_files(dir_path: str, file_size_to_gzip: int, num_to_store: int) -> None:
+    # dir_path is gathered_commands/<device_name>/<commands|deltas>
+    with metrics.timer('rotation', basename(dirname(dir_path)), basename(dir_path)):
+        rotate_big_files(dir_path, file_size_to_gzip, num_to_store)
+
+    # sizes of files updated during the run are kept for the next one
+    archive_index.get_index(dir_path).save_changes()
+
+
+def rotate_big_files(dir_path: str, file_size_to_gzip: int, num_to_store: int) -> None:
+    # get all big non-gz files (in plain text) for this device
+    only_big_files = get_files_to_gz(dir_path, file_size_to_gzip)
+
+    if len(only_big_files) > 0:
+        archive_dir_name = 'archive'
+        abs_archive_path = join(dir_path, archive_dir_name)
+        sup.create_non_existing_dir(abs_archive_path)
 
-        log.debug(f'only .gz files for this command output {big_file}: {gz_files_for_big_file}')
+        # archive all big plain text files for this device
+        gz_files(only_big_files, abs_archive_path, num_to_store)
 
-        if len(gz_files_for_big_file) > num_to_store:
-            oldest_file = min(gz_files_for_big_file)
-            remove_file(oldest_file)
 
+def update_file_size(abs_filename: str, file_size: int) -> None:
+    # keep size of the file in the archive index to decide when to archive it
+    archive_index.get_index(dirname(abs_filename)).update_size(basename(abs_filename), file_size)
 
-def get_time_trunc(time_readable: str) -> str:
-    match_time = re.match(r'(\w+:\s+)\d+-(\d+)-(\d+)(\s+\d+:\d+\d+:\d+).*', time_readable)
-    if match_time:
-        time_readable = f'{match_time.group(1)}{match_time.group(3)}.{match_time.group(2)}{match_time.group(4)}'
 
-    return time_readable
+def write_commands_to_file(abs_filename: str, command_output: str, time_now_readable: str, additional_info='',
+                           timestamp: float = None) -> None:
+    """
+    :param timestamp: time of the snapshot (seconds since epoch) to put to the offset index of the file
+    """
+    # output is written by the writer thread, failure to write it affects only this file
+    log.debug('writing command output to file: %s', abs_filename)
+    output_writer.append(abs_filename, format_banner(time_now_readable, additional_info) + command_output,
+                         partial(update_file_size, abs_filename), timestamp)
 
 
-def write_commands_to_file(abs_filename: str, command_output: str, time_now_readable: str, additional_info='') -> None:
+def format_banner(time_now_readable: str, additional_info='') -> str:
     # truncate timestamp before writing to file
+    return f'\n*****{timestamps.time_trunc(time_now_readable)}{additional_info}*****\n'
 
-    time_now_readable = get_time_trunc(time_now_readable)
 
-    try:
-        with open(abs_filename, "a") as file_output:
-            file_output.write(f'\n*****{time_now_readable}{additional_info}*****\n')
-            log.debug(f'writing command output to file: {abs_filename}')
-            file_output.write(command_output)
-    except IOError as e:
-        log.error(f'Unable to write output to file: {abs_filename}.'
-                  f'Due to error: {e}')
-        exit(1)
+def get_failover_state(command_output) -> str:
+    for failover_command_line in command_output.splitlines():
+        failover_state = re.match(r'.*(This host: )(.*)', failover_command_line)
+        if failover_state:
+            return failover_state.group(2).strip()
+
+    return ''
+
+
+def format_failover_status(failover_state: str) -> str:
+    if failover_state:
+        return f'. Unit failover status: {failover_state}'
+
+    return ''
 
 
 def get_failover_status(command_output):
-    failover_status = ''
+    return format_failover_status(get_failover_state(command_output))
 
-    for failover_command_line in command_output.splitlines():
-        failover_status = re.match(r'.*(This host: )(.*)', failover_command_line)
-        if failover_status:
-            failover_status = failover_status.group(2)
-            break
-
-    if failover_status:
-        failover_status = failover_status.strip()
-        failover_status = f'. Unit failover status: {failover_status}'
+
+def get_timestamp(time_readable: str) -> float:
+    # time_readable is in format: 'DT: 2020-11-30 18:26:00+00:00' (or with 'ST: ' prefix)
+    timestamp = timestamps.to_timestamp(time_readable)
+    return timestamp if timestamp is not None else time.time()
+
+
+def write_snapshot(abs_filename: str, device_name: str, command: str, command_output: str, time_now_readable: str,
+                   banner: str, failover_state='', **additional_fields) -> None:
+    """
+    Stores command output using storage backend chosen in settings.ini ('storage_backend' option).
+
+    :param banner: text to put in the banner before command output in plain text file
+    :param additional_fields: additional fields to store with the record (e.g. delta interval)
+    """
+    if storage_backend in ['records', 'delta']:
+        records_file = records.records_filename(abs_filename)
+        # 'delta' backend stores full output every keyframe_interval records and line-level diffs in between
+        record_keyframe_interval = keyframe_interval if storage_backend == 'delta' else 0
+
+        def append_record():
+            file_size = records.append_record(abs_filename, device_name, command, command_output,
+                                              get_timestamp(time_now_readable), time_now_readable, failover_state,
+                                              archiver.codec, archiver.level, record_keyframe_interval,
+                                              **additional_fields)
+            update_file_size(records_file, file_size)
+
+        # record is compressed and written by the writer thread, failure to write it affects only this file
+        output_writer.submit(records_file, append_record)
     else:
-        failover_status = ''
+        write_commands_to_file(abs_filename, command_output, banner, format_failover_status(failover_state),
+                               get_timestamp(time_now_readable))
+
 
-    return failover_status
+def open_snapshot_stream(abs_filename: str, device_name: str, command: str, time_now_readable: str,
+                         failover_state=''):
+    """
+    Opens a snapshot whose output is written in chunks as it arrives (streamed commands),
+    using storage backend chosen in settings.ini.
 
+    :return: stream with write(data), close() and abort(error)
+    """
+    timestamp = get_timestamp(time_now_readable)
 
-def get_time_ftd(command_output):
-    device_time_now = ''
-    for time_command_line in command_output.splitlines():
-        # device_time_now = re.match(r'Localtime - (.*)', time_command_line)
-        # Due to the CSCvc04969 for FPR2100 and FPR1100 ("Need option to set local timezone on FTD") -
-        # it's better to get UTC time from FTD now:
-        device_time_now = re.match(r'(UTC\s+-\s+)(.*)', time_command_line)
-        if device_time_now:
-            device_time_now = device_time_now.group(2)
-            break
+    if storage_backend in ['records', 'delta']:
+        records_file = records.records_filename(abs_filename)
+        return records.RecordStream(abs_filename, device_name, command, timestamp, time_now_readable, failover_state,
+                                    archiver.codec, archiver.level, partial(output_writer.submit, records_file),
+                                    partial(update_file_size, records_file))
 
-    return device_time_now
+    stream = output_writer.open_stream(abs_filename, partial(update_file_size, abs_filename), timestamp)
+    stream.write(format_banner(time_now_readable, format_failover_status(failover_state)).encode('utf-8'))
+    return stream
+
+
+def stream_command(device, device_plan: plans.DevicePlan, command: str, time_now_readable: str,
+                   failover_state: str) -> str:
+    """
+    Runs the command and writes its output to the file in chunks as it arrives from the device. Post-processors
+    of the plan are applied to the chunks, hence memory doesn't depend on size of output.
+
+    :return: hash of output (see scheduler.hash_output()) or None if the command has failed
+    """
+    abs_filename = device_plan.command_files[command]
+    log.info('filename: %s', abs_filename)
+
+    try:
+        snapshot = open_snapshot_stream(abs_filename, device.name, command, time_now_readable, failover_state)
+    except OSError as e:
+        log.error('%s: unable to store output of command "%s". Error: %s', device.name, command, e)
+        return None
+
+    output_hash = hashlib.md5()
+    output_bytes = 0
+
+    def write(data):
+        nonlocal output_bytes
+        data = data.encode('utf-8')
+        output_hash.update(data)
+        output_bytes += len(data)
+        snapshot.write(data)
+
+    stream = plans.PostProcessingStream(device_plan.plan, write)
+
+    try:
+        with metrics.timer('execute', device.name, command):
+            executor.stream_command(device, command, stream.write, command_timeout or executor.BATCH_COMMAND_TIMEOUT,
+                                    deadline)
+        stream.close()
+    except resilience.DeadlineExceeded as e:
+        snapshot.abort(e)
+        raise
+    except Exception as e:
+        log.error('%s: streamed command "%s" has failed. Error: %s', device.name, command, e)
+        snapshot.abort(e)
+        # the rest of output has to be read, so the next command gets its own output
+        executor.resync(device)
+        return None
+
+    snapshot.close()
+    metrics.observe('output_bytes', output_bytes, device.name, command)
+
+    return output_hash.hexdigest()
 
 
 def get_time(device, device_os: str) -> str:
-    time_now_readable = f"ST: {datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)}"
-    log.debug(f'time_now: {time_now_readable}')
+    time_now_readable = timestamps.server_time_readable()
+    log.debug('time_now: %s', time_now_readable)
 
     if device_os == 'fxos':
         log.debug('running "show time"')
-        command_output = device.execute('show time', log_stdout=debug_connection)
-        ftd_time_now = get_time_ftd(command_output)  # get 'show time' output from FTD
-        log.debug(f'Got time from device: {ftd_time_now}')
+        with metrics.timer('get_time', device.name):
+            command_output = execute_command(device, 'show time')
+        ftd_time_now = timestamps.get_ftd_utc_time(command_output)  # get 'show time' output from FTD
+        log.debug('Got time from device: %s', ftd_time_now)
 
         if ftd_time_now:
-            try:
-                # convert to UTC time
-                ftd_time_now = dateparser.parse(ftd_time_now, date_formats=['%a %b %d %H:%M:%S %Z %Y'])
-                ftd_time_now = pytz.utc.localize(ftd_time_now)
-            except ValueError:
-                print('Time taken from device already contains TZ offset from UTC, no need to convert to UTC offset')
+            ftd_time_now = timestamps.parse_ftd_time(ftd_time_now)
 
-            time_now_readable = f'DT: {ftd_time_now}'
-            log.debug(f'Got time from ftd: {time_now_readable}')
+            if ftd_time_now is not None:
+                time_now_readable = timestamps.format_time_readable(timestamps.DEVICE_TIME_PREFIX, ftd_time_now)
+                log.debug('Got time from ftd: %s', time_now_readable)
 
     return time_now_readable
 
 
-def collect_device_commands(testbed, commands_to_gather: Dict,
-                            dir_name: str, file_size_to_gzip: int, num_to_store=10) -> None:
-    abs_dir_path = join(dirname(__file__), dir_name)
+def get_device_failover_state(device_name: str, device, device_os: str) -> str:
+    """
+    Gets failover state of the device. It's taken once per run and shared by all commands of the run.
+    """
+    failover_state = ''
+    # get failover state of this device
+    if device_os == 'fxos':
+        log.debug('%s: running "show failover | include This host"', device_name)
+        command_output = execute_command(device, 'show failover | include "This host"')
+        failover_state = get_failover_state(command_output)  # get failover status
+        log.debug('%s: got failover status: %s', device_name, failover_state)
 
-    sup.create_non_existing_dir(abs_dir_path)
+    return failover_state
+
+
+def execute_command(device, command: str) -> str:
+    """
+    Executes a single command with timeout, retries and deadline from settings.ini.
+    """
+    return executor.execute_command(device, command, debug_connection, command_timeout, retries, retry_backoff,
+                                    deadline)
+
+
+def run_commands(device, plan: plans.CommandPlan, commands: List, idempotent=True) -> Dict:
+    """
+    Runs commands on the device in a single batch (if batch_execute is on) or one by one.
+    Output of each command is passed through post-processors of the plan (e.g. FTD's trailing '>' is removed).
+
+    :param idempotent: whether commands may be sent again. Commands which aren't (e.g. clear commands of delta pairs,
+                       which would reset counters twice) are neither retried nor batched, since a failed batch
+                       is executed again one by one
+    :return: {command: output}
+    """
+    outputs = executor.execute_commands(device, commands, debug_connection, batch_execute and idempotent,
+                                        command_timeout, retries if idempotent else 0, retry_backoff, deadline)
+
+    for command, command_output in outputs.items():
+        outputs[command] = plan.post_process(command_output)
+        metrics.observe('output_bytes', len(outputs[command].encode('utf-8')), device.name, command)
 
-    log.debug('Starting to collect output of the commands')
+    return outputs
 
-    for device_name, device in testbed.devices.items():
-        # get operating system of a device from pyats_testbed.yaml
-        device_os = device.os
-        device_path = join(abs_dir_path, device_name)
-        sup.create_non_existing_dir(device_path)
-        device_path_commands = join(device_path, 'commands')
-        sup.create_non_existing_dir(device_path_commands)
 
+def run_device_worker(device_worker, device_name: str, device, *args) -> None:
+    # records logged while collecting from the device have its name in their context
+    with sup.log_context(device=device_name):
+        device_worker(device_name, device, *args)
+
+
+def run_device_workers(testbed, device_worker, max_workers: int, *args) -> bool:
+    """
+    Runs device_worker(device_name, device, *args) for every device in testbed using a pool of threads.
+
+    Each worker only touches its own device and its own gathered_commands/<device_name> directory,
+    hence devices are processed independently and their output is never mixed.
+
+    :param testbed: pyATS testbed object
+    :param device_worker: function to collect commands from a single device
+    :param max_workers: how many devices to process at the same time
+    :param args: additional arguments to pass to device_worker
+    :return: False if the run has been interrupted by the deadline
+    """
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='collector')
+    futures = {pool.submit(run_device_worker, device_worker, device_name, device, *args): device_name
+               for device_name, device in testbed.devices.items()}
+
+    def report(future):
+        device_name = futures[future]
         try:
-            device.connect(log_stdout=debug_connection)
-        except errors.ConnectionError:
-            log.error(f'Failed to establish connection to: {device_name}.'
-                      f'Check connectivity and try again.')
-            continue
-
-        time_now_readable = get_time(device, device_os)
-
-        if commands_to_gather.get(device_os):
-            additional_info = ''
-            # get failover state of this device
-            if device_os == 'fxos':
-                log.debug(f'{device_name}: running "show failover | include This host"')
-                command_output = device.execute('show failover | include "This host"', log_stdout=debug_connection)
-                additional_info = get_failover_status(command_output)  # get failover status
-                log.debug(f'{device_name}: got failover status: {additional_info}')
-
-            for command in commands_to_gather[device_os]:
-                filename_command = command.replace(' ', '_')
-                filename_command = filename_command.replace('*', 'all')
-                filename = device_name + '_' + filename_command
-                abs_filename = join(device_path_commands, filename)
-                log.info(f'filename: {abs_filename}')
-
-                log.info(f'{device_name}: run command: "{command}"')
-                command_output = device.execute(command, log_stdout=debug_connection)
-
-                # fixing cosmetic bug with '>' on the last line of FTD's output
-                if device_os == 'fxos' and command_output[-1:] == '>':
-                    command_output = '\n'.join(command_output.split('\n')[:-1]) + '\n'
-                write_commands_to_file(abs_filename, command_output, time_now_readable, additional_info)
-
-            # get all big non-gz files (in plain text) for this device
-            only_big_files = get_files_to_gz(device_path_commands, file_size_to_gzip)
-
-            if len(only_big_files) > 0:
-                archive_dir_name = 'archive'
-                abs_archive_path = join(device_path_commands, archive_dir_name)
-                sup.create_non_existing_dir(abs_archive_path)
-
-                # gz all big plain text files for this device
-                gz_files(only_big_files, abs_archive_path)
-                # remove the oldest gz file for each command for this device
-                remove_old_gz_files(only_big_files, abs_archive_path, num_to_store)
+            future.result()
+        except resilience.DeadlineExceeded as e:
+            log.error('%s: collection has been interrupted. Error: %s', device_name, e)
+        except Exception as e:
+            log.exception('%s: failed to collect commands. Error: %s', device_name, e)
+
+    try:
+        for future in as_completed(futures, timeout=deadline.remaining() if deadline is not None else None):
+            report(future)
+
+    except FuturesTimeoutError:
+        unfinished = [device_name for future, device_name in futures.items() if not future.done()]
+        for future in futures:
+            future.cancel()
+        log.error('Run deadline of %s sec has been exceeded. '
+                  'Devices which have not been finished: %s', deadline.seconds, unfinished)
+
+        # devices which are still in progress stop before their next command (their timeouts are cut to the deadline).
+        # They are waited for, hence their output is queued before the writer is closed
+        running = [future for future in futures if not future.cancelled()]
+        done, not_done = wait(running, timeout=DEADLINE_GRACE_PERIOD)
+        for future in done:
+            report(future)
+        if not_done:
+            log.error('Devices have not stopped within %s sec after the run deadline, '
+                      'their further output is discarded: %s',
+                      DEADLINE_GRACE_PERIOD, [futures[future] for future in not_done])
+        return False
+
+    finally:
+        pool.shutdown(wait=False)
+
+    return True
+
+
+def connect_device(device_name: str, device) -> bool:
+    try:
+        connection_error = profiling.lazy_import('unicon.core.errors').ConnectionError
+    except ImportError:
+        connection_error = ConnectionErrorStub
+
+    if not breaker.allow(device_name):
+        return False
 
+    def connect():
+        timeout = deadline.timeout(connect_timeout) if deadline is not None else connect_timeout
+        device.connect(log_stdout=debug_connection, connection_timeout=timeout)
+
+    try:
+        with metrics.timer('connect', device_name):
+            resilience.retry(connect, retries, retry_backoff, deadline, f'{device_name}: connect')
+    except connection_error as e:
+        log.error('Failed to establish connection to: %s.'
+                  'Check connectivity and try again.', device_name)
+        breaker.record_failure(device_name, f'Connection error: {e}')
+        return False
+    except resilience.DeadlineExceeded:
+        raise
+    except Exception as e:
+        log.error('Failed to establish connection to: %s. Error: %s', device_name, e)
+        breaker.record_failure(device_name, f'Connection error: {e}')
+        return False
+
+    return True
+
+
+@contextmanager
+def device_health(device_name: str):
+    """
+    Records outcome of collection from the device for the circuit breaker.
+    Devices which haven't been finished due to the run deadline are not counted as failed.
+    """
+    try:
+        yield
+    except resilience.DeadlineExceeded:
+        raise
+    except Exception as e:
+        breaker.record_failure(device_name, str(e) or type(e).__name__)
+        raise
+    else:
+        breaker.record_success(device_name)
+
+
+def commit_phase(device_journal: journal.DeviceJournal, phase: str, written=False, **fields) -> None:
+    """
+    Commits the phase to the journal of the device (if there is one).
+
+    :param written: the phase has produced output. It's committed by the writer thread once everything queued
+                    for writing is written, hence the collector doesn't wait for the disk
+    """
+    if device_journal is None:
+        return
+
+    if written:
+        output_writer.call_when_written(partial(device_journal.commit, phase, **fields))
+    else:
+        device_journal.commit(phase, **fields)
+
+
+def gather_commands(device_name: str, device, device_plan: plans.DevicePlan, time_now_readable: str,
+                    failover_state: str, file_size_to_gzip: int, num_to_store: int) -> None:
+    plan = device_plan.plan
+    sup.create_non_existing_dir(device_plan.commands_path)
+
+    commands = [spec.command for spec in plan.commands]
+
+    schedule = None
+    if adaptive_schedule:
+        schedule = scheduler.AdaptiveSchedule(join(device_plan.device_path, scheduler.SCHEDULE_FILENAME),
+                                              (min_interval, max_interval), plan.command_intervals)
+        due_commands = schedule.due(commands)
+        if len(due_commands) < len(commands):
+            log.info('%s: commands which are not due yet: %s',
+                     device_name, [command for command in commands if command not in due_commands])
+        if not due_commands:
+            return
+        commands = due_commands
+
+    # huge outputs are streamed to their files one command at a time (if stream_output is on), the rest are run together
+    streamed_commands = plan.streamed_commands if stream_output else frozenset()
+    command_outputs = run_commands(device, plan, [command for command in commands
+                                                  if command not in streamed_commands])
+
+    if schedule is not None:
+        for command, command_output in command_outputs.items():
+            schedule.update(command, command_output)
+
+    for command, command_output in command_outputs.items():
+        abs_filename = device_plan.command_files[command]
+        with sup.log_context(command=command):
+            log.info('filename: %s', abs_filename)
+            write_snapshot(abs_filename, device_name, command, command_output, time_now_readable, time_now_readable,
+                           failover_state)
+
+    for command in commands:
+        if command in streamed_commands:
+            with sup.log_context(command=command):
+                output_hash = stream_command(device, device_plan, command, time_now_readable, failover_state)
+            if schedule is not None and output_hash is not None:
+                schedule.update_hash(command, output_hash)
+
+    if schedule is not None:
+        schedule.save()
+
+    archive_big_files(device_plan.commands_path, file_size_to_gzip, num_to_store)
+
+
+def gather_snapshot_delta_commands(device_name: str, device, device_plan: plans.DevicePlan,
+                                   time_now_readable_full: str, failover_state: str,
+                                   file_size_to_gzip: int, num_to_store: int, device_journal=None) -> None:
+    """
+    Non-destructive delta mode: counters are never cleared on the device.
+    Deltas are computed against the snapshot of counters taken during the previous run.
+    """
+    if device_journal is not None and device_journal.done(journal.DELTA_SHOWS):
+        log.info('%s: delta commands have been finished by the interrupted run. Skipping them', device_name)
+        return
+
+    plan = device_plan.plan
+    device_path_delta = device_plan.deltas_path
+    current_timestamp = get_timestamp(time_now_readable_full)
+
+    command_outputs = run_commands(device, plan, [spec.show for spec in plan.delta_commands])
+    filenames = {spec.show: spec.filename for spec in plan.delta_commands}
+
+    for show_command, command_output in command_outputs.items():
+        filename_command = filenames[show_command]
+        abs_filename = device_plan.delta_files[show_command]
+        log.info('filename: %s', abs_filename)
+
+        current_counters = counters.parse_counters(device, show_command, command_output,
+                                                   use_genie=parse_counters == 'genie')
+        # e.g. 'show asp drop' has no counters in the output if there have been no drops
+        log.debug('%s: got %d counters from the output of "%s"', device_name, len(current_counters), show_command)
+
+        snapshot_filename = counters.snapshot_filename(device_path_delta, filename_command)
+        previous_snapshot = counters.load_snapshot(snapshot_filename)
+
+        if previous_snapshot:
+            seconds_interval = round(current_timestamp - previous_snapshot['timestamp'])
+            deltas, reset = counters.compute_deltas(previous_snapshot['counters'], current_counters)
+
+            delta_time_string = f'Delta output for the interval: ' \
+                                f'{timestamps.time_trunc(previous_snapshot["time"])} -' \
+                                f' {timestamps.time_trunc(time_now_readable_full)}.' \
+                                f' Interval: {seconds_interval} sec'
+            if reset:
+                log.warning('%s: counters of "%s" have been reset since previous snapshot '
+                            '(device has been rebooted or counters have been cleared)', device_name, show_command)
+                delta_time_string += '. Counters have been reset during the interval'
+
+            write_snapshot(abs_filename, device_name, show_command, counters.format_counters(deltas),
+                           time_now_readable_full, delta_time_string, failover_state, interval=seconds_interval,
+                           time_from=previous_snapshot['time'], reset=reset)
+
+            if parse_counters != 'False':
+                # store deltas with their rates per second for further analysis
+                series_path = join(device_plan.device_path, counters.COUNTERS_DIR_NAME, filename_command)
+                try:
+                    counters.append_counters(series_path, deltas, current_timestamp, seconds_interval)
+                except (OSError, ValueError) as e:
+                    # snapshot of counters is saved anyway, hence the next delta doesn't cover this interval again
+                    log.exception('%s: unable to store counters of "%s" to: %s. Error: %s',
+                                  device_name, show_command, series_path, e)
         else:
-            log.error(f'No commands for operating system: {device_os} '
-                      f'of device: {device_name} has been defined. '
-                      f'This device has been skipped. Specify list of commands'
-                      f' for {device_os} and try again.')
-            continue
+            log.info('%s: there is no previous snapshot of counters for "%s". '
+                     'Deltas would be computed during the next run', device_name, show_command)
+
+        try:
+            counters.save_snapshot(snapshot_filename, current_counters, current_timestamp, time_now_readable_full)
+        except OSError as e:
+            log.error('Unable to write snapshot of counters: %s. Error: %s', snapshot_filename, e)
+
+    archive_big_files(device_path_delta, file_size_to_gzip, num_to_store)
+    commit_phase(device_journal, journal.DELTA_SHOWS, written=True)
+
+
+def gather_delta_commands(device_name: str, device, device_plan: plans.DevicePlan, time_now_readable_full: str,
+                          failover_state: str, file_size_to_gzip: int, num_to_store: int,
+                          device_journal: journal.DeviceJournal = None) -> None:
+    """
+    :param device_journal: journal to commit phases of show/clear pair to. Phases which have been committed
+                           by the interrupted run (if it's resumed) are skipped
+    """
+    plan = device_plan.plan
+    device_path_delta = device_plan.deltas_path
+    sup.create_non_existing_dir(device_path_delta)
+
+    if delta_mode == 'snapshot':
+        gather_snapshot_delta_commands(device_name, device, device_plan, time_now_readable_full, failover_state,
+                                       file_size_to_gzip, num_to_store, device_journal)
+        return
+
+    if device_journal is not None and device_journal.done(journal.CLEAR_FLAG):
+        log.info('%s: delta commands have been finished by the interrupted run. Skipping them', device_name)
+        return
+
+    current_timestamp = get_timestamp(time_now_readable_full)
+
+    skip_show_commands = False
 
+    log.debug('time_now: %s', current_timestamp)
 
-def time_gmt_format(str_datetime):
-    # from string like "Mon Nov 30 13:44:43 EST 2020" to 'Mon Nov 30 13:46:43 2020'
-    # date_time_obj = dateparser.parse(str_datetime, date_formats=['%a %b %d %H:%M:%S %Z %Y'])
-    date_time_obj = dateparser.parse(str_datetime)
-    return date_time_obj
+    flag_delta_filename = join(device_path_delta, CLEAR_FLAG_FILENAME)
 
+    if exists(flag_delta_filename):
+        # counters have been cleared already
+        log.info('flag_delta_filename %s for device "%s" exists', flag_delta_filename, device_name)
 
-def collect_delta_device_commands(testbed, commands_to_gather: Dict,
-                            dir_name: str, file_size_to_gzip: int, num_to_store=10) -> None:
+        # check that we are able to read from delta file. Otherwise there is no point to collect show commands
+        try:
+            # read time of the last clear (seconds since epoch and readable time with ST:/DT: and TZ):
+            clear_timestamp, clear_timestamp_full = timestamps.read_clear_flag(flag_delta_filename)
+        except PermissionError as e:
+            log.error('Unable to read delta file: %s.'
+                      'Insufficient privileges. Error: %s', flag_delta_filename, e)
+            skip_show_commands = True
+
+        except ValueError as e:
+            log.error('Unable to read delta file: %s.'
+                      'Unknown time format or empty file. Error: %s', flag_delta_filename, e)
+            skip_show_commands = True
+
+        if not skip_show_commands and device_journal is not None and device_journal.done(journal.DELTA_SHOWS):
+            log.info('%s: output of delta show commands has been written by the interrupted run', device_name)
+            skip_show_commands = True
+
+        if not skip_show_commands:
+            command_outputs = run_commands(device, plan, [spec.show for spec in plan.delta_commands])
+            filenames = {spec.show: spec.filename for spec in plan.delta_commands}
+
+            for show_command, command_output in command_outputs.items():
+                filename_command = filenames[show_command]
+                abs_filename = device_plan.delta_files[show_command]
+                log.info('filename: %s', abs_filename)
+
+                seconds_interval = round(current_timestamp - clear_timestamp)
+
+                delta_time_string = f'Delta output for the interval: ' \
+                                    f'{timestamps.time_trunc(clear_timestamp_full)} -' \
+                                    f' {timestamps.time_trunc(time_now_readable_full)}.' \
+                                    f' Interval: {seconds_interval} sec'
+                write_snapshot(abs_filename, device_name, show_command, command_output, time_now_readable_full,
+                               delta_time_string, failover_state, interval=seconds_interval,
+                               time_from=clear_timestamp_full)
+
+                if parse_counters != 'False':
+                    # store counters with their rates per second for further analysis
+                    counters.store_counters(device, device_plan.device_path, show_command, filename_command,
+                                            command_output, current_timestamp, seconds_interval,
+                                            use_genie=parse_counters == 'genie')
+
+            archive_big_files(device_path_delta, file_size_to_gzip, num_to_store)
+            commit_phase(device_journal, journal.DELTA_SHOWS, written=True)
+
+    else:
+        # counters haven't been cleared already
+        log.info('flag_delta_filename %s for device "%s" does not exist', flag_delta_filename, device_name)
+
+    # Block of run clear commands and update tmp file with new timestamp.
+    # Time of the clear is journaled before counters are touched, hence .clear_flag could be repaired
+    # if the run is interrupted before it's written (see journal.DeviceJournal.repair_clear_flag()):
+    commit_phase(device_journal, journal.DELTA_CLEARS_STARTED,
+                 clear={'timestamp': current_timestamp, 'time': time_now_readable_full})
+    with sup.log_context(phase=journal.DELTA_CLEARS):
+        run_commands(device, plan, [spec.clear for spec in plan.delta_commands], idempotent=False)
+    commit_phase(device_journal, journal.DELTA_CLEARS)
+
+    try:
+        # write time to .clear_flag (seconds since epoch and readable time with ST:/DT: and TZ):
+        timestamps.write_clear_flag(flag_delta_filename, current_timestamp, time_now_readable_full)
+        commit_phase(device_journal, journal.CLEAR_FLAG)
+    except OSError as e:
+        # deltas of the next run will cover the interval since the previous clear
+        log.error('Unable to create delta file: %s. Error: %s', flag_delta_filename, e)
+    # End of run clear commands and update tmp file with new timestamp
+
+
+def repair_delta_pair(device_journal: journal.DeviceJournal, device_plan: plans.DevicePlan) -> None:
+    if device_plan.plan.delta_commands and delta_mode == 'clear':
+        try:
+            device_journal.repair_clear_flag(join(device_plan.deltas_path, CLEAR_FLAG_FILENAME))
+        except OSError as e:
+            log.error('%s: unable to repair delta file. Error: %s', device_plan.device_name, e)
+
+
+def collect_from_device(device_name: str, device, command_plans: plans.CommandPlans, abs_dir_path: str,
+                        file_size_to_gzip: int, num_to_store: int, run_journal: journal.RunJournal) -> None:
+    """
+    Collects both regular and delta commands from a single device using one session.
+
+    The device is connected and its time is taken only once, then regular commands and
+    delta show/clear pairs are run in a single pass. The connection is left open.
+    Each finished phase is committed to the journal of the device: if the run is interrupted, the next run
+    resumes it from the last committed phase.
+    """
+    # get operating system of a device from pyats_testbed.yaml
+    device_os = device.os
+    device_plan = command_plans.for_device(device_name, device, abs_dir_path)
+
+    if device_plan is None:
+        log.error('No commands for operating system: %s '
+                  'of device: %s has been defined. '
+                  'This device has been skipped. Specify list of commands'
+                  ' for %s in config/commands.yaml and try again.', device_os, device_name, device_os)
+        return
+
+    sup.create_non_existing_dir(device_plan.device_path)
+
+    device_journal = run_journal.device(device_plan.device_path)
+    if device_journal.finished():
+        log.info('%s: device has been finished by the interrupted run. Skipping it', device_name)
+        return
+
+    # half-done show/clear pair of the previous run has to be repaired before its journal is overwritten
+    repair_delta_pair(device_journal, device_plan)
+
+    with metrics.timer('device_total', device_name):
+        with sup.log_context(phase=journal.CONNECT):
+            if not connect_device(device_name, device):
+                return
+            device_journal.commit(journal.CONNECT)
+
+        with device_health(device_name):
+            time_now_readable = get_time(device, device_os)
+            failover_state = get_device_failover_state(device_name, device, device_os)
+
+            if device_plan.plan.commands and not device_journal.done(journal.COMMANDS):
+                with sup.log_context(phase=journal.COMMANDS):
+                    gather_commands(device_name, device, device_plan, time_now_readable, failover_state,
+                                    file_size_to_gzip, num_to_store)
+                    commit_phase(device_journal, journal.COMMANDS, written=True)
+
+            if device_plan.plan.delta_commands:
+                with sup.log_context(phase=journal.DELTA_SHOWS):
+                    gather_delta_commands(device_name, device, device_plan, time_now_readable, failover_state,
+                                          file_size_to_gzip, num_to_store, device_journal)
+
+            # rotation of big files is done by gather functions.
+            # Device is finished once all its output has been written
+            commit_phase(device_journal, journal.ARCHIVE, written=True)
+
+
+def collect_all_device_commands(testbed, command_plans: plans.CommandPlans,
+                                dir_name: str, file_size_to_gzip: int, num_to_store=10, max_workers=10,
+                                mode='all') -> None:
+    """
+    :param mode: which commands are collected: 'all', 'commands' or 'deltas' (for the journal of the run)
+    """
     abs_dir_path = join(dirname(__file__), dir_name)
 
     sup.create_non_existing_dir(abs_dir_path)
 
-    log.debug('Starting to collect output of the delta commands')
+    run_journal = journal.RunJournal(abs_dir_path, mode, resume_window, fsync_policy != 'never')
+    run_journal.start()
 
-    for device_name, device in testbed.devices.items():
-        # get operating system of a device from pyats_testbed.yaml
-        device_os = device.os
-        device_path = join(abs_dir_path, device_name)
-        sup.create_non_existing_dir(device_path)
-        device_path_delta = join(device_path, 'deltas')
-        sup.create_non_existing_dir(device_path_delta)
+    log.debug('Starting to collect output of the commands and delta commands')
 
-        try:
-            device.connect(log_stdout=debug_connection)
-        except errors.ConnectionError:
-            log.error(f'Failed to establish connection to: {device_name}.'
-                      f'Check connectivity and try again.')
-            continue
+    finished = run_device_workers(testbed, collect_from_device, max_workers,
+                                  command_plans, abs_dir_path, file_size_to_gzip, num_to_store, run_journal)
 
-        time_now_readable_full = get_time(device, device_os)
-        # to strip leading ST: or DT:
-        time_now_readable = time_now_readable_full[4:]
-        current_timestamp = time_gmt_format(time_now_readable)
+    # the run is finished once its output is written
+    output_writer.flush()
+    if finished:
+        run_journal.finish()
+    else:
+        # devices which have been finished are skipped if the next run resumes this one (see resume_window)
+        log.warning('Run %s has been interrupted by the deadline. It is left unfinished in the journal',
+                    run_journal.run_id)
 
-        skip_show_commands = False
 
-        log.debug(f'time_now: {current_timestamp}')
+def collect_device_commands(testbed, command_plans: plans.CommandPlans,
+                            dir_name: str, file_size_to_gzip: int, num_to_store=10, max_workers=10) -> None:
+    collect_all_device_commands(testbed, command_plans.filter(lambda plan: plan._replace(delta_commands=())),
+                                dir_name, file_size_to_gzip, num_to_store, max_workers, 'commands')
 
-        if commands_to_gather.get(device_os):
-            flag_delta_filename = join(device_path_delta, '.clear_flag')
 
-            if exists(flag_delta_filename):
-                # counters have been cleared already
-                log.info(f'flag_delta_filename {flag_delta_filename} for device "{device_name}" exists')
+def collect_delta_device_commands(testbed, command_plans: plans.CommandPlans,
+                                  dir_name: str, file_size_to_gzip: int, num_to_store=10, max_workers=10) -> None:
+    collect_all_device_commands(testbed, command_plans.filter(lambda plan: plan._replace(commands=())),
+                                dir_name, file_size_to_gzip, num_to_store, max_workers, 'deltas')
+
+
+def run_commands_job(device_name: str, device, device_plan: plans.DevicePlan,
+                     file_size_to_gzip: int, num_to_store: int) -> None:
+    sup.create_non_existing_dir(device_plan.device_path)
+
+    with device_health(device_name):
+        time_now_readable = get_time(device, device.os)
+        failover_state = get_device_failover_state(device_name, device, device.os)
+        gather_commands(device_name, device, device_plan, time_now_readable, failover_state,
+                        file_size_to_gzip, num_to_store)
+
+    flush_metrics('daemon', metrics.DAEMON_FLUSH_INTERVAL)
+
+
+def run_delta_commands_job(device_name: str, device, device_plan: plans.DevicePlan,
+                           file_size_to_gzip: int, num_to_store: int) -> None:
+    sup.create_non_existing_dir(device_plan.device_path)
+
+    # every iteration is a run of its own, only a half-done show/clear pair of the previous one is repaired
+    device_journal = journal.DeviceJournal(device_plan.device_path, f'{time.time():.6f}', fsync_policy != 'never')
+    repair_delta_pair(device_journal, device_plan)
+
+    with device_health(device_name):
+        time_now_readable = get_time(device, device.os)
+        failover_state = get_device_failover_state(device_name, device, device.os)
+        gather_delta_commands(device_name, device, device_plan, time_now_readable, failover_state,
+                              file_size_to_gzip, num_to_store, device_journal)
+
+    flush_metrics('daemon', metrics.DAEMON_FLUSH_INTERVAL)
+
+
+def flush_metrics(mode: str, interval=0) -> None:
+    """
+    Writes timings of the run to metrics/ directory (unless metrics_to_store is 0).
+
+    :param interval: write only if at least interval seconds have passed since the previous write
+    """
+    if metrics_to_store:
+        metrics.flush_if_due(metrics_path, mode, metrics_to_store, interval)
+
+
+def run_collection_daemon(testbed, command_plans: plans.CommandPlans, dir_name: str, file_size_to_gzip: int,
+                          num_to_store: int, max_workers: int, commands_interval: int, deltas_interval: int) -> None:
+    """
+    Keeps sessions to the devices open and runs regular and delta commands on their own schedule.
+
+    Default intervals might be overridden per device in 'custom' section of testbed.yaml
+    (options 'commands_interval' and 'deltas_interval').
+    """
+    abs_dir_path = join(dirname(__file__), dir_name)
+
+    sup.create_non_existing_dir(abs_dir_path)
+
+    def get_plan(device_name, device):
+        return command_plans.for_device(device_name, device, abs_dir_path)
+
+    job_args = dict(file_size_to_gzip=file_size_to_gzip, num_to_store=num_to_store)
+    job_specs = {
+        'commands': (lambda plan: plan.plan.commands, partial(run_commands_job, **job_args), commands_interval),
+        'deltas': (lambda plan: plan.plan.delta_commands, partial(run_delta_commands_job, **job_args),
+                   deltas_interval)}
+
+    jobs = daemon.build_jobs(testbed, get_plan, job_specs)
+
+    if not jobs:
+        log.error('No commands have been defined for operating systems of devices in testbed. Exiting')
+        exit(1)
+
+    pool = daemon.SessionPool(testbed, connect_device)
+    daemon.run_daemon(pool, jobs, max_workers)
+
+
+def load_testbed(testbed_filename: str):
+    """
+    Loads pyATS testbed. Genie is imported only here, hence runs which have nothing to do don't pay for its import.
+    """
+    genie_conf = profiling.lazy_import('genie.conf')
+
+    with profiling.phase('load testbed'):
+        return genie_conf.Genie.init(testbed_filename)
 
-                # check that we are able to read from delta file. Otherwise there is no point to collect show commands
-                try:
-                    with open(flag_delta_filename, mode='r') as fp:
-                        # read time from .clear_flag file to string (without TZ):
-                        clear_timestamp_full = fp.read()
-                        # convert to datetime:
-                        clear_timestamp = time_gmt_format(clear_timestamp_full[4:])
-                except PermissionError as e:
-                    log.error(f'Unable to read delta file: {flag_delta_filename}.'
-                              f'Insufficient privileges. Error: {e}')
-                    skip_show_commands = True
-
-                except ValueError as e:
-                    log.error(f'Unable to read delta file: {flag_delta_filename}.'
-                              f'Non-integer value has been written or empty file. Error: {e}')
-                    skip_show_commands = True
-
-                if not skip_show_commands:
-                    for command in commands_to_gather[device_os]:
-                        filename_command = command[0].replace(' ', '_')
-                        filename_command = filename_command.replace('*', 'all')
-                        filename = device_name + '_' + filename_command
-                        abs_filename = join(device_path_delta, filename)
-                        log.info(f'filename: {abs_filename}')
-
-                        additional_info = ''
-                        # get failover state of this device
-                        if device_os == 'fxos':
-                            log.debug(f'{device_name}: running "show failover | include This host"')
-                            command_output = device.execute('show failover | include "This host"', log_stdout=debug_connection)
-                            additional_info = get_failover_status(command_output)  # get failover status
-                            log.debug(f'{device_name}: got failover status: {additional_info}')
-
-                        log.info(f'{device_name}: run command: "{command[0]}"')
-                        command_output = device.execute(command[0], log_stdout=debug_connection)
-
-                        # fixing cosmetic bug with '>' on the last line of FTD's output
-                        if device_os == 'fxos' and command_output[-1:] == '>':
-                            command_output = '\n'.join(command_output.split('\n')[:-1]) + '\n'
-
-                        seconds_interval = round((current_timestamp - clear_timestamp).total_seconds())
-
-                        delta_time_string = f'Delta output for the interval: ' \
-                                            f'{get_time_trunc(clear_timestamp_full)} -' \
-                                            f' {get_time_trunc(time_now_readable_full)}.' \
-                                            f' Interval: {seconds_interval} sec'
-                        write_commands_to_file(abs_filename, command_output, delta_time_string, additional_info)
-
-                    # get all big non-gz files (in plain text) for this device
-                    only_big_files = get_files_to_gz(device_path_delta, file_size_to_gzip)
-
-                    if len(only_big_files) > 0:
-                        archive_dir_name = 'archive'
-                        abs_archive_path = join(device_path_delta, archive_dir_name)
-                        sup.create_non_existing_dir(abs_archive_path)
-
-                        # gz all big plain text files for this device
-                        gz_files(only_big_files, abs_archive_path)
-                        # remove the oldest gz file for each command for this device
-                        remove_old_gz_files(only_big_files, abs_archive_path, num_to_store)
-
-            else:
-                # counters haven't been cleared already
-                log.info(f'flag_delta_filename {flag_delta_filename} for device "{device_name}" does not exist')
-
-            # Block of run clear commands and update tmp file with new timestamp:
-            for command in commands_to_gather[device_os]:
-                log.info(f'{device_name}: run command: "{command[1]}"')
-                device.execute(command[1], log_stdout=debug_connection)
-
-            try:
-                with open(flag_delta_filename, mode='w') as fp:
-                    # write time to .clear_flag (with ST:/DT: and TZ):
-                    fp.write(str(time_now_readable_full))
-            except PermissionError as e:
-                log.error(f'Unable to create delta file: {flag_delta_filename}.'
-                          f'Insufficient privileges. Error: {e}')
-                exit(1)
-            # End of run clear commands and update tmp file with new timestamp
+
+def report_startup(profile_startup: bool) -> None:
+    if profile_startup:
+        print(profiling.report(), file=sys.stderr)
+
+
+def run_benchmark(args, file_size_to_gzip: int, num_to_store: int, max_workers: int) -> None:
+    """
+    Collects commands from simulated fleets of different size and prints throughput of collection.
+    """
+    fleet_sizes = [int(num_devices) for num_devices in args.devices.split(',')]
+    file_size_to_gzip = args.file_size_to_gzip if args.file_size_to_gzip is not None else file_size_to_gzip
+    max_workers = args.workers or max_workers
+
+    # simulated devices replay outputs of the default commands
+    command_plans = plans.compile_plans(plans.DEFAULT_COMMAND_SETS, 'default commands')
+
+    def collect_commands(testbed, dir_name):
+        collect_device_commands(testbed, command_plans, dir_name, file_size_to_gzip, num_to_store, max_workers)
+
+    def collect_deltas(testbed, dir_name):
+        collect_delta_device_commands(testbed, command_plans, dir_name, file_size_to_gzip, num_to_store,
+                                      max_workers)
+
+    def wait_for_output():
+        output_writer.flush()
+        archiver.shutdown()
+
+    results = benchmark.run_benchmark(collect_commands, collect_deltas, wait_for_output, fleet_sizes,
+                                      args.runs, args.latency, args.output_size, args.dir)
+    print(benchmark.format_results(results))
+
+
+def run_query(args, gathered_commands_path: str) -> None:
+    """
+    Prints snapshots of the command taken on the device between --from and --to.
+    """
+    try:
+        time_from = history.parse_time(args.time_from) if args.time_from else None
+        time_to = history.parse_time(args.time_to) if args.time_to else None
+    except ValueError as e:
+        log.error('%s. Exiting', e)
+        exit(1)
+
+    started = time.perf_counter()
+    snapshots = history.query(gathered_commands_path, args.device, plans.command_filename(args.command),
+                              time_from, time_to, args.last)
+    log.info('Found %s snapshots in %.3f sec', len(snapshots), time.perf_counter() - started)
+
+    if not snapshots:
+        print(f'No snapshots of "{args.command}" have been found for device: {args.device}', file=sys.stderr)
+        exit(1)
+
+    for timestamp, snapshot in snapshots:
+        sys.stdout.write(snapshot)
+
+
+def run_report(args, gathered_commands_path: str) -> None:
+    """
+    Prints top counters, fleet percentiles and anomalies of counter series of delta commands.
+    """
+    try:
+        analytics = profiling.lazy_import('pycrawler_lib.analytics')
+    except ImportError as e:
+        log.error('numpy is required for report. Install it with: pip install numpy. Error: %s. Exiting', e)
+        exit(1)
+
+    started = time.perf_counter()
+    report = analytics.report(gathered_commands_path, plans.command_filename(args.command) if args.command else None,
+                              args.days, args.recent, args.top, args.threshold, not args.no_cache)
+    log.info('Report has been built in %.3f sec', time.perf_counter() - started)
+
+    if report is None:
+        print('No counters have been collected yet. Set parse_counters in settings.ini to store counters '
+              'of delta commands', file=sys.stderr)
+        exit(1)
+
+    print(report)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='pycrawler - gather commands from Cisco devices '
+                                                 'and store them for further analysis')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print breakdown of startup time (imports, settings, testbed loading)')
+    parser.add_argument('--shard', default=None,
+                        help="collect only shard i out of n of the testbed, e.g. '1/3' (default: shard from "
+                             "settings.ini, all devices if it's empty)")
+    parser.add_argument('--node', default=None,
+                        help='name of this node, output is written to gathered_commands/nodes/<node> '
+                             'in sharding mode (default: node_name from settings.ini or hostname)')
+    subparsers = parser.add_subparsers(dest='mode')
+    subparsers.add_parser('run', help='connect to all devices, collect commands once and exit (default)')
+    subparsers.add_parser('daemon', help='keep sessions to devices open and collect commands '
+                                         'according to the schedule until stopped')
+    stats_parser = subparsers.add_parser('stats', help='show p50/p95 of connect, execute, compress and other timings '
+                                                       'and the slowest devices and commands')
+    stats_parser.add_argument('--last', type=int, default=0, help='how many latest runs to take into account '
+                                                                  '(default: all stored runs)')
+    stats_parser.add_argument('--top', type=int, default=10, help='how many slowest devices and commands to show')
+    query_parser = subparsers.add_parser('query', help='show snapshots of a command taken on a device between two '
+                                                       'times (plain files and archives are searched by time index)')
+    query_parser.add_argument('--device', required=True, help='name of the device as specified in testbed.yaml')
+    query_parser.add_argument('--command', required=True, help="command, e.g. 'show blocks'")
+    query_parser.add_argument('--from', dest='time_from', default=None,
+                              help="UTC time to show snapshots from: 'YYYY-MM-DD[ HH:MM[:SS]]' or seconds since epoch")
+    query_parser.add_argument('--to', dest='time_to', default=None,
+                              help="UTC time to show snapshots till: 'YYYY-MM-DD[ HH:MM[:SS]]' or seconds since epoch")
+    query_parser.add_argument('--last', type=int, default=0,
+                              help='show only the last snapshots in the range (default: all of them)')
+    report_parser = subparsers.add_parser('report', help='show top counters of delta commands for the whole fleet, '
+                                                         'fleet percentiles of their rates and anomalies against '
+                                                         'baseline of each device (requires numpy)')
+    report_parser.add_argument('--command', default=None,
+                               help="delta command to report on, e.g. 'show asp drop' (default: all of them)")
+    report_parser.add_argument('--top', type=int, default=10,
+                               help='how many top counters and anomalies to show (default: 10)')
+    report_parser.add_argument('--days', type=int, default=7,
+                               help='how many last days to report on (default: 7)')
+    report_parser.add_argument('--recent', type=int, default=3600,
+                               help='how many last seconds to compare against the rest of the days (default: 3600)')
+    report_parser.add_argument('--threshold', type=float, default=3.0,
+                               help='z-score of the recent rate against baseline to report an anomaly (default: 3)')
+    report_parser.add_argument('--no-cache', action='store_true',
+                               help='load all counters instead of updating gathered_commands/.report_cache')
+    subparsers.add_parser('merge', help='unify output of all nodes in gathered_commands/nodes: write '
+                                        'gathered_commands/manifest.json and links in gathered_commands/devices')
+    benchmark_parser = subparsers.add_parser('benchmark', help='measure throughput of collection against '
+                                                               'simulated fleets of devices (no real devices needed)')
+    benchmark_parser.add_argument('--devices', default='10,100,1000,5000',
+                                  help='comma-separated sizes of simulated fleets (default: 10,100,1000,5000)')
+    benchmark_parser.add_argument('--runs', type=int, default=2,
+                                  help='how many times to collect commands from each fleet (default: 2)')
+    benchmark_parser.add_argument('--latency', type=float, default=0.05,
+                                  help='delay of connect and of each command in seconds (default: 0.05)')
+    benchmark_parser.add_argument('--output-size', type=int, default=4096,
+                                  help='size of output of each regular command in bytes (default: 4096)')
+    benchmark_parser.add_argument('--file-size-to-gzip', type=float, default=None,
+                                  help='size (Mbytes) of file to archive (default: file_size_to_gzip from settings.ini)')
+    benchmark_parser.add_argument('--workers', type=int, default=0,
+                                  help='how many devices to process at the same time '
+                                       '(default: max_workers from settings.ini)')
+    benchmark_parser.add_argument('--dir', default=None,
+                                  help='directory to write output to (default: temporary directory removed afterwards)')
+
+    return parser.parse_args()
 
 
 def main():
+    args = parse_arguments()
+
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s - %(filename)s - %(funcName)s - %(levelname)s - %(message)s')
 
     par_dir_path = Path(__file__).resolve().parents[1]
     settings_file_path = join(par_dir_path, 'config', 'settings.ini')
 
-    s = settings.settings(settings_file_path)
+    with profiling.phase('read settings'):
+        s = settings.settings(settings_file_path)
     logging.debug(s)
 
     # file_size_to_gzip - Size (Mbytes) of file with commands to gzip
@@ -398,6 +1049,13 @@ def main():
     # how many gzip files for each command to store
     num_to_store = s['num_to_store']
 
+    # how many devices to collect commands from at the same time
+    max_workers = s['max_workers']
+
+    # how often (in seconds) to collect regular and delta commands in daemon mode
+    commands_interval = s['commands_interval']
+    deltas_interval = s['deltas_interval']
+
     # logging level for console
     logging_level_console = s['logging_console']
 
@@ -406,34 +1064,188 @@ def main():
 
     script_directory = Path(__file__).resolve().parents[1]
     testbed_filename = join(script_directory, 'config/testbed.yaml')
+    commands_filename = join(script_directory, 'config', 'commands.yaml')
 
     global log
-    log = sup.set_main_logging(logging_level_console, logging_level_file)
+    with profiling.phase('set up logging'):
+        log = sup.set_main_logging(logging_level_console, logging_level_file, s['log_format'],
+                                   s['device_log_files'])
+
+    # timings of each run are stored to metrics/ directory:
+    global metrics_path
+    metrics_path = join(script_directory, metrics.METRICS_DIR_NAME)
+
+    # how many runs to keep timings for (0 - don't store timings):
+    global metrics_to_store
+    metrics_to_store = s['metrics_to_store']
+
+    if args.mode == 'stats':
+        print(metrics.summarize(metrics.load_runs(metrics_path, args.last), args.top))
+        return
+
+    gathered_commands_path = join(script_directory, 'gathered_commands')
+
+    if args.mode == 'query':
+        run_query(args, gathered_commands_path)
+        return
+
+    if args.mode == 'report':
+        run_report(args, gathered_commands_path)
+        return
+
+    if args.mode == 'merge':
+        manifest = sharding.merge(gathered_commands_path)
+        if manifest is None:
+            exit(1)
+        print(sharding.format_manifest(manifest))
+        return
+
+    # in sharding mode this node collects only its shard of the testbed and writes to its own subtree:
+    shard = args.shard if args.shard is not None else s['shard']
+    node_name = args.node or s['node_name'] or socket.gethostname()
+    shard_index, shard_count = 1, 1
+    if shard:
+        try:
+            shard_index, shard_count = sharding.parse_shard(shard)
+        except ValueError as e:
+            log.error('%s. Exiting', e)
+            exit(1)
+        if not node_name or node_name.startswith('.') or '/' in node_name or '\\' in node_name:
+            log.error("Node name must be a valid directory name. Got: '%s'. Exiting", node_name)
+            exit(1)
+
+    dir_name = sharding.node_dir(gathered_commands_path, node_name) if shard else gathered_commands_path
 
     # turns on or off output from the connection to a device:
     global debug_connection
     debug_connection = s['debug_connection']
-    
-    if exists(testbed_filename):
-        log.debug(f'testbed_filename = {testbed_filename}')
-        testbed = Genie.init(testbed_filename)
-    else:
-        log.error(f"'testbed' file does not exist. Path checked: {testbed_filename}. Exiting")
+
+    # how to store output of commands: 'text', 'records' or 'delta':
+    global storage_backend
+    storage_backend = s['storage_backend']
+
+    # how often to store full output of a command with 'delta' storage backend:
+    global keyframe_interval
+    keyframe_interval = s['keyframe_interval']
+
+    # whether to parse counters from output of delta commands: 'False', 'regex' or 'genie':
+    global parse_counters
+    parse_counters = s['parse_counters']
+
+    # how to compute deltas: 'clear' (run clear commands on devices) or 'snapshot' (compute locally):
+    global delta_mode
+    delta_mode = s['delta_mode']
+
+    # whether to send all commands to a device at once instead of waiting for the prompt after each one:
+    global batch_execute
+    batch_execute = s['batch_execute']
+
+    # whether to stream output of commands marked with 'stream: true' in commands.yaml to their files in chunks:
+    global stream_output
+    stream_output = s['stream_output']
+
+    # timeouts (in seconds) of connect to a device and of each command, how many times to retry them
+    # and delay before the first retry:
+    global connect_timeout, command_timeout, retries, retry_backoff
+    connect_timeout = s['connect_timeout']
+    command_timeout = s['command_timeout']
+    retries = s['retries']
+    retry_backoff = s['retry_backoff']
+
+    # whether to poll commands whose output doesn't change less often, and bounds of their intervals (in seconds):
+    global adaptive_schedule, min_interval, max_interval
+    adaptive_schedule = s['adaptive_schedule']
+    min_interval = s['min_interval']
+    max_interval = s['max_interval']
+    if min_interval > max_interval:
+        log.error('Option min_interval (%s) in settings.ini must not be greater than '
+                  'max_interval (%s). Setting max_interval: %s', min_interval, max_interval, min_interval)
+        max_interval = min_interval
+
+    # the whole run (but not daemon) must be finished within run_deadline seconds:
+    global deadline
+    deadline = resilience.Deadline(s['run_deadline']) if args.mode in [None, 'run'] else None
+
+    # devices which have failed breaker_threshold times in a row are skipped for breaker_cooldown seconds
+    # (simulated devices of benchmark don't touch the state of real devices):
+    global breaker
+    breaker_filename = join(dir_name, BREAKER_FILENAME) if args.mode != 'benchmark' else None
+    breaker = resilience.CircuitBreaker(breaker_filename, s['breaker_threshold'], s['breaker_cooldown'])
+
+    # background writer stage for output of commands:
+    global output_writer, fsync_policy
+    fsync_policy = s['fsync_policy']
+    output_writer = writer.OutputWriter(fsync_policy)
+
+    # how old (in seconds) an interrupted run may be to resume it:
+    global resume_window
+    resume_window = s['resume_window']
+
+    # background compression stage for archive rotation:
+    global archiver
+    archiver = compression.Archiver(s['compression_codec'], s['compression_level'], s['compression_workers'])
+
+    if args.mode == 'benchmark':
+        try:
+            run_benchmark(args, file_size_to_gzip, num_to_store, max_workers)
+        finally:
+            output_writer.close()
+            archiver.shutdown()
+        return
+
+    if not exists(testbed_filename):
+        log.error("'testbed' file does not exist. Path checked: %s. Exiting", testbed_filename)
         exit(1)
 
-    commands_to_gather = {
-        'fxos': ['show blocks', 'show blocks old', 'show blocks queue history detail',
-                'show blocks queue history core-local', 'show blocks old core-local',
-                'show blocks exhaustion snapshot', 'show blocks assigned', 'show blocks old dump | b 80']}
+    # command sets, delta show/clear pairs and post-processing of output per operating system and device group
+    # are compiled once into plans (reused by every iteration in daemon mode):
+    with profiling.phase('compile command plans'):
+        try:
+            command_plans = plans.load_plans(commands_filename)
+        except ValueError as e:
+            log.error('%s. Exiting', e)
+            exit(1)
+
+    with profiling.phase('load testbed inventory'):
+        devices = inventory.load_inventory(testbed_filename)
+
+    if devices is not None and shard:
+        devices = {device_name: devices[device_name]
+                   for device_name in sharding.select_devices(devices, shard_index, shard_count)}
+        if not devices:
+            log.error('No devices of testbed: %s belong to shard %s. Exiting', testbed_filename, shard)
+            sharding.write_node_manifest(dir_name, node_name, shard, [])
+            report_startup(args.profile_startup)
+            exit(1)
+
+    if devices is not None and not inventory.devices_with_commands(devices, command_plans.operating_systems()):
+        log.error('No commands have been defined for operating systems of devices in testbed: %s. Exiting',
+                  testbed_filename)
+        report_startup(args.profile_startup)
+        exit(1)
 
-    dir_name = join(script_directory, 'gathered_commands')
-    delta_commands_to_gather = {
-            'fxos': [('show asp drop', 'clear asp drop'),
-                     ('show crypto accelerator statistics',
-                     'clear crypto accelerator statistics')]}
+    log.debug('testbed_filename = %s', testbed_filename)
+    testbed = load_testbed(testbed_filename)
 
-    collect_device_commands(testbed, commands_to_gather, dir_name, file_size_to_gzip, num_to_store)
-    collect_delta_device_commands(testbed, delta_commands_to_gather, dir_name, file_size_to_gzip, num_to_store)
+    if shard:
+        testbed = sharding.ShardedTestbed(testbed, sharding.select_devices(testbed.devices, shard_index, shard_count))
+        log.info('Node %s collects shard %s/%s: %s devices', node_name, shard_index, shard_count, len(testbed.devices))
+        sharding.write_node_manifest(dir_name, node_name, shard, list(testbed.devices))
+
+    report_startup(args.profile_startup)
+
+    try:
+        if args.mode == 'daemon':
+            run_collection_daemon(testbed, command_plans, dir_name, file_size_to_gzip, num_to_store, max_workers,
+                                  commands_interval, deltas_interval)
+        else:
+            collect_all_device_commands(testbed, command_plans, dir_name, file_size_to_gzip, num_to_store,
+                                        max_workers)
+    finally:
+        # wait for output of commands and archive files to be written
+        output_writer.close()
+        archiver.shutdown()
+        flush_metrics(args.mode or 'run')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,262 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from os.path import exists, join
+
+from typing import Dict
+from typing import List
+
+log = logging.getLogger('main_logger')
+
+METRICS_DIR_NAME = 'metrics'
+RUN_FILENAME_PREFIX = 'run_'
+PROMETHEUS_FILENAME = 'pycrawler.prom'
+
+# metric name -> (Prometheus metric name, description)
+METRICS = {
+    'connect': ('pycrawler_connect_seconds', 'Time to connect to the device'),
+    'get_time': ('pycrawler_get_time_seconds', 'Time to get time from the device'),
+    'execute': ('pycrawler_execute_seconds', 'Time to execute the command on the device'),
+    'output_bytes': ('pycrawler_output_bytes', 'Size of the command output'),
+    'rotation': ('pycrawler_rotation_seconds', 'Time to find big files and hand them over for archiving'),
+    'compress': ('pycrawler_compress_seconds', 'Time to compress the file to archive'),
+    'device_total': ('pycrawler_device_seconds', 'Time to collect all commands from the device'),
+}
+
+# how often (in seconds) to write metrics in daemon mode
+DAEMON_FLUSH_INTERVAL = 60
+
+# metrics which are summed up to find the slowest devices
+DEVICE_TIME_METRICS = ('connect', 'get_time', 'execute')
+
+_samples = []
+_samples_lock = threading.Lock()
+_run_started = time.time()
+
+
+def observe(metric: str, value: float, device='', command='') -> None:
+    """
+    Records a sample of the metric for the current run.
+    """
+    with _samples_lock:
+        _samples.append({'metric': metric, 'device': device, 'command': command, 'value': value})
+
+
+def take_samples() -> List:
+    """
+    :return: samples recorded since the previous call (they are removed from the current run)
+    """
+    with _samples_lock:
+        samples = list(_samples)
+        _samples.clear()
+
+    return samples
+
+
+@contextmanager
+def timer(metric: str, device='', command=''):
+    """
+    Records time spent in the block (in seconds) as a sample of the metric.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(metric, time.perf_counter() - started, device, command)
+
+
+def aggregate(samples: List) -> Dict:
+    """
+    :return: {(metric, device, command): [sum, count]}
+    """
+    aggregated = dict()
+    for sample in samples:
+        key = (sample['metric'], sample['device'], sample['command'])
+        value = aggregated.setdefault(key, [0.0, 0])
+        value[0] += sample['value']
+        value[1] += 1
+
+    return aggregated
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_prometheus(samples: List, started: float, duration: float) -> str:
+    """
+    Formats samples of the run for Prometheus node_exporter textfile collector.
+    """
+    lines = ['# HELP pycrawler_last_run_timestamp_seconds Time when the last run has started',
+             '# TYPE pycrawler_last_run_timestamp_seconds gauge',
+             f'pycrawler_last_run_timestamp_seconds {started}',
+             '# HELP pycrawler_last_run_duration_seconds Duration of the last run',
+             '# TYPE pycrawler_last_run_duration_seconds gauge',
+             f'pycrawler_last_run_duration_seconds {duration}']
+
+    aggregated = aggregate(samples)
+    for metric, (prometheus_name, description) in METRICS.items():
+        keys = sorted(key for key in aggregated if key[0] == metric)
+        if not keys:
+            continue
+
+        lines.append(f'# HELP {prometheus_name} {description}')
+        lines.append(f'# TYPE {prometheus_name} summary')
+        for key in keys:
+            labels = f'device="{escape_label(key[1])}"'
+            if key[2]:
+                labels += f',command="{escape_label(key[2])}"'
+            value_sum, count = aggregated[key]
+            lines.append(f'{prometheus_name}_sum{{{labels}}} {value_sum}')
+            lines.append(f'{prometheus_name}_count{{{labels}}} {count}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_atomic(filename: str, data: str) -> None:
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as fp:
+        fp.write(data)
+    os.replace(tmp_filename, filename)
+
+
+def remove_old_runs(metrics_path: str, num_to_store: int) -> None:
+    run_files = sorted(filename for filename in os.listdir(metrics_path)
+                       if filename.startswith(RUN_FILENAME_PREFIX) and filename.endswith('.json'))
+
+    for filename in run_files[:max(len(run_files) - num_to_store, 0)]:
+        try:
+            os.remove(join(metrics_path, filename))
+        except OSError as e:
+            log.error('Unable to remove metrics file: %s. Error: %s', filename, e)
+
+
+def flush(metrics_path: str, mode: str, num_to_store: int) -> None:
+    """
+    Writes samples collected since the previous flush to metrics/run_<timestamp>.json and metrics/pycrawler.prom.
+
+    :param mode: 'run' or 'daemon'
+    :param num_to_store: how many run files to keep
+    """
+    global _run_started
+
+    with _samples_lock:
+        samples = list(_samples)
+        _samples.clear()
+        started = _run_started
+        _run_started = time.time()
+
+    duration = _run_started - started
+    run = {'started': started, 'duration': duration, 'mode': mode, 'samples': samples}
+
+    try:
+        os.makedirs(metrics_path, exist_ok=True)
+        write_atomic(join(metrics_path, f'{RUN_FILENAME_PREFIX}{started:.3f}.json'), json.dumps(run))
+        write_atomic(join(metrics_path, PROMETHEUS_FILENAME), format_prometheus(samples, started, duration))
+        remove_old_runs(metrics_path, num_to_store)
+    except OSError as e:
+        log.error('Unable to write metrics to: %s. Error: %s', metrics_path, e)
+
+
+def flush_if_due(metrics_path: str, mode: str, num_to_store: int, interval: float) -> None:
+    """
+    Flushes samples if at least interval seconds have passed since the previous flush (used in daemon mode).
+    """
+    with _samples_lock:
+        due = time.time() - _run_started >= interval
+
+    if due:
+        flush(metrics_path, mode, num_to_store)
+
+
+def load_runs(metrics_path: str, last=0) -> List:
+    """
+    :param last: how many latest runs to load (0 - all stored runs)
+    :return: list of runs sorted by start time
+    """
+    if not exists(metrics_path):
+        return []
+
+    run_files = sorted(filename for filename in os.listdir(metrics_path)
+                       if filename.startswith(RUN_FILENAME_PREFIX) and filename.endswith('.json'))
+    if last:
+        run_files = run_files[-last:]
+
+    runs = []
+    for filename in run_files:
+        try:
+            with open(join(metrics_path, filename), 'r') as fp:
+                runs.append(json.load(fp))
+        except (OSError, ValueError) as e:
+            log.error('Unable to read metrics file: %s. Error: %s', filename, e)
+
+    return runs
+
+
+def percentile(values: List, p: float) -> float:
+    """
+    :return: p-th percentile (0 <= p <= 100) of values using linear interpolation
+    """
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    position = (len(values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(runs: List, top=10) -> str:
+    """
+    :return: report with p50/p95 of each metric, the slowest devices and the slowest commands
+    """
+    if not runs:
+        return 'No metrics have been collected yet'
+
+    samples = [sample for run in runs for sample in run['samples']]
+    durations = [run['duration'] for run in runs]
+
+    lines = [f'Runs: {len(runs)}, '
+             f'duration p50: {percentile(durations, 50):.2f} sec, p95: {percentile(durations, 95):.2f} sec',
+             '',
+             f'{"metric":<16}{"count":>10}{"p50":>14}{"p95":>14}{"max":>14}']
+
+    for metric in METRICS:
+        values = [sample['value'] for sample in samples if sample['metric'] == metric]
+        if values:
+            lines.append(f'{metric:<16}{len(values):>10}{percentile(values, 50):>14.3f}'
+                         f'{percentile(values, 95):>14.3f}{max(values):>14.3f}')
+
+    # time of each device per run: connect + get_time + execute
+    device_run_times = dict()
+    for run in runs:
+        run_times = dict()
+        for sample in run['samples']:
+            if sample['metric'] in DEVICE_TIME_METRICS and sample['device']:
+                run_times[sample['device']] = run_times.get(sample['device'], 0.0) + sample['value']
+        for device, value in run_times.items():
+            device_run_times.setdefault(device, []).append(value)
+
+    lines += ['', f'Slowest devices (time per run: {" + ".join(DEVICE_TIME_METRICS)}):',
+              f'{"device":<40}{"p50":>14}{"p95":>14}']
+    slowest_devices = sorted(device_run_times.items(), key=lambda item: percentile(item[1], 95), reverse=True)
+    for device, values in slowest_devices[:top]:
+        lines.append(f'{device:<40}{percentile(values, 50):>14.3f}{percentile(values, 95):>14.3f}')
+
+    command_times = dict()
+    for sample in samples:
+        if sample['metric'] == 'execute':
+            command_times.setdefault((sample['device'], sample['command']), []).append(sample['value'])
+
+    lines += ['', 'Slowest commands (execute):', f'{"device":<30}{"command":<45}{"p50":>12}{"p95":>12}']
+    slowest_commands = sorted(command_times.items(), key=lambda item: percentile(item[1], 95), reverse=True)
+    for (device, command), values in slowest_commands[:top]:
+        lines.append(f'{device:<30}{command:<45}{percentile(values, 50):>12.3f}{percentile(values, 95):>12.3f}')
+
+    return '\n'.join(lines)
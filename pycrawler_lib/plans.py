@@ -0,0 +1,333 @@
+import logging
+import threading
+
+from os.path import exists, join
+from types import MappingProxyType
+
+from typing import Callable
+from typing import Dict
+from typing import Mapping
+from typing import NamedTuple
+from typing import Tuple
+
+log = logging.getLogger('main_logger')
+
+# command sets used if config/commands.yaml doesn't exist
+DEFAULT_COMMAND_SETS = {
+    'os': {
+        'fxos': {
+            'post_processors': ['strip_trailing_prompt'],
+            'commands': ['show blocks', 'show blocks old', 'show blocks queue history detail',
+                         'show blocks queue history core-local', 'show blocks old core-local',
+                         'show blocks exhaustion snapshot', 'show blocks assigned',
+                         {'command': 'show blocks old dump | b 80', 'min_interval': 300, 'max_interval': 86400,
+                          'stream': True}],
+            'delta_commands': [{'show': 'show asp drop', 'clear': 'clear asp drop'},
+                               {'show': 'show crypto accelerator statistics',
+                                'clear': 'clear crypto accelerator statistics'}]}}}
+
+SET_OPTIONS = ('commands', 'delta_commands', 'post_processors')
+
+
+def strip_trailing_prompt(command_output: str) -> str:
+    # fixing cosmetic bug with '>' on the last line of FTD's output (the last line is cut off without copying lines)
+    if command_output[-1:] == '>':
+        command_output = command_output[:max(command_output.rfind('\n'), 0)] + '\n'
+
+    return command_output
+
+
+def normalize_newlines(command_output: str) -> str:
+    return command_output.replace('\r\n', '\n')
+
+
+# name in commands.yaml -> function to apply to output of every command of the set.
+# Post-processors work on lines and may change only the last line of output as a whole,
+# hence streamed output could be processed in chunks of complete lines (see PostProcessingStream)
+POST_PROCESSORS = {
+    'strip_trailing_prompt': strip_trailing_prompt,
+    'normalize_newlines': normalize_newlines,
+}
+
+
+def command_filename(command: str) -> str:
+    """
+    :return: part of the file name for output of the command, e.g. 'show_blocks_old' for 'show blocks old'
+    """
+    return command.replace(' ', '_').replace('*', 'all')
+
+
+class CommandSpec(NamedTuple):
+    command: str
+    filename: str
+    # (minimum, maximum) interval in adaptive schedule or None to use min_interval and max_interval from settings.ini
+    intervals: Tuple
+    # output is written to the file in chunks as it arrives instead of being kept in memory as a whole
+    stream: bool
+
+
+class DeltaCommandSpec(NamedTuple):
+    show: str
+    clear: str
+    filename: str
+
+
+class CommandPlan(NamedTuple):
+    """
+    Immutable execution plan of a command set: commands with sanitized file names and post-processors of output.
+    """
+    os: str
+    group: str
+    commands: Tuple
+    delta_commands: Tuple
+    post_processors: Tuple
+    # command -> (minimum, maximum) interval for commands with their own intervals
+    command_intervals: Mapping
+    # commands whose output is streamed
+    streamed_commands: frozenset
+
+    def post_process(self, command_output: str) -> str:
+        for post_processor in self.post_processors:
+            command_output = post_processor(command_output)
+
+        return command_output
+
+
+class PostProcessingStream:
+    """
+    Applies post-processors of a plan to output which arrives in chunks.
+
+    Complete lines are processed and passed on right away. The last complete line and the incomplete one are held back
+    till the next chunk, since post-processors might change the last line of the whole output
+    (e.g. strip_trailing_prompt). Hence only a couple of lines are kept in memory regardless of size of output.
+    """
+
+    def __init__(self, plan: CommandPlan, write: Callable):
+        """
+        :param write: function write(data) to pass processed output to
+        """
+        self.plan = plan
+        self._write = write
+        self._pending = ''
+
+    def write(self, data: str) -> None:
+        self._pending += data
+
+        last_newline = self._pending.rfind('\n')
+        if last_newline < 0:
+            return
+
+        position = self._pending.rfind('\n', 0, last_newline) + 1
+        if position:
+            self._write(self.plan.post_process(self._pending[:position]))
+            self._pending = self._pending[position:]
+
+    def close(self) -> None:
+        if self._pending:
+            self._write(self.plan.post_process(self._pending))
+            self._pending = ''
+
+
+class DevicePlan(NamedTuple):
+    """
+    Execution plan of a command set for a single device with absolute paths of all its files.
+    """
+    device_name: str
+    plan: CommandPlan
+    device_path: str
+    commands_path: str
+    deltas_path: str
+    # command -> absolute file name of its output
+    command_files: Mapping
+    # show command -> absolute file name of its output
+    delta_files: Mapping
+
+
+def compile_commands(name: str, commands) -> Tuple:
+    specs = []
+    for command in commands or []:
+        if isinstance(command, str):
+            command = {'command': command}
+        if not isinstance(command, dict) or not isinstance(command.get('command'), str):
+            raise ValueError(f'{name}: each command must be a string or a mapping with "command" key. Got: {command}')
+
+        intervals = None
+        if 'min_interval' in command or 'max_interval' in command:
+            try:
+                intervals = (int(command['min_interval']), int(command['max_interval']))
+            except (KeyError, TypeError, ValueError):
+                raise ValueError(f'{name}: "{command["command"]}" must have both min_interval and max_interval '
+                                 f'as numbers')
+            if not 1 <= intervals[0] <= intervals[1]:
+                raise ValueError(f'{name}: "{command["command"]}" must have 1 <= min_interval <= max_interval')
+
+        stream = command.get('stream', False)
+        if not isinstance(stream, bool):
+            raise ValueError(f'{name}: "{command["command"]}" must have "stream" as true or false')
+
+        specs.append(CommandSpec(command['command'], command_filename(command['command']), intervals, stream))
+
+    return tuple(specs)
+
+
+def compile_delta_commands(name: str, delta_commands) -> Tuple:
+    specs = []
+    for delta_command in delta_commands or []:
+        if not isinstance(delta_command, dict) or not isinstance(delta_command.get('show'), str) \
+                or not isinstance(delta_command.get('clear'), str):
+            raise ValueError(f'{name}: each delta command must be a mapping with "show" and "clear" keys. '
+                             f'Got: {delta_command}')
+
+        specs.append(DeltaCommandSpec(delta_command['show'], delta_command['clear'],
+                                      command_filename(delta_command['show'])))
+
+    return tuple(specs)
+
+
+def compile_plan(name: str, device_os: str, group: str, command_set: Dict) -> CommandPlan:
+    unknown = [option for option in command_set if option not in SET_OPTIONS + ('os',)]
+    if unknown:
+        raise ValueError(f'{name}: unknown options: {unknown}. Supported options: {list(SET_OPTIONS)}')
+
+    post_processors = []
+    for post_processor in command_set.get('post_processors') or []:
+        if post_processor not in POST_PROCESSORS:
+            raise ValueError(f'{name}: unknown post-processor: {post_processor}. '
+                             f'Supported post-processors: {list(POST_PROCESSORS)}')
+        post_processors.append(POST_PROCESSORS[post_processor])
+
+    commands = compile_commands(name, command_set.get('commands'))
+    delta_commands = compile_delta_commands(name, command_set.get('delta_commands'))
+    command_intervals = {spec.command: spec.intervals for spec in commands if spec.intervals is not None}
+    streamed_commands = frozenset(spec.command for spec in commands if spec.stream)
+
+    return CommandPlan(device_os, group, commands, delta_commands, tuple(post_processors),
+                       MappingProxyType(command_intervals), streamed_commands)
+
+
+class CommandPlans:
+    """
+    Execution plans compiled once at startup: one per operating system and one per device group.
+    Plans of devices (with absolute paths of their files) are built on first use and cached,
+    hence daemon iterations and consecutive collectors don't pay for them again.
+
+    A device belongs to a group if 'command_group' is set in 'custom' section of the device in testbed.yaml.
+    """
+
+    def __init__(self, plans: Dict):
+        """
+        :param plans: {(os, group or None): CommandPlan}
+        """
+        self.plans = plans
+        self._device_plans = dict()
+        self._lock = threading.Lock()
+
+    def plan_for(self, device) -> CommandPlan:
+        custom = getattr(device, 'custom', None) or {}
+        group = custom.get('command_group')
+
+        if group is not None:
+            plan = self.plans.get((device.os, group))
+            if plan is not None:
+                return plan
+            log.error('%s: command group "%s" for operating system %s has not been '
+                      'defined. Commands of operating system are used', device.name, group, device.os)
+
+        return self.plans.get((device.os, None))
+
+    def for_device(self, device_name: str, device, abs_dir_path: str) -> DevicePlan:
+        """
+        :return: plan of the device or None if there are no commands for its operating system
+        """
+        key = (device_name, abs_dir_path)
+        with self._lock:
+            device_plan = self._device_plans.get(key)
+        if device_plan is not None:
+            return device_plan
+
+        plan = self.plan_for(device)
+        if plan is None or not (plan.commands or plan.delta_commands):
+            return None
+
+        device_path = join(abs_dir_path, device_name)
+        commands_path = join(device_path, 'commands')
+        deltas_path = join(device_path, 'deltas')
+        command_files = {spec.command: join(commands_path, f'{device_name}_{spec.filename}')
+                         for spec in plan.commands}
+        delta_files = {spec.show: join(deltas_path, f'{device_name}_{spec.filename}')
+                       for spec in plan.delta_commands}
+
+        device_plan = DevicePlan(device_name, plan, device_path, commands_path, deltas_path,
+                                 MappingProxyType(command_files), MappingProxyType(delta_files))
+        with self._lock:
+            self._device_plans[key] = device_plan
+
+        return device_plan
+
+    def operating_systems(self) -> set:
+        """
+        :return: operating systems which have commands in any of the plans
+        """
+        return {device_os for (device_os, group), plan in self.plans.items()
+                if plan.commands or plan.delta_commands}
+
+    def filter(self, func: Callable) -> 'CommandPlans':
+        """
+        :param func: function func(plan) -> plan to transform each plan with (e.g. to keep only delta commands)
+        :return: new plans
+        """
+        return CommandPlans({key: func(plan) for key, plan in self.plans.items()})
+
+
+def compile_plans(command_sets: Dict, name='commands') -> CommandPlans:
+    """
+    Compiles command sets into plans.
+
+    :param command_sets: {'os': {os: command set}, 'groups': {group: command set with 'os' key}},
+                         where command set is {'commands': [...], 'delta_commands': [...], 'post_processors': [...]}.
+                         Options missing in a group are taken from the command set of its operating system
+    :param name: name of the source of command sets for error messages
+    :raise ValueError: if command sets are invalid
+    """
+    if not isinstance(command_sets, dict) or not isinstance(command_sets.get('os'), dict):
+        raise ValueError(f'{name}: "os" section with command sets per operating system is required')
+
+    plans = dict()
+    for device_os, command_set in command_sets['os'].items():
+        command_set = command_set or {}
+        if not isinstance(command_set, dict):
+            raise ValueError(f'{name}: command set of operating system {device_os} must be a mapping')
+        plans[(device_os, None)] = compile_plan(f'{name}: os: {device_os}', device_os, None, command_set)
+
+    for group, command_set in (command_sets.get('groups') or {}).items():
+        if not isinstance(command_set, dict) or not command_set.get('os'):
+            raise ValueError(f'{name}: command group {group} must be a mapping with "os" key')
+
+        os_command_set = command_sets['os'].get(command_set['os']) or {}
+        merged_set = {option: command_set.get(option, os_command_set.get(option)) for option in SET_OPTIONS}
+        plans[(command_set['os'], group)] = compile_plan(f'{name}: groups: {group}', command_set['os'], group,
+                                                         merged_set)
+
+    return CommandPlans(plans)
+
+
+def load_plans(filename: str) -> CommandPlans:
+    """
+    Loads command sets from YAML file (config/commands.yaml) and compiles them into plans.
+    If the file doesn't exist, default command sets are used.
+
+    :raise ValueError: if the file can't be parsed or command sets are invalid
+    """
+    if not exists(filename):
+        log.info('File with commands does not exist: %s. Using default commands', filename)
+        return compile_plans(DEFAULT_COMMAND_SETS, 'default commands')
+
+    import yaml
+
+    try:
+        with open(filename, 'r') as fp:
+            command_sets = yaml.safe_load(fp)
+    except (OSError, yaml.YAMLError) as e:
+        raise ValueError(f'Unable to read file with commands: {filename}. Error: {e}')
+
+    return compile_plans(command_sets, filename)
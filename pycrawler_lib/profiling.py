@@ -0,0 +1,48 @@
+import importlib
+import sys
+import time
+
+from contextlib import contextmanager
+
+# time when pycrawler has started to import its modules
+process_start = time.perf_counter()
+
+# list of (phase name, seconds)
+_phases = []
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Measures time of a startup phase (e.g. reading settings or loading testbed).
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.perf_counter() - started))
+
+
+def lazy_import(module_name: str):
+    """
+    Imports heavy module (e.g. genie.conf) when it's needed for the first time and measures time of the import.
+    """
+    if module_name in sys.modules:
+        # the module might be still being imported by another thread, import_module() waits for it
+        return importlib.import_module(module_name)
+
+    with phase(f'import {module_name}'):
+        return importlib.import_module(module_name)
+
+
+def report() -> str:
+    """
+    :return: breakdown of startup time: time of each phase and total time since start of the process
+    """
+    total = time.perf_counter() - process_start
+    lines = ['Startup profile:']
+    for name, seconds in _phases:
+        lines.append(f'  {name:<40} {seconds * 1000:10.1f} ms')
+    lines.append(f'  {"total since process start":<40} {total * 1000:10.1f} ms')
+
+    return '\n'.join(lines)
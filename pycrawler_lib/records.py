@@ -0,0 +1,478 @@
+import bisect
+import difflib
+import json
+import logging
+import os
+import struct
+import threading
+
+from collections import OrderedDict
+from os.path import basename, dirname, exists, getsize, join
+
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+
+import pycrawler_lib.compression as compression
+
+log = logging.getLogger('main_logger')
+
+RECORDS_SUFFIX = '.rec'
+
+# Each record in .rec file:
+#   magic (4 bytes) | header length (uint32) | payload length (uint32) | header (JSON) | payload (compressed output)
+RECORD_MAGIC = b'PCR1'
+RECORD_PREFIX = struct.Struct('<4sII')
+
+# Each entry in the offset index (hidden file next to .rec file): timestamp (double) | offset (uint64) | length (uint32)
+INDEX_ENTRY = struct.Struct('<dQI')
+
+# Record types: full output (keyframe) or line-level diff against output of the previous record.
+# Diff records keep offset of their keyframe in 'keyframe' field of the header
+RECORD_FULL = 'full'
+RECORD_DIFF = 'diff'
+
+# spool file of a streamed record (hidden file next to .rec file), removed when the record is appended
+STREAM_SUFFIX = '.stream'
+
+# size of chunks to copy spooled payload to records file with
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# outputs with more lines than this are always stored in full (diff of huge outputs is too slow)
+MAX_DIFF_LINES = 50000
+
+# how much output (in characters) of the last snapshots to keep in memory to make diffs against
+MAX_CACHED_OUTPUT = 64 * 1024 * 1024
+
+
+class SnapshotCache:
+    """
+    Last snapshot written to each records file by this process. Total size of cached output is bounded:
+    the least recently used snapshots are dropped first and reloaded from their records files when needed.
+    """
+
+    def __init__(self, max_output: int):
+        self.max_output = max_output
+        # records file -> last snapshot, ordered from the least to the most recently used
+        self._snapshots = OrderedDict()
+        self._output_size = 0
+        self._lock = threading.Lock()
+
+    def get(self, records_file: str) -> Dict:
+        with self._lock:
+            snapshot = self._snapshots.get(records_file)
+            if snapshot is None:
+                return dict()
+            self._snapshots.move_to_end(records_file)
+            return snapshot
+
+    def put(self, records_file: str, snapshot: Dict) -> None:
+        with self._lock:
+            self._pop(records_file)
+            if len(snapshot['output']) > self.max_output:
+                return
+
+            self._snapshots[records_file] = snapshot
+            self._output_size += len(snapshot['output'])
+            while self._output_size > self.max_output:
+                self._pop(next(iter(self._snapshots)))
+
+    def pop(self, records_file: str) -> None:
+        with self._lock:
+            self._pop(records_file)
+
+    def _pop(self, records_file: str) -> None:
+        snapshot = self._snapshots.pop(records_file, None)
+        if snapshot is not None:
+            self._output_size -= len(snapshot['output'])
+
+
+_last_snapshots = SnapshotCache(MAX_CACHED_OUTPUT)
+
+
+def records_filename(abs_filename: str) -> str:
+    return abs_filename + RECORDS_SUFFIX
+
+
+def index_filename(records_file: str) -> str:
+    return join(dirname(records_file), f'.{basename(records_file)}.idx')
+
+
+def encode_record(header: Dict, payload: bytes) -> bytes:
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return RECORD_PREFIX.pack(RECORD_MAGIC, len(header_bytes), len(payload)) + header_bytes + payload
+
+
+def decode_record(data: bytes) -> Dict:
+    """
+    :return: header of the record with decompressed command output in 'output' key
+             (or diff against the previous record in 'diff' key for diff records)
+    """
+    magic, header_length, payload_length = RECORD_PREFIX.unpack_from(data)
+    if magic != RECORD_MAGIC:
+        raise ValueError('Not a pycrawler record')
+
+    header_end = RECORD_PREFIX.size + header_length
+    record = json.loads(data[RECORD_PREFIX.size:header_end].decode('utf-8'))
+    payload = data[header_end:header_end + payload_length]
+    payload = compression.decompress_bytes(payload, record['codec']).decode('utf-8')
+
+    if record.get('type') == RECORD_DIFF:
+        record['diff'] = json.loads(payload)
+    else:
+        record['output'] = payload
+
+    return record
+
+
+def make_diff(previous_output: str, output: str) -> List:
+    """
+    :return: list of [i1, i2, new_lines] - lines i1:i2 of previous output to replace with new_lines
+    """
+    previous_lines = previous_output.splitlines(keepends=True)
+    lines = output.splitlines(keepends=True)
+    matcher = difflib.SequenceMatcher(None, previous_lines, lines)
+
+    return [[i1, i2, lines[j1:j2]] for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def apply_diff(previous_output: str, diff: List) -> str:
+    previous_lines = previous_output.splitlines(keepends=True)
+    lines = []
+    position = 0
+
+    for i1, i2, new_lines in diff:
+        lines.extend(previous_lines[position:i1])
+        lines.extend(new_lines)
+        position = i2
+
+    lines.extend(previous_lines[position:])
+
+    return ''.join(lines)
+
+
+def scan_entries(fp, records_size: int, offset=0) -> List:
+    """
+    Reads records one by one starting from offset and returns index entries for them.
+    Reading stops at the first truncated or broken record.
+
+    :param fp: file object opened in binary mode (or an object with the same seek() and read())
+    """
+    entries = []
+
+    while True:
+        fp.seek(offset)
+        prefix = fp.read(RECORD_PREFIX.size)
+        if len(prefix) < RECORD_PREFIX.size:
+            break
+
+        magic, header_length, payload_length = RECORD_PREFIX.unpack(prefix)
+        header = fp.read(header_length)
+        length = RECORD_PREFIX.size + header_length + payload_length
+
+        if magic != RECORD_MAGIC or len(header) < header_length or offset + length > records_size:
+            break
+
+        entries.append((json.loads(header.decode('utf-8'))['timestamp'], offset, length))
+        offset += length
+
+    return entries
+
+
+def scan_records(records_file: str) -> List:
+    """
+    Reads all records of the file one by one and returns index entries for them.
+    Truncated record at the end of file (e.g. process has been killed during write) is cut off.
+    """
+    records_size = getsize(records_file)
+
+    with open(records_file, 'rb') as fp:
+        entries = scan_entries(fp, records_size)
+
+    offset = entries[-1][1] + entries[-1][2] if entries else 0
+    if offset < records_size:
+        log.warning('Truncated record at the end of file: %s. Cutting it off at offset %s', records_file, offset)
+        os.truncate(records_file, offset)
+
+    return entries
+
+
+def rebuild_index(records_file: str) -> List:
+    entries = scan_records(records_file)
+
+    with open(index_filename(records_file), 'wb') as fp:
+        for entry in entries:
+            fp.write(INDEX_ENTRY.pack(*entry))
+
+    return entries
+
+
+def check_index(records_file: str) -> None:
+    """
+    Checks that the last entry of the offset index points to the end of the records file.
+    Rebuilds the index otherwise (e.g. process has been killed between writing record and index entry).
+    """
+    records_size = getsize(records_file) if exists(records_file) else 0
+    idx_file = index_filename(records_file)
+    idx_size = getsize(idx_file) if exists(idx_file) else 0
+
+    if idx_size == 0 and records_size == 0:
+        return
+
+    if idx_size >= INDEX_ENTRY.size and idx_size % INDEX_ENTRY.size == 0:
+        with open(idx_file, 'rb') as fp:
+            fp.seek(-INDEX_ENTRY.size, os.SEEK_END)
+            timestamp, offset, length = INDEX_ENTRY.unpack(fp.read(INDEX_ENTRY.size))
+        if offset + length == records_size:
+            return
+
+    log.warning('Offset index of file: %s is inconsistent. Rebuilding it', records_file)
+    rebuild_index(records_file)
+
+
+def load_last_snapshot(records_file: str) -> Dict:
+    """
+    Restores the last snapshot of the file (output, offset of its keyframe and number of diffs since keyframe).
+    """
+    entries = read_index(records_file) if exists(records_file) else []
+    if not entries:
+        return dict()
+
+    with open(records_file, 'rb') as fp:
+        record, keyframe_position = read_resolved(fp, entries, len(entries) - 1)
+
+    return {'output': record['output'], 'keyframe': entries[keyframe_position][1],
+            'since_keyframe': len(entries) - 1 - keyframe_position, 'size': getsize(records_file)}
+
+
+def append_record(abs_filename: str, device_name: str, command: str, command_output: str, timestamp: float,
+                  time_readable: str, failover_state: str, codec='gzip', level=6, keyframe_interval=0,
+                  **additional_fields) -> int:
+    """
+    Appends command output as a record to <abs_filename>.rec and its offset to the index.
+
+    :param timestamp: time of the snapshot (seconds since epoch)
+    :param time_readable: time of the snapshot in human readable format
+    :param keyframe_interval: 0 - always store full output,
+                              N - store full output every N records and line-level diffs against
+                                  the previous snapshot in between
+    :param additional_fields: additional fields to store in the header of the record (e.g. delta interval)
+    :return: size of the records file
+    """
+    records_file = records_filename(abs_filename)
+    check_index(records_file)
+
+    header = {'device': device_name, 'command': command, 'timestamp': timestamp, 'time': time_readable,
+              'failover': failover_state, 'codec': codec, 'type': RECORD_FULL}
+    header.update(additional_fields)
+    payload = command_output
+
+    last_snapshot = dict()
+    if keyframe_interval:
+        last_snapshot = _last_snapshots.get(records_file)
+
+        records_size = getsize(records_file) if exists(records_file) else 0
+        if last_snapshot.get('size') != records_size:
+            # the file has been written by another process or archived
+            last_snapshot = load_last_snapshot(records_file)
+
+        if (last_snapshot and last_snapshot['since_keyframe'] + 1 < keyframe_interval
+                and command_output.count('\n') <= MAX_DIFF_LINES):
+            diff = json.dumps(make_diff(last_snapshot['output'], command_output), separators=(',', ':'))
+
+            if len(diff) < len(command_output):
+                header['type'] = RECORD_DIFF
+                header['keyframe'] = last_snapshot['keyframe']
+                payload = diff
+
+    record = encode_record(header, compression.compress_bytes(payload.encode('utf-8'), codec, level))
+
+    with open(records_file, 'ab') as fp:
+        offset = fp.tell()
+        fp.write(record)
+        records_size = fp.tell()
+
+    with open(index_filename(records_file), 'ab') as fp:
+        fp.write(INDEX_ENTRY.pack(timestamp, offset, len(record)))
+
+    if keyframe_interval:
+        if header['type'] == RECORD_DIFF:
+            last_snapshot = {'keyframe': header['keyframe'], 'since_keyframe': last_snapshot['since_keyframe'] + 1}
+        else:
+            last_snapshot = {'keyframe': offset, 'since_keyframe': 0}
+        last_snapshot.update(output=command_output, size=records_size)
+
+        _last_snapshots.put(records_file, last_snapshot)
+
+    return records_size
+
+
+class RecordStream:
+    """
+    Record whose output arrives in chunks (streamed commands, see executor.stream_command()).
+
+    Output is compressed as it arrives into a hidden spool file next to the records file, hence memory doesn't depend
+    on size of output. When output is complete, the record is appended to the records file by a task handed over
+    to submit() (e.g. OutputWriter.submit() of the records file), so it's ordered with other records of the file.
+    Streamed records are always stored in full.
+    """
+
+    def __init__(self, abs_filename: str, device_name: str, command: str, timestamp: float, time_readable: str,
+                 failover_state: str, codec: str, level: int, submit: Callable, on_written: Callable = None,
+                 **additional_fields):
+        """
+        :param submit: function submit(task) to run task() which appends the record
+        :param on_written: function on_written(size of the records file) to call when the record has been appended
+        """
+        self.records_file = records_filename(abs_filename)
+        self.spool_filename = join(dirname(self.records_file), f'.{basename(self.records_file)}{STREAM_SUFFIX}')
+        self.header = {'device': device_name, 'command': command, 'timestamp': timestamp, 'time': time_readable,
+                       'failover': failover_state, 'codec': codec, 'type': RECORD_FULL}
+        self.header.update(additional_fields)
+        self.submit = submit
+        self.on_written = on_written
+
+        self._compressor = compression.make_compressor(codec, level)
+        self._fp = open(self.spool_filename, 'wb')
+
+    def write(self, data: bytes) -> None:
+        self._fp.write(self._compressor.compress(data))
+
+    def close(self) -> None:
+        self._fp.write(self._compressor.flush())
+        self._fp.close()
+        self.submit(self._append)
+
+    def abort(self, error: Exception) -> None:
+        log.error('Streamed output has not been stored to: %s. Due to error: %s', self.records_file, error)
+        self._fp.close()
+        os.remove(self.spool_filename)
+
+    def _append(self) -> None:
+        check_index(self.records_file)
+
+        header_bytes = json.dumps(self.header, separators=(',', ':')).encode('utf-8')
+        payload_length = getsize(self.spool_filename)
+
+        with open(self.records_file, 'ab') as fp, open(self.spool_filename, 'rb') as spool:
+            offset = fp.tell()
+            fp.write(RECORD_PREFIX.pack(RECORD_MAGIC, len(header_bytes), payload_length) + header_bytes)
+            for chunk in iter(lambda: spool.read(COPY_CHUNK_SIZE), b''):
+                fp.write(chunk)
+            records_size = fp.tell()
+
+        with open(index_filename(self.records_file), 'ab') as fp:
+            fp.write(INDEX_ENTRY.pack(self.header['timestamp'], offset, records_size - offset))
+
+        os.remove(self.spool_filename)
+
+        # the next diff record (if any) has to be made against this one, it's reloaded from the file
+        _last_snapshots.pop(self.records_file)
+
+        if self.on_written is not None:
+            self.on_written(records_size)
+
+
+def load_index(idx_file: str) -> List:
+    """
+    :return: entries (timestamp, offset, length) of the offset index file (a partially written entry is ignored)
+    """
+    with open(idx_file, 'rb') as fp:
+        data = fp.read()
+
+    return list(INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]))
+
+
+def read_index(records_file: str) -> List:
+    idx_file = index_filename(records_file)
+
+    if not exists(idx_file):
+        return rebuild_index(records_file)
+
+    return load_index(idx_file)
+
+
+def read_resolved(fp, entries: List, position: int):
+    """
+    Reads record entries[position] and rebuilds its full output starting from its keyframe.
+
+    :return: record and position of its keyframe in entries
+    """
+    timestamp, offset, length = entries[position]
+    fp.seek(offset)
+    record = decode_record(fp.read(length))
+
+    if 'diff' not in record:
+        return record, position
+
+    keyframe_position = bisect.bisect_left([entry[1] for entry in entries], record['keyframe'])
+    output = ''
+
+    for timestamp, offset, length in entries[keyframe_position:position + 1]:
+        fp.seek(offset)
+        previous_record = decode_record(fp.read(length))
+        output = previous_record['output'] if 'output' in previous_record \
+            else apply_diff(output, previous_record['diff'])
+
+    del record['diff']
+    record['output'] = output
+
+    return record, keyframe_position
+
+
+def read_record(records_file: str, timestamp: float) -> Dict:
+    """
+    Returns the latest record taken at or before timestamp. Full records are read with a single seek,
+    diff records are rebuilt from their keyframe.
+
+    :return: record or empty dict if there are no records before timestamp
+    """
+    entries = read_index(records_file)
+    position = bisect.bisect_right([entry[0] for entry in entries], timestamp)
+
+    if position == 0:
+        return dict()
+
+    with open(records_file, 'rb') as fp:
+        record, keyframe_position = read_resolved(fp, entries, position - 1)
+
+    return record
+
+
+def iter_entries(fp, entries: List, time_from=None, time_to=None) -> Iterator[Dict]:
+    """
+    Yields records of entries taken between time_from and time_to (seconds since epoch, both are inclusive).
+    Only records in the range (and the keyframe of the first one) are read.
+
+    :param fp: file object opened in binary mode (or an object with the same seek() and read())
+    """
+    start = bisect.bisect_left([entry[0] for entry in entries], time_from) if time_from is not None else 0
+    previous_output = None
+
+    for position in range(start, len(entries)):
+        timestamp, offset, length = entries[position]
+        if time_to is not None and timestamp > time_to:
+            break
+
+        if previous_output is None:
+            # the first record in the range might be a diff, rebuild it from its keyframe
+            record, keyframe_position = read_resolved(fp, entries, position)
+        else:
+            fp.seek(offset)
+            record = decode_record(fp.read(length))
+            if 'diff' in record:
+                record['output'] = apply_diff(previous_output, record.pop('diff'))
+
+        previous_output = record['output']
+        yield record
+
+
+def iter_records(records_file: str, time_from=None, time_to=None) -> Iterator[Dict]:
+    """
+    Yields records taken between time_from and time_to (seconds since epoch, both are inclusive).
+    """
+    entries = read_index(records_file)
+
+    with open(records_file, 'rb') as fp:
+        yield from iter_entries(fp, entries, time_from, time_to)
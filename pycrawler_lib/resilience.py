@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from os.path import dirname, exists
+
+from typing import Callable
+
+log = logging.getLogger('main_logger')
+
+# maximum delay (in seconds) between retries
+MAX_BACKOFF = 60
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """
+    Time by which the whole run must be finished. Timeouts of connects and commands are cut down to it,
+    hence a device which hangs can't make the run last longer than the deadline.
+    """
+
+    def __init__(self, seconds: float):
+        """
+        :param seconds: how long the run may last (0 - no deadline)
+        """
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds if seconds else None
+
+    def remaining(self) -> float:
+        """
+        :return: seconds left till the deadline (None if there is no deadline)
+        """
+        if self.expires is None:
+            return None
+
+        return max(self.expires - time.monotonic(), 0.0)
+
+    def check(self, description='') -> None:
+        if self.expires is not None and time.monotonic() >= self.expires:
+            raise DeadlineExceeded(f'Run deadline of {self.seconds} sec has been exceeded{description}')
+
+    def timeout(self, timeout: float) -> float:
+        """
+        :return: timeout cut down to the time left till the deadline
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+
+        return max(min(timeout, remaining), 1) if timeout else max(remaining, 1)
+
+
+def retry(func: Callable, retries: int, backoff: float, deadline=None, description='', before_retry: Callable = None):
+    """
+    Calls func() and retries it up to retries times if it raises an exception.
+    Delay between attempts grows exponentially (backoff, 2 * backoff, 4 * backoff, ...) with random jitter.
+
+    :param deadline: Deadline of the run. No retries are made after it
+    :param before_retry: function to call before each retry (e.g. to read what is left from the failed attempt)
+    :return: result of func()
+    """
+    attempt = 0
+    while True:
+        if deadline is not None:
+            deadline.check(f' before {description}' if description else '')
+
+        try:
+            return func()
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            if attempt >= retries:
+                raise
+
+            delay = min(backoff * 2 ** attempt, MAX_BACKOFF) * random.uniform(0.5, 1.5)
+            if deadline is not None and deadline.remaining() is not None and deadline.remaining() <= delay:
+                raise
+
+            attempt += 1
+            log.warning('%s has failed (attempt %s of %s). '
+                        'Retrying in %.1f sec. Error: %s', description, attempt, retries + 1, delay, e)
+            time.sleep(delay)
+            if before_retry is not None:
+                before_retry()
+
+
+class CircuitBreaker:
+    """
+    Skips devices which have failed in threshold consecutive runs for cooldown seconds.
+    After cooldown one attempt is allowed: success closes the breaker, failure opens it for another cooldown.
+
+    State is kept in a JSON file, hence it's shared by consecutive cron runs.
+    """
+
+    def __init__(self, filename: str, threshold: int, cooldown: int):
+        """
+        :param filename: file to keep state in (None - state isn't kept between runs)
+        :param threshold: number of consecutive failures to start skipping the device (0 - never skip devices)
+        :param cooldown: for how long (in seconds) to skip the device
+        """
+        self.filename = filename
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        self._lock = threading.Lock()
+        # device name -> {'failures': number of consecutive failures, 'open_until': timestamp, 'error': last error}
+        self.devices = dict()
+        self.load()
+
+    def load(self) -> None:
+        if self.filename is None or not exists(self.filename):
+            return
+
+        try:
+            with open(self.filename, 'r') as fp:
+                self.devices = json.load(fp)
+        except (OSError, ValueError) as e:
+            log.error('Unable to read state of circuit breaker: %s. It will be reset. Error: %s', self.filename, e)
+
+    def save(self) -> None:
+        if self.filename is None:
+            return
+
+        tmp_filename = self.filename + '.tmp'
+
+        with self._lock:
+            try:
+                os.makedirs(dirname(self.filename), exist_ok=True)
+                with open(tmp_filename, 'w') as fp:
+                    json.dump(self.devices, fp, indent=2)
+                os.replace(tmp_filename, self.filename)
+            except OSError as e:
+                log.error('Unable to write state of circuit breaker: %s. Error: %s', self.filename, e)
+
+    def allow(self, device_name: str) -> bool:
+        if not self.threshold:
+            return True
+
+        with self._lock:
+            state = self.devices.get(device_name)
+
+        if state is None or state['open_until'] <= time.time():
+            return True
+
+        log.warning('%s: device has failed %s times in a row. Skipping it till %s. Last error: %s',
+                    device_name, state['failures'],
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state['open_until'])), state['error'])
+        return False
+
+    def record_success(self, device_name: str) -> None:
+        with self._lock:
+            changed = self.devices.pop(device_name, None) is not None
+
+        if changed:
+            log.info('%s: device has recovered', device_name)
+            self.save()
+
+    def record_failure(self, device_name: str, error: str) -> None:
+        with self._lock:
+            state = self.devices.setdefault(device_name, {'failures': 0, 'open_until': 0, 'error': ''})
+            state['failures'] += 1
+            state['error'] = error
+            if self.threshold and state['failures'] >= self.threshold:
+                state['open_until'] = time.time() + self.cooldown
+
+        self.save()
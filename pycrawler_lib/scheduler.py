@@ -0,0 +1,119 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from os.path import exists
+
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+log = logging.getLogger('main_logger')
+
+# state of adaptive schedule of regular commands, kept in gathered_commands/<device_name>/
+SCHEDULE_FILENAME = '.schedule.json'
+
+# runs from crontab are not exactly interval apart, hence a command is due a bit earlier than its interval
+DUE_TOLERANCE = 0.1
+
+
+def hash_output(command_output: str) -> str:
+    return hashlib.md5(command_output.encode('utf-8')).hexdigest()
+
+
+class AdaptiveSchedule:
+    """
+    Adaptive schedule of regular commands of a single device.
+
+    Output of each command is hashed. If the output hasn't changed since the previous run, the interval of the command
+    is doubled (up to its maximum interval), if it has changed - the interval is halved (down to its minimum interval).
+    Hence stable commands are polled less often and volatile ones are polled as often as allowed.
+    """
+
+    def __init__(self, filename: str, default_intervals: Tuple[int, int], command_intervals: Dict):
+        """
+        :param filename: file to keep state in
+        :param default_intervals: (minimum, maximum) interval in seconds of commands
+        :param command_intervals: {command: (minimum, maximum)} for commands with their own intervals
+        """
+        self.filename = filename
+        self.default_intervals = default_intervals
+        self.command_intervals = command_intervals
+
+        # command -> {'hash': hash of the last output, 'interval': current interval, 'last_run': timestamp,
+        #             'runs': number of runs, 'changes': number of runs when output has changed}
+        self.commands = dict()
+        self.load()
+
+    def load(self) -> None:
+        if not exists(self.filename):
+            return
+
+        try:
+            with open(self.filename, 'r') as fp:
+                self.commands = json.load(fp)
+        except (OSError, ValueError) as e:
+            log.error('Unable to read schedule of commands: %s. It will be reset. Error: %s', self.filename, e)
+
+    def save(self) -> None:
+        tmp_filename = self.filename + '.tmp'
+
+        try:
+            with open(tmp_filename, 'w') as fp:
+                json.dump(self.commands, fp, indent=2)
+            os.replace(tmp_filename, self.filename)
+        except OSError as e:
+            log.error('Unable to write schedule of commands: %s. Error: %s', self.filename, e)
+
+    def intervals(self, command: str) -> Tuple[int, int]:
+        return self.command_intervals.get(command, self.default_intervals)
+
+    def is_due(self, command: str, now: float) -> bool:
+        state = self.commands.get(command)
+        if state is None:
+            return True
+
+        min_interval, max_interval = self.intervals(command)
+        # intervals might have been changed in settings since the previous run
+        interval = min(max(state['interval'], min_interval), max_interval)
+
+        return now - state['last_run'] >= interval * (1 - DUE_TOLERANCE)
+
+    def due(self, commands: List, now=None) -> List:
+        """
+        :return: commands which are due to run now, in the original order
+        """
+        now = time.time() if now is None else now
+        return [command for command in commands if self.is_due(command, now)]
+
+    def update(self, command: str, command_output: str, now=None) -> None:
+        """
+        Records output of the command and adjusts its interval.
+        """
+        self.update_hash(command, hash_output(command_output), now)
+
+    def update_hash(self, command: str, output_hash: str, now=None) -> None:
+        """
+        Records hash of output of the command (e.g. computed while output has been streamed) and adjusts its interval.
+        """
+        now = time.time() if now is None else now
+        min_interval, max_interval = self.intervals(command)
+
+        state = self.commands.get(command)
+        if state is None:
+            self.commands[command] = {'hash': output_hash, 'interval': min_interval, 'last_run': now,
+                                      'runs': 1, 'changes': 0}
+            return
+
+        state['runs'] += 1
+        if output_hash == state['hash']:
+            interval = state['interval'] * 2
+        else:
+            state['changes'] += 1
+            interval = state['interval'] // 2
+
+        state['hash'] = output_hash
+        state['interval'] = min(max(interval, min_interval), max_interval)
+        state['last_run'] = now
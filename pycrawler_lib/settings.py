@@ -1,5 +1,6 @@
 import os
 import logging
+import re
 from configparser import ConfigParser
 
 
@@ -10,6 +11,35 @@ def settings(ini_path):
     s["logging_console"] = "ERROR"
     s["logging_file"] = "INFO"
     s["debug_connection"] = False
+    s["max_workers"] = 10
+    s["commands_interval"] = 60
+    s["deltas_interval"] = 300
+    s["compression_codec"] = "gzip"
+    s["compression_level"] = 6
+    s["compression_workers"] = 2
+    s["storage_backend"] = "text"
+    s["keyframe_interval"] = 60
+    s["parse_counters"] = "regex"
+    s["delta_mode"] = "clear"
+    s["batch_execute"] = False
+    s["stream_output"] = False
+    s["metrics_to_store"] = 1440
+    s["run_deadline"] = 0
+    s["connect_timeout"] = 60
+    s["command_timeout"] = 120
+    s["retries"] = 2
+    s["retry_backoff"] = 2
+    s["breaker_threshold"] = 3
+    s["breaker_cooldown"] = 1800
+    s["fsync_policy"] = "close"
+    s["shard"] = ""
+    s["node_name"] = ""
+    s["adaptive_schedule"] = False
+    s["min_interval"] = 60
+    s["max_interval"] = 3600
+    s["resume_window"] = 300
+    s["log_format"] = "text"
+    s["device_log_files"] = False
 
     if os.path.exists(ini_path):
         try:
@@ -50,6 +80,184 @@ def settings(ini_path):
                                               f"file_size_to_gzip: {s['file_size_to_gzip']} "
                                               f"num_to_store: {s['num_to_store']}.")
 
+                        elif opt == "max_workers":
+                            get_opt = config.get("main", opt)
+                            try:
+                                get_opt = int(get_opt)
+                                if 1 <= get_opt <= 1000:
+                                    s[opt] = get_opt
+                                else:
+                                    logging.error(f"Option 'max_workers' in settings.ini "
+                                                  f"must be between 1 and 1000. Setting default value: "
+                                                  f"max_workers: {s['max_workers']}.")
+                            except ValueError:
+                                logging.error(f"Option 'max_workers' in settings.ini "
+                                              f"must be a number. Setting default value: "
+                                              f"max_workers: {s['max_workers']}.")
+
+                        elif opt in ["commands_interval", "deltas_interval"]:
+                            get_opt = config.get("main", opt)
+                            try:
+                                get_opt = int(get_opt)
+                                if 1 <= get_opt <= 86400:
+                                    s[opt] = get_opt
+                                else:
+                                    logging.error(f"Options 'commands_interval' and 'deltas_interval' in settings.ini "
+                                                  f"must be between 1 and 86400 seconds. Setting default values: "
+                                                  f"commands_interval: {s['commands_interval']} "
+                                                  f"deltas_interval: {s['deltas_interval']}.")
+                            except ValueError:
+                                logging.error(f"Options 'commands_interval' and 'deltas_interval' in settings.ini "
+                                              f"must be numbers. Setting default values: "
+                                              f"commands_interval: {s['commands_interval']} "
+                                              f"deltas_interval: {s['deltas_interval']}.")
+
+                        elif opt == "compression_codec":
+                            get_opt = config.get("main", opt).lower()
+                            if get_opt in ['gzip', 'zstd', 'lz4']:
+                                s[opt] = get_opt
+                            else:
+                                logging.error(f"Option 'compression_codec' in settings.ini "
+                                              f"must be one of the following values: 'gzip', 'zstd', 'lz4'. "
+                                              f"Setting default value: "
+                                              f"compression_codec: {s['compression_codec']}.")
+
+                        elif opt == "storage_backend":
+                            get_opt = config.get("main", opt).lower()
+                            if get_opt in ['text', 'records', 'delta']:
+                                s[opt] = get_opt
+                            else:
+                                logging.error(f"Option 'storage_backend' in settings.ini "
+                                              f"must be one of the following values: 'text', 'records', 'delta'. "
+                                              f"Setting default value: "
+                                              f"storage_backend: {s['storage_backend']}.")
+
+                        elif opt == "delta_mode":
+                            get_opt = config.get("main", opt).lower()
+                            if get_opt in ['clear', 'snapshot']:
+                                s[opt] = get_opt
+                            else:
+                                logging.error(f"Option 'delta_mode' in settings.ini "
+                                              f"must be one of the following values: 'clear', 'snapshot'. "
+                                              f"Setting default value: "
+                                              f"delta_mode: {s['delta_mode']}.")
+
+                        elif opt == "parse_counters":
+                            get_opt = config.get("main", opt)
+                            if get_opt in ['False', 'regex', 'genie']:
+                                s[opt] = get_opt
+                            else:
+                                logging.error(f"Option 'parse_counters' in settings.ini "
+                                              f"must be one of the following values: 'False', 'regex', 'genie'. "
+                                              f"Setting default value: "
+                                              f"parse_counters: {s['parse_counters']}.")
+
+                        elif opt in ["compression_level", "compression_workers", "keyframe_interval",
+                                     "metrics_to_store", "run_deadline", "connect_timeout", "command_timeout",
+                                     "retries", "retry_backoff", "breaker_threshold", "breaker_cooldown",
+                                     "min_interval", "max_interval", "resume_window"]:
+                            get_opt = config.get("main", opt)
+                            min_value, max_value = {"compression_level": (0, 22), "compression_workers": (1, 64),
+                                                    "keyframe_interval": (1, 10000),
+                                                    "metrics_to_store": (0, 100000),
+                                                    "run_deadline": (0, 86400),
+                                                    "connect_timeout": (1, 3600),
+                                                    "command_timeout": (1, 3600),
+                                                    "retries": (0, 10),
+                                                    "retry_backoff": (0, 600),
+                                                    "breaker_threshold": (0, 1000),
+                                                    "breaker_cooldown": (1, 604800),
+                                                    "min_interval": (1, 86400),
+                                                    "max_interval": (1, 604800),
+                                                    "resume_window": (0, 86400)}[opt]
+                            try:
+                                get_opt = int(get_opt)
+                                if min_value <= get_opt <= max_value:
+                                    s[opt] = get_opt
+                                else:
+                                    logging.error(f"Option '{opt}' in settings.ini must be between "
+                                                  f"{min_value} and {max_value}. Setting default value: "
+                                                  f"{opt}: {s[opt]}.")
+                            except ValueError:
+                                logging.error(f"Option '{opt}' in settings.ini must be a number. "
+                                              f"Setting default value: {opt}: {s[opt]}.")
+
+                        elif opt == "fsync_policy":
+                            get_opt = config.get("main", opt).lower()
+                            if get_opt in ['never', 'close', 'batch']:
+                                s[opt] = get_opt
+                            else:
+                                logging.error(f"Option 'fsync_policy' in settings.ini "
+                                              f"must be one of the following values: 'never', 'close', 'batch'. "
+                                              f"Setting default value: "
+                                              f"fsync_policy: {s['fsync_policy']}.")
+
+                        elif opt == "shard":
+                            get_opt = config.get("main", opt).strip()
+                            match = re.match(r'^(\d+)/(\d+)$', get_opt)
+                            if not get_opt:
+                                s[opt] = get_opt
+                            elif match and 1 <= int(match.group(1)) <= int(match.group(2)):
+                                s[opt] = get_opt
+                            else:
+                                logging.error(f"Option 'shard' in settings.ini must be empty or 'i/n' "
+                                              f"where 1 <= i <= n, e.g. '1/3'. Setting default value: "
+                                              f"shard: '{s['shard']}' (all devices).")
+
+                        elif opt == "log_format":
+                            get_opt = config.get("main", opt).lower()
+                            if get_opt in ['text', 'json']:
+                                s[opt] = get_opt
+                            else:
+                                logging.error(f"Option 'log_format' in settings.ini "
+                                              f"must be one of the following values: 'text', 'json'. "
+                                              f"Setting default value: "
+                                              f"log_format: {s['log_format']}.")
+
+                        elif opt == "device_log_files":
+                            get_opt = config.get("main", opt)
+                            if get_opt == 'False':
+                                s[opt] = False
+                            elif get_opt == 'True':
+                                s[opt] = True
+                            else:
+                                logging.error(f"Option 'device_log_files' is not either 'True' or 'False'."
+                                              f"Setting default value: "
+                                              f"device_log_files: {s['device_log_files']}.")
+
+                        elif opt == "batch_execute":
+                            get_opt = config.get("main", opt)
+                            if get_opt == 'False':
+                                s[opt] = False
+                            elif get_opt == 'True':
+                                s[opt] = True
+                            else:
+                                logging.error(f"Option 'batch_execute' is not either 'True' or 'False'."
+                                              f"Setting default value: "
+                                              f"batch_execute: {s['batch_execute']}.")
+
+                        elif opt == "stream_output":
+                            get_opt = config.get("main", opt)
+                            if get_opt == 'False':
+                                s[opt] = False
+                            elif get_opt == 'True':
+                                s[opt] = True
+                            else:
+                                logging.error(f"Option 'stream_output' is not either 'True' or 'False'."
+                                              f"Setting default value: "
+                                              f"stream_output: {s['stream_output']}.")
+
+                        elif opt == "adaptive_schedule":
+                            get_opt = config.get("main", opt)
+                            if get_opt == 'False':
+                                s[opt] = False
+                            elif get_opt == 'True':
+                                s[opt] = True
+                            else:
+                                logging.error(f"Option 'adaptive_schedule' is not either 'True' or 'False'."
+                                              f"Setting default value: "
+                                              f"adaptive_schedule: {s['adaptive_schedule']}.")
+
                         elif opt == "debug_connection":
                             get_opt = config.get("main", opt)
                             if get_opt == 'False':
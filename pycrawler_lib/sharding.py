@@ -0,0 +1,226 @@
+import bisect
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+from os.path import exists, isdir, join, relpath
+
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+log = logging.getLogger('main_logger')
+
+# output of each node is written to gathered_commands/nodes/<node name>/
+NODES_DIR_NAME = 'nodes'
+
+# per-node manifest: which shard the node has collected and which devices belong to it
+NODE_MANIFEST_FILENAME = '.node.json'
+
+# merged manifest of all nodes and directory with links to the latest output of each device
+MANIFEST_FILENAME = 'manifest.json'
+DEVICES_DIR_NAME = 'devices'
+
+# number of points of each shard on the hash ring. More points - more even split of devices between shards
+VIRTUAL_NODES = 100
+
+SHARD_RE = re.compile(r'^(?P<index>\d+)/(?P<count>\d+)$')
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    :param shard: 'i/n' - shard i (starting from 1) out of n shards
+    :return: (i, n)
+    """
+    m = SHARD_RE.match(shard.strip())
+    if not m or not 1 <= int(m.group('index')) <= int(m.group('count')):
+        raise ValueError(f"Shard must be specified as 'i/n' where 1 <= i <= n, e.g. '1/3'. Got: '{shard}'")
+
+    return int(m.group('index')), int(m.group('count'))
+
+
+def hash_key(key: str) -> int:
+    # hash() of str is randomized per process, hence md5 is used to get the same split on every host
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of device names to shards.
+
+    Every host computes the same split from device names alone, without talking to other hosts.
+    When a shard is added, only about 1/n of devices move to it, the rest stay where their history is.
+    """
+
+    def __init__(self, count: int, virtual_nodes=VIRTUAL_NODES):
+        """
+        :param count: number of shards
+        """
+        self.count = count
+        points = sorted((hash_key(f'shard-{shard}-{point}'), shard)
+                        for shard in range(1, count + 1) for point in range(virtual_nodes))
+        self._hashes = [point_hash for point_hash, shard in points]
+        self._shards = [shard for point_hash, shard in points]
+
+    def shard_of(self, device_name: str) -> int:
+        """
+        :return: shard (starting from 1) the device belongs to
+        """
+        position = bisect.bisect(self._hashes, hash_key(device_name)) % len(self._hashes)
+        return self._shards[position]
+
+
+def select_devices(device_names, index: int, count: int) -> List:
+    """
+    :return: names of devices which belong to shard index out of count
+    """
+    ring = HashRing(count)
+    return [device_name for device_name in device_names if ring.shard_of(device_name) == index]
+
+
+class ShardedTestbed:
+    """
+    Part of pyATS testbed which contains only devices of this shard. Everything else is taken from the testbed.
+    """
+
+    def __init__(self, testbed, device_names: List):
+        self.testbed = testbed
+        self.devices = {device_name: testbed.devices[device_name] for device_name in device_names}
+
+    def __getattr__(self, name):
+        return getattr(self.testbed, name)
+
+
+def node_dir(dir_name: str, node_name: str) -> str:
+    return join(dir_name, NODES_DIR_NAME, node_name)
+
+
+def write_json(filename: str, data: Dict) -> None:
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as fp:
+        json.dump(data, fp, indent=2)
+    os.replace(tmp_filename, filename)
+
+
+def write_node_manifest(node_path: str, node_name: str, shard: str, device_names: List) -> None:
+    """
+    Records which devices the node has been collecting, hence merge knows the owner of each device
+    even if the shard has been changed and old output of the device is left in other node directories.
+    """
+    try:
+        os.makedirs(node_path, exist_ok=True)
+        write_json(join(node_path, NODE_MANIFEST_FILENAME),
+                   {'node': node_name, 'shard': shard, 'devices': sorted(device_names), 'updated': time.time()})
+    except OSError as e:
+        log.error('Unable to write node manifest to: %s. Error: %s', node_path, e)
+
+
+def read_node_manifest(node_path: str) -> Dict:
+    filename = join(node_path, NODE_MANIFEST_FILENAME)
+    if not exists(filename):
+        return None
+
+    try:
+        with open(filename, 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError) as e:
+        log.error('Unable to read node manifest: %s. Error: %s', filename, e)
+        return None
+
+
+def link_device(devices_path: str, device_name: str, target: str) -> None:
+    link_name = join(devices_path, device_name)
+    tmp_link_name = link_name + '.tmp'
+
+    if exists(tmp_link_name) or os.path.islink(tmp_link_name):
+        os.remove(tmp_link_name)
+    os.symlink(relpath(target, devices_path), tmp_link_name)
+    os.replace(tmp_link_name, link_name)
+
+
+def merge(dir_name: str) -> Dict:
+    """
+    Unifies output of all nodes copied (e.g. with rsync) to dir_name/nodes/.
+
+    Writes dir_name/manifest.json with the owner node and all paths of each device,
+    and dir_name/devices/<device name> links to output of the owner node.
+
+    The owner of a device is the node which has collected it most recently according to node manifests.
+    Devices found only on disk (e.g. manifest of the node has been lost) are owned by the node
+    with the most recent manifest among the ones which have the device.
+
+    :return: merged manifest
+    """
+    nodes_path = join(dir_name, NODES_DIR_NAME)
+    if not isdir(nodes_path):
+        log.error('No output of nodes has been found in: %s', nodes_path)
+        return None
+
+    nodes = dict()
+    # device name -> names of nodes which have output of the device
+    found = dict()
+    # device name -> (updated, node name) of the node which lists the device in its manifest
+    owners = dict()
+
+    for node_name in sorted(os.listdir(nodes_path)):
+        node_path = join(nodes_path, node_name)
+        if not isdir(node_path):
+            continue
+
+        node_manifest = read_node_manifest(node_path) or {'shard': None, 'devices': [], 'updated': 0}
+        nodes[node_name] = {'shard': node_manifest['shard'], 'updated': node_manifest['updated'],
+                            'devices': len(node_manifest['devices'])}
+
+        for device_name in node_manifest['devices']:
+            if device_name in owners:
+                log.warning('%s: device is listed by more than one node: %s and %s. '
+                            'Output of the most recent one is used', device_name, owners[device_name][1], node_name)
+            owners[device_name] = max(owners.get(device_name, (0, '')), (node_manifest['updated'], node_name))
+
+        for device_name in sorted(os.listdir(node_path)):
+            if device_name.startswith('.') or not isdir(join(node_path, device_name)):
+                continue
+            found.setdefault(device_name, []).append(node_name)
+
+    shards = {nodes[node_name]['shard'].split('/')[1] for node_name in nodes if nodes[node_name]['shard']}
+    if len(shards) > 1:
+        log.warning('Nodes have been run with different number of shards: %s. '
+                    'Devices might be collected twice or not at all', sorted(shards))
+
+    devices = dict()
+    for device_name, node_names in sorted(found.items()):
+        if device_name in owners and owners[device_name][1] in node_names:
+            owner = owners[device_name][1]
+        else:
+            owner = max((nodes[node_name]['updated'], node_name) for node_name in node_names)[1]
+        devices[device_name] = {'node': owner,
+                                'paths': [relpath(join(node_dir(dir_name, node_name), device_name), dir_name)
+                                          for node_name in node_names]}
+
+    manifest = {'merged': time.time(), 'nodes': nodes, 'devices': devices}
+
+    devices_path = join(dir_name, DEVICES_DIR_NAME)
+    try:
+        os.makedirs(devices_path, exist_ok=True)
+        for device_name, device in devices.items():
+            link_device(devices_path, device_name, join(node_dir(dir_name, device['node']), device_name))
+        write_json(join(dir_name, MANIFEST_FILENAME), manifest)
+    except OSError as e:
+        log.error('Unable to write merged manifest to: %s. Error: %s', dir_name, e)
+
+    return manifest
+
+
+def format_manifest(manifest: Dict) -> str:
+    lines = [f'{"node":<30}{"shard":>8}{"devices":>10}  last run']
+    for node_name, node in manifest['nodes'].items():
+        updated = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(node['updated'])) if node['updated'] else '-'
+        lines.append(f'{node_name:<30}{node["shard"] or "-":>8}{node["devices"]:>10}  {updated}')
+
+    moved = [device_name for device_name, device in manifest['devices'].items() if len(device['paths']) > 1]
+    lines.append(f'Devices: {len(manifest["devices"])}, with output on more than one node: {len(moved)}')
+
+    return '\n'.join(lines)
@@ -1,14 +1,144 @@
+import atexit
+import datetime
+import json
 import logging
 import logging.handlers
+import queue
+import threading
 
+from contextlib import contextmanager
 from os import path
 from os import mkdir
 from pathlib import Path
-from pyats.log import TaskLogHandler
 
-def set_main_logging(logging_level_console='ERROR', logging_level_file='INFO') -> logging.getLogger():
+# fields of context of the calling thread added to every record (see log_context())
+LOG_CONTEXT_FIELDS = ('device', 'command', 'phase')
+
+# per-device log files: log/devices/<device_name>.log up to 5 Mbytes of size, 3 files per device.
+# Only this many files are kept open, the least recently used one is closed when a new one is opened
+DEVICE_LOG_DIR_NAME = 'devices'
+DEVICE_LOG_FILE_SIZE = 5
+DEVICE_LOG_BACKUP_COUNT = 3
+MAX_OPEN_DEVICE_LOGS = 256
+
+_context = threading.local()
+_listener = None
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Adds fields (device, command, phase) to records logged by the current thread within the block.
+    Blocks might be nested: inner fields are added to the outer ones.
+    """
+    previous = getattr(_context, 'fields', {})
+    _context.fields = {**previous, **fields}
+    try:
+        yield
+    finally:
+        _context.fields = previous
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records to the queue of the listener thread.
+
+    Unlike QueueHandler, the message isn't formatted here: records are queued with their arguments and formatted
+    by the listener thread, hence callers pay only for creation of the record. Arguments must not be changed
+    after the call to the logger. Context of the calling thread is added to the record.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        fields = getattr(_context, 'fields', {})
+        for field in LOG_CONTEXT_FIELDS:
+            setattr(record, field, fields.get(field))
+
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as JSON lines with context of the record (device, command, phase) as separate keys.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                 .isoformat(timespec='milliseconds'),
+                 'level': record.levelname,
+                 'file': record.filename,
+                 'line': record.lineno,
+                 'function': record.funcName,
+                 'thread': record.threadName}
+
+        for field in LOG_CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+
+        entry['message'] = record.getMessage()
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DeviceFileHandler(logging.Handler):
+    """
+    Writes records which have device in their context to log/devices/<device_name>.log.
+    """
+
+    def __init__(self, dir_path: str, max_open=MAX_OPEN_DEVICE_LOGS):
+        super().__init__()
+        self.dir_path = dir_path
+        self.max_open = max_open
+        # device name -> handler of its file, the least recently used first
+        self._handlers = dict()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        device_name = getattr(record, 'device', None)
+        if device_name is None:
+            return
+
+        handler = self._handlers.pop(device_name, None)
+        if handler is None:
+            filename = path.join(self.dir_path, f'{str(device_name).replace("/", "_")}.log')
+            handler = logging.handlers.RotatingFileHandler(filename, maxBytes=(1048576 * DEVICE_LOG_FILE_SIZE),
+                                                           backupCount=DEVICE_LOG_BACKUP_COUNT, encoding='utf-8',
+                                                           delay=True)
+            handler.setFormatter(self.formatter)
+            if len(self._handlers) >= self.max_open:
+                self._handlers.pop(next(iter(self._handlers))).close()
+        self._handlers[device_name] = handler
+
+        handler.emit(record)
+
+    def close(self) -> None:
+        for handler in self._handlers.values():
+            handler.close()
+        self._handlers.clear()
+        super().close()
+
+
+def stop_logging() -> None:
     """
-    Sets logger (for stderr, file).
+    Writes records which are still in the queue and stops the listener thread. Called at exit.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def set_main_logging(logging_level_console='ERROR', logging_level_file='INFO', log_format='text',
+                     device_log_files=False) -> logging.getLogger():
+    """
+    Sets logger (for stderr, file and optionally per-device files).
+
+    Records are put to a queue and written by a background listener thread, hence formatting and I/O of logs
+    don't add latency to collection. Logger level is the lowest level of the handlers, hence calls to the logger
+    with a disabled level return right away.
 
     In case logging directory doesn't exist, will try to create it.
     If it's not possible to save to logging directory, will start to save to the directory with the script.
@@ -16,6 +146,8 @@ def set_main_logging(logging_level_console='ERROR', logging_level_file='INFO') -
     :param DIRECTORY: Logging directory
     :param LOG_NAME: Logging file name
     :param LOG_FILE_SIZE: Size of each logging file in MBytes
+    :param log_format: format of log files: 'text' or 'json' (JSON lines with device, command and phase as keys)
+    :param device_log_files: whether to write records of each device to log/devices/<device_name>.log as well
     :return: link to the root logger object.
     """
 
@@ -25,17 +157,30 @@ def set_main_logging(logging_level_console='ERROR', logging_level_file='INFO') -
     logging_num_file = logging_level_to_num[logging_level_file]
 
     global root_logger
+    global _listener
     root_logger = logging.getLogger('main_logger')
     root_logger.propagate = False
-    root_logger.setLevel(logging.DEBUG)
+    root_logger.setLevel(min(logging_num_console, logging_num_file))
     logFormatter = logging.Formatter("%(asctime)s - %(filename)s - "
                                      "line %(lineno)s - %(funcName)s - %(levelname)s: %(message)s")
+    fileFormatter = JsonFormatter() if log_format == 'json' else logFormatter
+
+    # handlers are run by the listener thread
+    handlers = []
 
     # Initialize logging to console:
     consoleHandler = logging.StreamHandler()
     consoleHandler.setLevel(logging_num_console)
     consoleHandler.setFormatter(logFormatter)
-    root_logger.addHandler(consoleHandler)
+    handlers.append(consoleHandler)
+
+    stop_logging()
+    _listener = logging.handlers.QueueListener(queue.SimpleQueue(), *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    for handler in [handler for handler in root_logger.handlers if isinstance(handler, ContextQueueHandler)]:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(ContextQueueHandler(_listener.queue))
 
     log_dir_name = 'log'
     script_directory = Path(__file__).resolve().parents[1]
@@ -52,17 +197,29 @@ def set_main_logging(logging_level_console='ERROR', logging_level_file='INFO') -
         file_handler = logging.handlers.RotatingFileHandler(LOGFILE, maxBytes=(1048576 * LOG_FILE_SIZE), backupCount=10,
                                                             encoding='utf-8')
         file_handler.setLevel(logging_num_file)
-        file_handler.setFormatter(logFormatter)
-        root_logger.addHandler(file_handler)
+        file_handler.setFormatter(fileFormatter)
+        handlers.append(file_handler)
 
         '''
+        from pyats.log import TaskLogHandler
         PYATS_LOGFILE = path.join(abs_log_path, 'pyats.log')
         pyats_handler = TaskLogHandler(PYATS_LOGFILE)
         root_logger.addHandler(pyats_handler)
         '''
 
     except PermissionError:
-        root_logger.exception(f'Unable to create log file: {LOGFILE}.\nLogs not saved!')
+        root_logger.exception('Unable to create log file: %s.\nLogs not saved!', LOGFILE)
+
+    if device_log_files:
+        device_log_path = path.join(abs_log_path, DEVICE_LOG_DIR_NAME)
+        create_non_existing_dir(device_log_path)
+        device_handler = DeviceFileHandler(device_log_path)
+        device_handler.setLevel(logging_num_file)
+        device_handler.setFormatter(fileFormatter)
+        handlers.append(device_handler)
+
+    # handlers of the running listener are replaced at once, the listener reads them for every record
+    _listener.handlers = tuple(handlers)
 
     return root_logger
 
@@ -72,9 +229,9 @@ def create_non_existing_dir(dir_path):
         try:
             mkdir(dir_path)
         except PermissionError as e:
-            root_logger.error(f'Unable to create directory: {dir_path}. Insufficient privileges. Error: {e}')
+            root_logger.error('Unable to create directory: %s. Insufficient privileges. Error: %s', dir_path, e)
     else:
-        root_logger.debug(f'directory {dir_path} already exists. No need to create')
+        root_logger.debug('directory %s already exists. No need to create', dir_path)
 
 
 
@@ -0,0 +1,173 @@
+import datetime
+import functools
+import logging
+import os
+import re
+
+log = logging.getLogger('main_logger')
+
+# Time of the snapshot is kept as 'ST: 2020-11-30 18:44:43+00:00' (time of the server)
+# or 'DT: 2020-11-30 18:44:43+00:00' (time of the device)
+SERVER_TIME_PREFIX = 'ST'
+DEVICE_TIME_PREFIX = 'DT'
+
+TIME_READABLE_RE = re.compile(r'^\s*(?:(?P<prefix>[SD]T):\s+)?'
+                              r'(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})[ T]'
+                              r'(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})(?:\.\d+)?'
+                              r'(?:(?P<utc>Z)|(?P<sign>[+-])(?P<tz_hours>\d{2}):?(?P<tz_minutes>\d{2}))?\s*$')
+
+# output of 'show time' on FTD: 'UTC - Mon Nov 30 18:44:43 UTC 2020'
+FTD_UTC_TIME_RE = re.compile(r'(UTC\s+-\s+)(.*)')
+FTD_TIME_RE = re.compile(r'^\s*\w{3}\s+(?P<month>\w{3})\s+(?P<day>\d{1,2})\s+'
+                         r'(?P<hour>\d{1,2}):(?P<minute>\d{2}):(?P<second>\d{2})\s+'
+                         r'(?P<tz>UTC|GMT)\s+(?P<year>\d{4})\s*$')
+
+MONTHS = {month: number for number, month in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                                         'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1)}
+
+TIME_TRUNC_RE = re.compile(r'(\w+:\s+)\d+-(\d+)-(\d+)(\s+\d+:\d+\d+:\d+).*')
+
+
+@functools.lru_cache(maxsize=1)
+def get_dateparser():
+    """
+    dateparser is slow to import (it loads data of all languages), hence it's imported
+    only when time in unknown format has to be parsed.
+    """
+    log.debug('Time in unknown format. Loading dateparser')
+    import dateparser
+    return dateparser
+
+
+@functools.lru_cache(maxsize=256)
+def parse_with_dateparser(time_string: str):
+    """
+    :return: aware datetime in UTC or None if time_string couldn't be parsed (or dateparser isn't installed)
+    """
+    try:
+        dateparser = get_dateparser()
+    except ImportError:
+        log.error('Unable to parse time: "%s". It has unknown format and dateparser is not installed. '
+                  'Install it with: pip install dateparser', time_string)
+        return None
+
+    date_time = dateparser.parse(time_string, settings={'TIMEZONE': 'UTC', 'RETURN_AS_TIMEZONE_AWARE': True})
+    if date_time is None:
+        log.error('Unable to parse time: "%s"', time_string)
+        return None
+
+    return date_time.astimezone(datetime.timezone.utc)
+
+
+def parse_time_readable(time_readable: str):
+    """
+    :param time_readable: time in format 'DT: 2020-11-30 18:44:43+00:00' (prefix is optional)
+    :return: aware datetime or None if time couldn't be parsed
+    """
+    match = TIME_READABLE_RE.match(time_readable)
+    if not match:
+        return parse_with_dateparser(re.sub(r'^\s*[SD]T:\s+', '', time_readable))
+
+    tzinfo = datetime.timezone.utc
+    if match.group('sign'):
+        offset = datetime.timedelta(hours=int(match.group('tz_hours')), minutes=int(match.group('tz_minutes')))
+        tzinfo = datetime.timezone(offset if match.group('sign') == '+' else -offset)
+
+    return datetime.datetime(int(match.group('year')), int(match.group('month')), int(match.group('day')),
+                             int(match.group('hour')), int(match.group('minute')), int(match.group('second')),
+                             tzinfo=tzinfo)
+
+
+def parse_ftd_time(ftd_time: str):
+    """
+    :param ftd_time: time from 'show time' output of FTD, e.g. 'Mon Nov 30 18:44:43 UTC 2020'
+    :return: aware datetime in UTC or None if time couldn't be parsed
+    """
+    match = FTD_TIME_RE.match(ftd_time)
+    if not match or match.group('month') not in MONTHS:
+        return parse_with_dateparser(ftd_time)
+
+    return datetime.datetime(int(match.group('year')), MONTHS[match.group('month')], int(match.group('day')),
+                             int(match.group('hour')), int(match.group('minute')), int(match.group('second')),
+                             tzinfo=datetime.timezone.utc)
+
+
+def get_ftd_utc_time(command_output: str) -> str:
+    """
+    :return: UTC time from 'show time' output of FTD or empty string if there is no UTC time in the output
+    """
+    for time_command_line in command_output.splitlines():
+        # Due to the CSCvc04969 for FPR2100 and FPR1100 ("Need option to set local timezone on FTD") -
+        # it's better to get UTC time from FTD now:
+        device_time_now = FTD_UTC_TIME_RE.match(time_command_line)
+        if device_time_now:
+            return device_time_now.group(2)
+
+    return ''
+
+
+def format_time_readable(prefix: str, date_time) -> str:
+    return f'{prefix}: {date_time.replace(microsecond=0)}'
+
+
+def server_time_readable() -> str:
+    return format_time_readable(SERVER_TIME_PREFIX, datetime.datetime.now(datetime.timezone.utc))
+
+
+def to_timestamp(time_readable: str, default=None) -> float:
+    """
+    :return: seconds since epoch for time in format 'DT: 2020-11-30 18:44:43+00:00' or default if it couldn't be parsed
+    """
+    date_time = parse_time_readable(time_readable)
+    return date_time.timestamp() if date_time is not None else default
+
+
+def time_trunc(time_readable: str) -> str:
+    """
+    Truncates time for banners: 'DT: 2020-11-30 18:44:43+00:00' -> 'DT: 30.11 18:44:43'
+    """
+    match_time = TIME_TRUNC_RE.match(time_readable)
+    if match_time:
+        time_readable = f'{match_time.group(1)}{match_time.group(3)}.{match_time.group(2)}{match_time.group(4)}'
+
+    return time_readable
+
+
+def write_clear_flag(filename: str, timestamp: float, time_readable: str) -> None:
+    """
+    Writes time of the last clear of counters: seconds since epoch on the first line, readable time on the second one.
+    The flag is replaced atomically, hence it's never left half-written.
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, mode='w') as fp:
+        fp.write(f'{timestamp}\n{time_readable}\n')
+    os.replace(tmp_filename, filename)
+
+
+def read_clear_flag(filename: str):
+    """
+    Reads time of the last clear of counters. Flags written by older versions contain only readable time.
+
+    :return: (seconds since epoch, readable time)
+    :raises ValueError: if the flag is empty or time in it couldn't be parsed
+    """
+    with open(filename, mode='r') as fp:
+        lines = fp.read().splitlines()
+
+    if not lines or not lines[0].strip():
+        raise ValueError('empty .clear_flag file')
+
+    try:
+        timestamp = float(lines[0])
+    except ValueError:
+        # legacy format: 'DT: 2020-11-30 18:44:43+00:00'
+        timestamp = to_timestamp(lines[0])
+        if timestamp is None:
+            raise ValueError(f'unknown time format: {lines[0]}')
+        return timestamp, lines[0].strip()
+
+    if len(lines) > 1 and lines[1].strip():
+        return timestamp, lines[1].strip()
+
+    date_time = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return timestamp, format_time_readable(SERVER_TIME_PREFIX, date_time)
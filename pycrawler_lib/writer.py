@@ -0,0 +1,369 @@
+import logging
+import os
+import queue
+import threading
+
+from collections import OrderedDict
+
+from typing import Callable
+
+import pycrawler_lib.records as records
+
+log = logging.getLogger('main_logger')
+
+# how many files to keep open at the same time (the least recently used one is closed first)
+MAX_OPEN_FILES = 256
+
+# how many queued items to coalesce into a single batch of writes
+MAX_BATCH_ITEMS = 1000
+
+# how many items may wait in the queue before collectors are slowed down
+MAX_QUEUE_ITEMS = 10000
+
+_APPEND = 'append'
+_STREAM_START = 'stream_start'
+_STREAM_END = 'stream_end'
+_TASK = 'task'
+_CLOSE = 'close'
+_FLUSH = 'flush'
+_CALLBACK = 'callback'
+_STOP = 'stop'
+
+
+class OutputWriter:
+    """
+    Background writer stage for output of commands.
+
+    Collectors hand over output with append() and return immediately. A single writer thread keeps files open
+    for the duration of the run, coalesces all queued writes to the same file into one write and reports failure
+    only for the file which couldn't be written (e.g. full or read-only directory), hence other files
+    and devices are not affected.
+    """
+
+    def __init__(self, fsync_policy='close'):
+        """
+        :param fsync_policy: 'never' - leave it to the OS, 'close' - when a file is closed (end of run, rotation),
+                             'batch' - after every batch of coalesced writes
+        """
+        self.fsync_policy = fsync_policy
+
+        self._queue = queue.Queue(maxsize=MAX_QUEUE_ITEMS)
+        # filename -> open file object, ordered from the least to the most recently used
+        self._files = OrderedDict()
+        # filename -> (offset, timestamp) of the streamed data which is being written to the file
+        self._streams = dict()
+        # filename -> error of the first failed write
+        self.failures = dict()
+        self._failures_lock = threading.Lock()
+        # nothing is queued after close(): e.g. a device which is still running after the run deadline
+        # has its output discarded instead of waiting for the writer thread which has been stopped
+        self._closed = False
+        self._put_lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._run, name='writer', daemon=True)
+        self._thread.start()
+
+    def append(self, filename: str, data, on_written: Callable = None, timestamp: float = None) -> None:
+        """
+        Queues data (str or bytes) to append to the file.
+
+        :param on_written: function on_written(file size) to call from the writer thread when data has been written
+        :param timestamp: time of the data (seconds since epoch). If specified, (timestamp, offset, length) of the data
+                          is appended to the offset index of the file (the same format as the one of records),
+                          hence the data could be found by time without reading the whole file
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._put(_APPEND, filename, (data, on_written, timestamp))
+
+    def open_stream(self, filename: str, on_written: Callable = None, timestamp: float = None) -> 'OutputStream':
+        """
+        Opens a stream to append data which arrives in chunks (e.g. streamed output of a command). All chunks written
+        to the stream get a single entry in the offset index of the file, as if they have been appended at once.
+        Chunks are queued like any other data, hence the writer thread keeps memory bounded by the queue size.
+
+        :param on_written: function on_written(file size) to call when the stream has been closed and written
+        :param timestamp: time of the data (seconds since epoch) for the offset index
+        """
+        self._put(_STREAM_START, filename, timestamp)
+        return OutputStream(self, filename, on_written)
+
+    def end_stream(self, filename: str, on_written: Callable = None) -> None:
+        self._put(_STREAM_END, filename, on_written)
+
+    def submit(self, filename: str, task: Callable) -> None:
+        """
+        Queues task() which writes to the file on its own (e.g. appends a record). Tasks and appends
+        are executed in the order they have been queued. Failure of the task is recorded for the file.
+        """
+        self._put(_TASK, filename, task)
+
+    def close_file(self, filename: str) -> None:
+        """
+        Writes everything queued for the file and closes it together with its offset index. Blocks till it's done.
+        Must be called before the file is moved (e.g. to archive directory).
+        """
+        if threading.current_thread() is self._thread:
+            # called by a callback (see call_when_written()): everything queued before it is written already
+            self._close(filename)
+            self._close(records.index_filename(filename))
+            return
+
+        done = threading.Event()
+        if self._put(_CLOSE, filename, done):
+            done.wait()
+
+    def flush(self) -> None:
+        """
+        Blocks till everything queued so far has been written.
+        """
+        done = threading.Event()
+        if self._put(_FLUSH, None, done):
+            done.wait()
+
+    def call_when_written(self, callback: Callable) -> None:
+        """
+        Queues callback() to call from the writer thread once everything queued so far has been written.
+        Unlike flush(), the caller doesn't wait for it. After close() the callback is discarded.
+        """
+        self._put(_CALLBACK, None, callback)
+
+    def close(self) -> None:
+        """
+        Writes everything queued, closes all files (with fsync unless policy is 'never') and stops the writer thread.
+        """
+        with self._put_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put((_STOP, None, None))
+        self._thread.join()
+
+        if self.failures:
+            log.error('Output has not been written to %s files: %s', len(self.failures),
+                      '; '.join(f'{filename}: {error}' for filename, error in self.failures.items()))
+
+    def _put(self, kind: str, filename: str, payload) -> bool:
+        """
+        :return: whether the item has been queued. After close() items are discarded
+                 and failure is recorded for the file
+        """
+        with self._put_lock:
+            if not self._closed:
+                self._queue.put((kind, filename, payload))
+                return True
+
+        if filename is not None:
+            self._record_failure(filename, RuntimeError('writer has been closed, output is discarded'))
+        return False
+
+    def failed(self, filename: str) -> bool:
+        with self._failures_lock:
+            return filename in self.failures
+
+    def _record_failure(self, filename: str, error: Exception) -> None:
+        with self._failures_lock:
+            first_failure = filename not in self.failures
+            self.failures.setdefault(filename, str(error))
+
+        if first_failure:
+            log.error('Unable to write output to file: %s. Due to error: %s', filename, error)
+        else:
+            log.debug('Unable to write output to file: %s. Due to error: %s', filename, error)
+
+    def _open(self, filename: str):
+        fp = self._files.get(filename)
+        if fp is not None:
+            self._files.move_to_end(filename)
+            return fp
+
+        if len(self._files) >= MAX_OPEN_FILES:
+            self._close(next(iter(self._files)))
+
+        fp = open(filename, 'ab')
+        self._files[filename] = fp
+        return fp
+
+    def _close(self, filename: str) -> None:
+        fp = self._files.pop(filename, None)
+        if fp is None:
+            return
+
+        try:
+            fp.flush()
+            if self.fsync_policy != 'never':
+                os.fsync(fp.fileno())
+        except OSError as e:
+            self._record_failure(filename, e)
+        finally:
+            try:
+                fp.close()
+            except OSError:
+                pass
+
+    def _discard(self, filename: str) -> None:
+        # the handle might be broken, it will be reopened for the next write
+        fp = self._files.pop(filename, None)
+        if fp is not None:
+            try:
+                fp.close()
+            except OSError:
+                pass
+
+    def _write_index(self, filename: str, offset: int, chunks: list) -> None:
+        entries = []
+        for data, on_written, timestamp in chunks:
+            if timestamp is not None:
+                entries.append(records.INDEX_ENTRY.pack(timestamp, offset, len(data)))
+            offset += len(data)
+
+        self._write_index_entries(filename, entries)
+
+    def _write_index_entries(self, filename: str, entries: list) -> None:
+        if not entries:
+            return
+
+        index_filename = records.index_filename(filename)
+        try:
+            fp = self._open(index_filename)
+            fp.write(b''.join(entries))
+            fp.flush()
+        except OSError as e:
+            # output is written already, readers rebuild missing entries of the index from the file itself
+            log.error('Unable to write offset index: %s. Error: %s', index_filename, e)
+            self._discard(index_filename)
+
+    def _write(self, filename: str, chunks: list) -> None:
+        try:
+            fp = self._open(filename)
+            offset = fp.tell()
+            fp.write(b''.join(data for data, on_written, timestamp in chunks))
+            fp.flush()
+            if self.fsync_policy == 'batch':
+                os.fsync(fp.fileno())
+            file_size = fp.tell()
+        except OSError as e:
+            self._record_failure(filename, e)
+            self._discard(filename)
+            return
+
+        self._write_index(filename, offset, chunks)
+
+        for data, on_written, timestamp in chunks:
+            if on_written is not None:
+                try:
+                    on_written(file_size)
+                except Exception as e:
+                    log.error('Unable to update size of file: %s. Error: %s', filename, e)
+
+    def _start_stream(self, filename: str, timestamp: float) -> None:
+        try:
+            self._streams[filename] = (self._open(filename).tell(), timestamp)
+        except OSError as e:
+            self._record_failure(filename, e)
+            self._discard(filename)
+
+    def _end_stream(self, filename: str, on_written: Callable) -> None:
+        stream = self._streams.pop(filename, None)
+        try:
+            file_size = self._open(filename).tell()
+        except OSError as e:
+            self._record_failure(filename, e)
+            self._discard(filename)
+            return
+
+        if stream is not None:
+            offset, timestamp = stream
+            if timestamp is not None:
+                self._write_index_entries(filename, [records.INDEX_ENTRY.pack(timestamp, offset, file_size - offset)])
+
+        if on_written is not None:
+            try:
+                on_written(file_size)
+            except Exception as e:
+                log.error('Unable to update size of file: %s. Error: %s', filename, e)
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            while len(batch) < MAX_BATCH_ITEMS:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # filename -> list of (data, on_written), writes to the same file are coalesced
+            appends = OrderedDict()
+
+            for kind, filename, payload in batch:
+                if kind == _APPEND:
+                    appends.setdefault(filename, []).append(payload)
+                    continue
+
+                # everything queued before start or end of stream, close, task or stop has to be written first
+                if filename in appends:
+                    self._write(filename, appends.pop(filename))
+
+                if kind == _STREAM_START:
+                    self._start_stream(filename, payload)
+                elif kind == _STREAM_END:
+                    self._end_stream(filename, payload)
+                elif kind == _TASK:
+                    try:
+                        payload()
+                    except Exception as e:
+                        self._record_failure(filename, e)
+                elif kind == _CLOSE:
+                    self._close(filename)
+                    self._close(records.index_filename(filename))
+                    payload.set()
+                elif kind == _FLUSH:
+                    for append_filename, chunks in appends.items():
+                        self._write(append_filename, chunks)
+                    appends.clear()
+                    payload.set()
+                elif kind == _CALLBACK:
+                    for append_filename, chunks in appends.items():
+                        self._write(append_filename, chunks)
+                    appends.clear()
+                    try:
+                        payload()
+                    except Exception as e:
+                        log.exception('Callback after written output has failed. Error: %s', e)
+                elif kind == _STOP:
+                    for append_filename, chunks in appends.items():
+                        self._write(append_filename, chunks)
+                    appends.clear()
+                    stop = True
+
+            for filename, chunks in appends.items():
+                self._write(filename, chunks)
+
+        for filename in list(self._files):
+            self._close(filename)
+
+
+class OutputStream:
+    """
+    Data of a single snapshot appended to a file in chunks through the writer (see OutputWriter.open_stream()).
+    """
+
+    def __init__(self, output_writer: OutputWriter, filename: str, on_written: Callable = None):
+        self.output_writer = output_writer
+        self.filename = filename
+        self.on_written = on_written
+
+    def write(self, data: bytes) -> None:
+        self.output_writer.append(self.filename, data)
+
+    def close(self) -> None:
+        self.output_writer.end_stream(self.filename, self.on_written)
+
+    def abort(self, error: Exception) -> None:
+        """
+        Marks the data written so far as truncated and closes the stream.
+        """
+        log.error('Streamed output written to: %s has been truncated. Due to error: %s', self.filename, error)
+        self.write(f'\nOutput has been truncated due to error: {error}\n'.encode('utf-8'))
+        self.close()
@@ -0,0 +1,11 @@
+import pycrawler_lib.archive_index as archive_index
+
+
+def test_save_changes(tmp_path):
+    index = archive_index.ArchiveIndex(str(tmp_path))
+    index.update_size('ftd-1_show_blocks', 1024)
+
+    index.save_changes()
+
+    assert archive_index.ArchiveIndex(str(tmp_path)).files == {'ftd-1_show_blocks': 1024}
+    assert not index.changed
@@ -0,0 +1,11 @@
+import pycrawler_lib.compression as compression
+
+
+def test_check_level():
+    assert compression.check_level('gzip', 9) == 9
+    assert compression.check_level('zstd', 19) == 19
+
+
+def test_check_level_not_accepted_by_codec():
+    # e.g. zstd level is kept after falling back to gzip
+    assert compression.check_level('gzip', 19) == compression.DEFAULT_LEVEL
@@ -0,0 +1,30 @@
+import pycrawler_lib.counters as counters
+
+
+def test_compute_deltas():
+    deltas, reset = counters.compute_deltas({'no-route': 5, 'nat-failed': 7}, {'no-route': 8, 'nat-failed': 7})
+
+    assert deltas == {'no-route': 3, 'nat-failed': 0}
+    assert not reset
+
+
+def test_compute_deltas_counter_reset():
+    deltas, reset = counters.compute_deltas({'no-route': 5}, {'no-route': 2})
+
+    assert deltas == {'no-route': 2}
+    assert reset
+
+
+def test_compute_deltas_counter_disappeared():
+    # 'show asp drop' leaves out counters which are zero: after a clear only new counters might be left
+    deltas, reset = counters.compute_deltas({'no-route': 5, 'nat-failed': 7}, {'invalid-tcp-hdr-length': 4})
+
+    assert deltas == {'invalid-tcp-hdr-length': 4}
+    assert reset
+
+
+def test_compute_deltas_counter_wrapped():
+    deltas, reset = counters.compute_deltas({'no-route': 2 ** 32 - 10}, {'no-route': 5})
+
+    assert deltas == {'no-route': 15}
+    assert not reset
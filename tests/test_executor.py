@@ -0,0 +1,91 @@
+import pycrawler_lib.executor as executor
+
+PROMPT = 'ftd> '
+
+
+class Match:
+    def __init__(self, match_output: str):
+        self.match_output = match_output
+        self.last_match_index = 0
+
+
+class State:
+    pattern = r'^(.*?)ftd> $'
+
+
+class StateMachine:
+    current_state = 'enable'
+
+    def get_state(self, state: str) -> State:
+        return State()
+
+
+class Spawn:
+    """
+    Terminal which returns prepared raw output, regardless of what is sent to it.
+    """
+
+    def __init__(self, raw_output: str):
+        self.buffer = raw_output
+        self.sent = []
+
+    def sendline(self, command='') -> None:
+        self.sent.append(command)
+
+    def expect(self, patterns, timeout=None) -> Match:
+        # device reads type-ahead only when it shows the prompt, hence the first prompt is matched
+        position = self.buffer.find(PROMPT)
+        if position < 0:
+            raise TimeoutError('no prompt')
+        match_output = self.buffer[:position + len(PROMPT)]
+        self.buffer = self.buffer[position + len(PROMPT):]
+        return Match(match_output)
+
+
+class Device:
+    def __init__(self, name: str, raw_output: str):
+        self.name = name
+        self.spawn = Spawn(raw_output)
+        self.state_machine = StateMachine()
+        self.executed = []
+        self.connects = 0
+
+    def connect(self, **kwargs) -> None:
+        self.connects += 1
+
+    def disconnect(self) -> None:
+        pass
+
+    def execute(self, command: str, **kwargs) -> str:
+        self.executed.append(command)
+        return f'output of {command}\n'
+
+
+def test_execute_batch():
+    device = Device('ftd-batch', f'show clock\r\n12:00:00\r\n{PROMPT}show version\r\nVersion 7.0\r\n{PROMPT}')
+
+    outputs = executor.execute_commands(device, ['show clock', 'show version'], batch=True)
+
+    assert outputs == {'show clock': '12:00:00\n', 'show version': 'Version 7.0\n'}
+    assert device.executed == []
+
+
+def test_execute_batch_interleaved_echo():
+    # echo of 'show version' has arrived before the end of output of 'show clock'
+    device = Device('ftd-interleaved', f'show clock\r\nshow version\r\n12:00:00\r\n{PROMPT}Version 7.0\r\n{PROMPT}')
+
+    outputs = executor.execute_commands(device, ['show clock', 'show version'], batch=True)
+
+    assert outputs == {'show clock': 'output of show clock\n', 'show version': 'output of show version\n'}
+    assert device.executed == ['show clock', 'show version']
+    assert 'ftd-interleaved' in executor._batch_unsupported
+    # there is no prompt left to resync with
+    assert device.connects == 1
+
+
+def test_resync_reads_all_prompts():
+    device = Device('ftd-resync', f'Version 7.0\r\n{PROMPT}show failover\r\nFailover Off\r\n{PROMPT}\r\n{PROMPT}')
+
+    executor.resync(device)
+
+    assert device.spawn.buffer == ''
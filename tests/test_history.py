@@ -0,0 +1,64 @@
+import datetime
+import os
+
+import pycrawler_lib.compression as compression
+import pycrawler_lib.history as history
+
+
+def utc(*args) -> float:
+    return datetime.datetime(*args, tzinfo=datetime.timezone.utc).timestamp()
+
+
+def snapshot(day: int, hour: int, output: str) -> str:
+    return f'\n*****DT: {day:02}.11 {hour:02}:00:00. Unit failover status: Active*****\n{output}\n'
+
+
+def test_block_reader_reads_across_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr(compression, 'BLOCK_SIZE', 100)
+    data = bytes(range(256)) * 4
+    filename = str(tmp_path / 'ftd-1_show_blocks')
+    with open(filename, 'wb') as fp:
+        fp.write(data)
+    archive_name = compression.compress_file(filename, str(tmp_path / 'ftd-1_show_blocks_1606780800.gz'), 'gzip', 6)
+
+    reader = history.BlockReader(archive_name, 'gzip')
+    try:
+        assert reader.size == len(data)
+        reader.seek(250)
+        assert reader.read(300) == data[250:550]
+        reader.seek(-50, os.SEEK_CUR)
+        assert reader.read(10) == data[500:510]
+        reader.seek(1000)
+        assert reader.read(100) == data[1000:]
+    finally:
+        reader.close()
+
+
+def test_query_time_range(tmp_path):
+    commands_path = tmp_path / 'ftd-1' / 'commands'
+    archive_path = commands_path / 'archive'
+    archive_path.mkdir(parents=True)
+
+    # the oldest snapshots have been rotated to an archive on 29.11
+    filename = str(commands_path / 'ftd-1_show_blocks')
+    with open(filename, 'w') as fp:
+        fp.write(snapshot(27, 10, 'output 1') + snapshot(28, 10, 'output 2'))
+    compression.compress_file(filename, str(archive_path / f'ftd-1_show_blocks_{int(utc(2020, 11, 29)):010}.gz'),
+                              'gzip', 6)
+
+    with open(filename, 'w') as fp:
+        fp.write(snapshot(29, 10, 'output 3') + snapshot(30, 10, 'output 4'))
+    os.utime(filename, (utc(2020, 12, 1), utc(2020, 12, 1)))
+
+    snapshots = history.query(str(tmp_path), 'ftd-1', 'show_blocks', utc(2020, 11, 28), utc(2020, 11, 29, 12))
+
+    assert [timestamp for timestamp, text in snapshots] == [utc(2020, 11, 28, 10), utc(2020, 11, 29, 10)]
+    assert 'output 2' in snapshots[0][1] and 'output 3' in snapshots[1][1]
+    assert [text for timestamp, text in history.query(str(tmp_path), 'ftd-1', 'show_blocks', last=1)] == \
+        [snapshot(30, 10, 'output 4')]
+
+
+def test_parse_time():
+    assert history.parse_time('2020-11-30') == utc(2020, 11, 30)
+    assert history.parse_time('2020-11-30 18:44') == utc(2020, 11, 30, 18, 44)
+    assert history.parse_time('1606761883') == 1606761883.0
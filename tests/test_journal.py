@@ -0,0 +1,90 @@
+import os
+
+import pycrawler_lib.journal as journal
+import pycrawler_lib.timestamps as timestamps
+
+CLEAR = {'timestamp': 1606761883.0, 'time': 'DT: 2020-11-30 18:44:43+00:00'}
+
+
+def start_run(dir_path: str, mode='all', resume_window=300) -> journal.RunJournal:
+    run_journal = journal.RunJournal(dir_path, mode, resume_window, fsync=False)
+    run_journal.start()
+    return run_journal
+
+
+def test_interrupted_run_is_resumed(tmp_path):
+    interrupted = start_run(str(tmp_path))
+    device_journal = interrupted.device(str(tmp_path))
+    device_journal.commit(journal.CONNECT)
+    device_journal.commit(journal.COMMANDS)
+
+    resumed = start_run(str(tmp_path))
+
+    assert resumed.resumed
+    assert resumed.run_id == interrupted.run_id
+    device_journal = resumed.device(str(tmp_path))
+    assert device_journal.done(journal.COMMANDS)
+    assert not device_journal.finished()
+
+
+def test_finished_run_is_not_resumed(tmp_path):
+    finished = start_run(str(tmp_path))
+    finished.device(str(tmp_path)).commit(journal.ARCHIVE)
+    finished.finish()
+
+    next_run = start_run(str(tmp_path))
+
+    assert not next_run.resumed
+    # phases of the previous run are not done in the next one
+    assert not next_run.device(str(tmp_path)).finished()
+
+
+def test_interrupted_run_of_another_mode_is_not_resumed(tmp_path):
+    start_run(str(tmp_path), mode='commands')
+
+    assert not start_run(str(tmp_path), mode='deltas').resumed
+    assert not start_run(str(tmp_path), mode='deltas', resume_window=0).resumed
+
+
+def interrupt_delta_pair(dir_path: str, phases) -> journal.RunJournal:
+    run_journal = start_run(dir_path)
+    device_journal = run_journal.device(dir_path)
+    for phase in phases:
+        device_journal.commit(phase, **({'clear': CLEAR} if phase == journal.DELTA_CLEARS_STARTED else {}))
+    return run_journal
+
+
+def test_repair_clear_flag_after_clears(tmp_path):
+    flag_filename = str(tmp_path / '.clear_flag')
+    timestamps.write_clear_flag(flag_filename, 1606760000.0, 'DT: 2020-11-30 18:13:20+00:00')
+    interrupt_delta_pair(str(tmp_path), [journal.DELTA_SHOWS, journal.DELTA_CLEARS_STARTED, journal.DELTA_CLEARS])
+
+    device_journal = start_run(str(tmp_path), resume_window=0).device(str(tmp_path))
+    device_journal.repair_clear_flag(flag_filename)
+
+    assert timestamps.read_clear_flag(flag_filename)[0] == CLEAR['timestamp']
+
+
+def test_repair_clear_flag_during_clears(tmp_path):
+    flag_filename = str(tmp_path / '.clear_flag')
+    timestamps.write_clear_flag(flag_filename, 1606760000.0, 'DT: 2020-11-30 18:13:20+00:00')
+    interrupt_delta_pair(str(tmp_path), [journal.DELTA_SHOWS, journal.DELTA_CLEARS_STARTED])
+
+    device_journal = start_run(str(tmp_path)).device(str(tmp_path))
+    device_journal.repair_clear_flag(flag_filename)
+
+    # counters might have been cleared partially: the next delta would cover a wrong interval
+    assert not os.path.exists(flag_filename)
+    # resumed run clears counters again
+    assert device_journal.done(journal.DELTA_SHOWS)
+    assert not device_journal.done(journal.DELTA_CLEARS_STARTED)
+
+
+def test_finished_delta_pair_is_not_repaired(tmp_path):
+    flag_filename = str(tmp_path / '.clear_flag')
+    timestamps.write_clear_flag(flag_filename, CLEAR['timestamp'], CLEAR['time'])
+    interrupt_delta_pair(str(tmp_path), [journal.DELTA_CLEARS_STARTED, journal.DELTA_CLEARS, journal.CLEAR_FLAG])
+
+    start_run(str(tmp_path)).device(str(tmp_path)).repair_clear_flag(flag_filename)
+
+    assert timestamps.read_clear_flag(flag_filename)[0] == CLEAR['timestamp']
@@ -0,0 +1,11 @@
+import pycrawler_lib.plans as plans
+
+
+def test_command_filename():
+    assert plans.command_filename('show asp drop') == 'show_asp_drop'
+    assert plans.command_filename('show interface *') == 'show_interface_all'
+
+
+def test_command_filename_piped_command():
+    # file names of existing output and archives must not change
+    assert plans.command_filename('show blocks old dump | b 80') == 'show_blocks_old_dump_|_b_80'
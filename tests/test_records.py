@@ -0,0 +1,111 @@
+import os
+
+import pycrawler_lib.records as records
+
+
+def test_snapshot_cache_drops_least_recently_used():
+    cache = records.SnapshotCache(10)
+    cache.put('a.rec', {'output': 'aaaa'})
+    cache.put('b.rec', {'output': 'bbbb'})
+    cache.get('a.rec')
+
+    cache.put('c.rec', {'output': 'cccc'})
+
+    assert cache.get('a.rec') == {'output': 'aaaa'}
+    assert cache.get('b.rec') == dict()
+    assert cache.get('c.rec') == {'output': 'cccc'}
+
+
+def test_diff_against_dropped_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(records, '_last_snapshots', records.SnapshotCache(0))
+    abs_filename = str(tmp_path / 'ftd-1_show_blocks')
+    outputs = [f'line 1\nline 2\ncounter {i}\n' + 'line\n' * 100 for i in range(3)]
+
+    for i, output in enumerate(outputs):
+        records.append_record(abs_filename, 'ftd-1', 'show blocks', output, 1000.0 + i, f'time {i}', 'Active',
+                              keyframe_interval=10)
+
+    stored = list(records.iter_records(records.records_filename(abs_filename)))
+    assert [record['output'] for record in stored] == outputs
+    assert 'keyframe' in stored[-1]
+
+
+def append_outputs(abs_filename, outputs, keyframe_interval=0):
+    for i, output in enumerate(outputs):
+        records.append_record(abs_filename, 'ftd-1', 'show blocks', output, 1000.0 + i, f'time {i}', 'Active',
+                              keyframe_interval=keyframe_interval)
+
+    return records.records_filename(abs_filename)
+
+
+def test_append_and_read_record(tmp_path):
+    records_file = append_outputs(str(tmp_path / 'ftd-1_show_blocks'), ['output 0\n', 'output 1\n', 'output 2\n'])
+
+    record = records.read_record(records_file, 1001.5)
+
+    assert record['output'] == 'output 1\n'
+    assert record['device'] == 'ftd-1'
+    assert record['failover'] == 'Active'
+    assert records.read_record(records_file, 999.0) == dict()
+    assert [record['output'] for record in records.iter_records(records_file, 1001.0, 1002.0)] == \
+        ['output 1\n', 'output 2\n']
+
+
+def test_rebuild_missing_index(tmp_path):
+    records_file = append_outputs(str(tmp_path / 'ftd-1_show_blocks'), ['output 0\n', 'output 1\n'])
+    entries = records.read_index(records_file)
+    os.remove(records.index_filename(records_file))
+
+    assert records.read_index(records_file) == entries
+    assert records.read_record(records_file, 1001.0)['output'] == 'output 1\n'
+
+
+def test_truncated_record_is_cut_off(tmp_path):
+    records_file = append_outputs(str(tmp_path / 'ftd-1_show_blocks'), ['output 0\n', 'output 1\n'])
+    size = os.path.getsize(records_file)
+    # process has been killed while it has been writing the next record
+    with open(records_file, 'ab') as fp:
+        fp.write(records.RECORD_PREFIX.pack(records.RECORD_MAGIC, 100, 100) + b'{"timestamp"')
+
+    records.check_index(records_file)
+
+    assert os.path.getsize(records_file) == size
+    assert [entry[0] for entry in records.read_index(records_file)] == [1000.0, 1001.0]
+
+
+def test_index_without_last_entry_is_rebuilt(tmp_path):
+    records_file = append_outputs(str(tmp_path / 'ftd-1_show_blocks'), ['output 0\n', 'output 1\n'])
+    # process has been killed between writing record and its index entry
+    idx_file = records.index_filename(records_file)
+    os.truncate(idx_file, records.INDEX_ENTRY.size)
+
+    records.append_record(str(tmp_path / 'ftd-1_show_blocks'), 'ftd-1', 'show blocks', 'output 2\n', 1002.0,
+                          'time 2', 'Active')
+
+    assert [record['output'] for record in records.iter_records(records_file)] == \
+        ['output 0\n', 'output 1\n', 'output 2\n']
+
+
+def test_delta_round_trip(tmp_path):
+    outputs = [f'counter {i}\n' + 'line\n' * 100 for i in range(7)]
+    records_file = append_outputs(str(tmp_path / 'ftd-1_show_blocks'), outputs, keyframe_interval=3)
+
+    with open(records_file, 'rb') as fp:
+        types = []
+        for timestamp, offset, length in records.read_index(records_file):
+            fp.seek(offset)
+            types.append('diff' if 'diff' in records.decode_record(fp.read(length)) else 'full')
+
+    assert types == ['full', 'diff', 'diff', 'full', 'diff', 'diff', 'full']
+    assert [record['output'] for record in records.iter_records(records_file)] == outputs
+    # the first record in the range is a diff, it's rebuilt from its keyframe
+    assert [record['output'] for record in records.iter_records(records_file, 1004.0, 1005.0)] == outputs[4:6]
+    assert records.read_record(records_file, 1005.0)['output'] == outputs[5]
+
+
+def test_delta_stores_full_output_if_diff_is_bigger(tmp_path):
+    outputs = ['a\n', 'b\n']
+    records_file = append_outputs(str(tmp_path / 'ftd-1_show_blocks'), outputs, keyframe_interval=10)
+
+    assert [record['type'] for record in records.iter_records(records_file)] == \
+        [records.RECORD_FULL, records.RECORD_FULL]
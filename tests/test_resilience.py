@@ -0,0 +1,70 @@
+import pytest
+
+import pycrawler_lib.resilience as resilience
+
+
+def test_retry_calls_before_retry():
+    calls = []
+
+    def func():
+        calls.append('func')
+        if len(calls) < 3:
+            raise TimeoutError('timeout')
+        return 'output'
+
+    assert resilience.retry(func, 2, 0, before_retry=lambda: calls.append('before_retry')) == 'output'
+    assert calls == ['func', 'before_retry', 'func']
+
+
+def test_retry_gives_up_after_retries(monkeypatch):
+    delays = []
+    monkeypatch.setattr(resilience.time, 'sleep', delays.append)
+    monkeypatch.setattr(resilience.random, 'uniform', lambda a, b: 1)
+    calls = []
+
+    def func():
+        calls.append('func')
+        raise TimeoutError('timeout')
+
+    with pytest.raises(TimeoutError):
+        resilience.retry(func, 3, 2)
+
+    assert len(calls) == 4
+    # backoff is doubled for each next retry
+    assert delays == [2, 4, 8]
+
+
+def test_retry_stops_at_deadline(monkeypatch):
+    monkeypatch.setattr(resilience.time, 'sleep', lambda delay: None)
+    deadline = resilience.Deadline(100)
+    deadline.expires = resilience.time.monotonic() - 1
+
+    with pytest.raises(resilience.DeadlineExceeded):
+        resilience.retry(lambda: 'output', 3, 0, deadline, 'ftd-1: connect')
+
+
+def test_circuit_breaker_opens_after_threshold(tmp_path):
+    breaker = resilience.CircuitBreaker(str(tmp_path / '.circuit_breaker.json'), 2, 1800)
+
+    breaker.record_failure('ftd-1', 'Connection error: refused')
+    assert breaker.allow('ftd-1')
+
+    breaker.record_failure('ftd-1', 'Connection error: refused')
+    assert not breaker.allow('ftd-1')
+    assert breaker.allow('ftd-2')
+
+
+def test_circuit_breaker_state_is_kept_between_runs(tmp_path):
+    filename = str(tmp_path / '.circuit_breaker.json')
+    breaker = resilience.CircuitBreaker(filename, 1, 1800)
+    breaker.record_failure('ftd-1', 'Connection error: refused')
+
+    next_run_breaker = resilience.CircuitBreaker(filename, 1, 1800)
+
+    assert not next_run_breaker.allow('ftd-1')
+    assert next_run_breaker.devices['ftd-1']['error'] == 'Connection error: refused'
+
+    next_run_breaker.devices['ftd-1']['open_until'] = 0
+    assert next_run_breaker.allow('ftd-1')
+    next_run_breaker.record_success('ftd-1')
+    assert resilience.CircuitBreaker(filename, 1, 1800).devices == dict()
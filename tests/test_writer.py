@@ -0,0 +1,75 @@
+import os
+
+import pycrawler_lib.records as records
+import pycrawler_lib.writer as writer
+
+
+def test_call_when_written(tmp_path):
+    filename = str(tmp_path / 'ftd-1_show_asp_drop')
+    output_writer = writer.OutputWriter()
+    sizes = []
+
+    output_writer.append(filename, 'output\n')
+    output_writer.call_when_written(lambda: sizes.append(os.path.getsize(filename)))
+    output_writer.close()
+
+    assert sizes == [len('output\n')]
+
+
+def test_failure_affects_only_its_file(tmp_path):
+    good_filename = str(tmp_path / 'ftd-1_show_blocks')
+    # e.g. directory of the device has been removed or is not writable
+    bad_filename = str(tmp_path / 'missing' / 'ftd-2_show_blocks')
+    output_writer = writer.OutputWriter()
+    sizes = []
+
+    output_writer.append(bad_filename, 'output of ftd-2\n')
+    output_writer.append(good_filename, 'output of ftd-1\n', sizes.append)
+    output_writer.append(bad_filename, 'more output of ftd-2\n')
+    output_writer.append(good_filename, 'more output of ftd-1\n', sizes.append)
+    output_writer.close()
+
+    with open(good_filename) as fp:
+        assert fp.read() == 'output of ftd-1\nmore output of ftd-1\n'
+    assert sizes[-1] == os.path.getsize(good_filename)
+    assert output_writer.failed(bad_filename)
+    assert not output_writer.failed(good_filename)
+
+
+def test_failed_task_affects_only_its_file(tmp_path):
+    filename = str(tmp_path / 'ftd-1_show_blocks')
+    output_writer = writer.OutputWriter()
+
+    def task():
+        raise OSError('No space left on device')
+
+    output_writer.submit(filename + '.rec', task)
+    output_writer.append(filename, 'output\n')
+    output_writer.close()
+
+    assert output_writer.failed(filename + '.rec')
+    assert not output_writer.failed(filename)
+    assert os.path.getsize(filename) == len('output\n')
+
+
+def test_output_after_close_is_discarded(tmp_path):
+    filename = str(tmp_path / 'ftd-1_show_blocks')
+    output_writer = writer.OutputWriter()
+    output_writer.close()
+
+    output_writer.append(filename, 'output\n')
+    output_writer.flush()
+
+    assert not os.path.exists(filename)
+    assert output_writer.failed(filename)
+
+
+def test_offset_index(tmp_path):
+    filename = str(tmp_path / 'ftd-1_show_blocks')
+    output_writer = writer.OutputWriter()
+
+    output_writer.append(filename, 'first\n', timestamp=1000.0)
+    output_writer.append(filename, 'second\n', timestamp=1001.0)
+    output_writer.close()
+
+    assert records.load_index(records.index_filename(filename)) == [(1000.0, 0, 6), (1001.0, 6, 7)]